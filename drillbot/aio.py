@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains an asyncio variant of the drilldown menu bot.
+
+Transitions may define move_to and move_from as coroutines, in which case they're given
+an AsyncMachine whose Telegram operations are awaited. Regular transitions are run
+in the executor with a regular Machine, so existing transitions work unchanged.
+
+Telegram requests are still made with the blocking python-telegram-bot client, on a thread pool,
+so the number of requests in flight at once is bounded by its size.
+"""
+
+import asyncio
+import inspect
+import logging
+import os
+import sys
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import telegram
+from telegram.utils.request import Request
+
+from .concurrency import _update_key # pylint: disable=relative-beyond-top-level
+from .drillbot import DrillBot, DENIED_MESSAGE, STALE_KEYBOARD_MESSAGE # pylint: disable=relative-beyond-top-level
+from .machine import Machine, BACK, HOME, BACK_EMOJI, HOME_EMOJI # pylint: disable=relative-beyond-top-level
+from .transition import Transition # pylint: disable=relative-beyond-top-level
+
+logger = logging.getLogger(__name__)
+
+class AsyncMachine(Machine):
+    """This class is a Machine whose Telegram operations are coroutines.
+
+    The underlying requests are blocking ones made on the executor's threads, sharing a connection pool,
+    so they don't block the event loop, but each one holds a thread until it's answered.
+    """
+
+    def __init__(self, bot, update, user_data, executor, storage=None, rebuild_options=None): # pylint: disable=too-many-arguments
+        """Initialize this object for a given conversation."""
+        super().__init__(bot, update, user_data, storage=storage, rebuild_options=rebuild_options)
+        self.executor = executor
+
+    def sync(self):
+        """Get a regular Machine for the same conversation, for use on the executor."""
+        # share the state, instead of loading it from the storage again
+        machine = Machine(self.bot, self.update, {"MachineInfo": self.info}, rebuild_options=self.rebuild_options)
+        machine.user_data = self.user_data
+        machine.storage = self.storage
+        # the message was already decoded, which can mean rebuilding the keyboard's options
+        machine._message = self._message # pylint: disable=protected-access
+        machine._stale_callback = self._stale_callback # pylint: disable=protected-access
+        return machine
+
+    async def reply(self, text): # pylint: disable=invalid-overridden-method
+        """Send a message."""
+        await self._run(Machine.reply, self, text)
+
+    async def send_keyboard(self, title, menu_options, options=None, reply_markup=None, page_size=None, page=0): # pylint: disable=invalid-overridden-method,too-many-arguments
+        """Send an inline keyboard with commands."""
+        await self._run(Machine.send_keyboard, self, title, menu_options, options, reply_markup, page_size, page)
+
+    async def end_callback(self): # pylint: disable=invalid-overridden-method
+        """Complete a callback query."""
+        await self._run(Machine.end_callback, self)
+
+    def _run(self, func, *args):
+        """Run a blocking function on the executor."""
+        return asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+
+class AsyncTransition(Transition): # pylint: disable=abstract-method
+    """This is an abstract base class for transitions with coroutine move_to and move_from.
+
+    They're given an AsyncMachine, so Telegram operations must be awaited.
+    """
+
+class AsyncDrillBot(DrillBot):
+    """This class is for creating a drilldown menu bot running on asyncio.
+
+    Updates are handled concurrently across users, and in order for each user.
+    Waiting updates only cost a coroutine, but Telegram requests and regular transitions
+    each take one of the workers' threads while they run.
+
+    It always polls for updates and handles them itself, so configure_webhook, configure_concurrency,
+    configure_deferred_keyboards and configure_long_running aren't supported, and raise NotImplementedError.
+    """
+
+    def __init__(self, token, home_state, transitions, workers=32):
+        """Initialize this bot with a set of state transitions.
+
+        workers is the size of the thread pool Telegram requests and regular transitions share,
+        so it's also how many of them can run at once.
+        """
+        super().__init__(token, home_state, transitions)
+        self.workers = workers
+        self.executor = None
+        self.bot = None
+        self.user_data = defaultdict(dict)
+        self._user_locks = {}
+        self._tasks = set()
+        self._loop = None
+        self._running = False
+        self._restart = False
+
+    def configure_webhook(self, *args, **kwargs): # pylint: disable=arguments-differ
+        """Not supported, since updates are polled for."""
+        raise _unsupported("configure_webhook")
+
+    def configure_concurrency(self, *args, **kwargs): # pylint: disable=arguments-differ
+        """Not supported, since updates from different users are already handled concurrently."""
+        raise _unsupported("configure_concurrency")
+
+    def configure_deferred_keyboards(self, *args, **kwargs): # pylint: disable=arguments-differ
+        """Not supported, since handlers already don't block each other while keyboards are sent."""
+        raise _unsupported("configure_deferred_keyboards")
+
+    def configure_long_running(self, *args, **kwargs): # pylint: disable=arguments-differ
+        """Not supported, since a slow transition only holds up its own user's updates."""
+        raise _unsupported("configure_long_running")
+
+    def start_bot(self):
+        """Start the bot, and block until it's stopped, restarting the process if /restart asked for it."""
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            logger.info("Stopping bot.")
+        finally:
+            self._shutdown()
+        if self._restart:
+            os.execl(sys.executable, sys.executable, *sys.argv)
+
+    async def run(self):
+        """Poll for updates and handle them until stopped, then wait for the updates already received."""
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.bot = self._wrap_bot(telegram.Bot(self.token, request=Request(con_pool_size=self.workers + 1)))
+        self._track_sessions(self.user_data)
+        self.graph = self._compile_graph(self.transitions)
+        loop = self._loop = asyncio.get_running_loop()
+        offset = None
+        self._running = True
+        try:
+            while self._running:
+                try:
+                    updates = await loop.run_in_executor(
+                        self.executor, partial(self.bot.get_updates, offset=offset, timeout=10))
+                except telegram.error.TimedOut:
+                    continue
+                except telegram.error.TelegramError:
+                    logger.exception("Error polling for updates.")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    offset = update.update_id + 1
+                    # keep a reference, so the task isn't garbage collected and can be waited for
+                    task = loop.create_task(self.process_update(update))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+        finally:
+            if self._tasks:
+                logger.info("Waiting for %s updates to be handled.", len(self._tasks))
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stop(self):
+        """Stop polling for updates."""
+        self._running = False
+
+    async def process_update(self, update):
+        """Handle a single update, after any earlier updates from the same user."""
+        if not update.effective_chat or update.channel_post:
+            return
+        if self.recorder:
+            self.recorder.record(self.bot, update)
+        try:
+            await self._locked(_update_key(update), self._handle_update(update))
+        except BaseException: # pylint: disable=broad-except
+            logger.exception("Error handling update.")
+
+    async def _locked(self, key, coroutine):
+        """Await a coroutine while holding the lock for a user (or a chat without one), returning its result."""
+        lock = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+        lock[1] += 1
+        try:
+            async with lock[0]:
+                return await coroutine
+        finally:
+            lock[1] -= 1
+            if not lock[1]:
+                del self._user_locks[key]
+
+    async def _handle_update(self, update):
+        """Run an update through the auth, setup, and conversation layers."""
+        user = update.effective_user
+        # auth
+        if not self._is_allowed(update):
+            user_id = user.id if user else None
+            if self.denials.allow(user_id):
+                logger.warning("Blocked request from %s, not in allowed_ids %s",
+                               user_id,
+                               self.allowed_ids)
+                if self.notify_auth_failure and user_id is not None:
+                    logger.info("Replying with access denied notification.")
+                    await asyncio.get_running_loop().run_in_executor(
+                        self.executor, partial(self.bot.send_message, chat_id=update.effective_chat.id,
+                                               text=DENIED_MESSAGE.format(user_id)))
+            return
+        user_data = self.user_data[user.id if user else None]
+        machine = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._create_machine, update, user_data)
+        # setup
+        await machine.end_callback()
+        # main
+        command = _get_command(update)
+        if command == "restart":
+            await self._restart_async(machine)
+        elif command == "broadcast":
+            await self._broadcast_async(machine)
+        elif command == "start":
+            machine.clear()
+            logger.info("Received /start from user '%s' with id '%s'",
+                        machine.user_name(),
+                        machine.user_id())
+            await self._goto_state_async(machine, self.home_state)
+        elif command == "debug":
+            await self._debug_async(machine)
+        elif command == "back" or (update.callback_query and machine.get_message() == BACK_EMOJI):
+            await self._goto_state_async(machine, BACK)
+        elif update.callback_query and machine.get_message() == HOME_EMOJI:
+            await self._goto_state_async(machine, self.home_state)
+        elif machine.get_current_state() is not None:
+            if machine.get_current_state() not in self.transitions:
+                # the conversation state is gone, such as after a reload removed it, so start over
+                machine.ascend_all()
+                await self._goto_state_async(machine, self.home_state)
+                return
+            transition = self.transitions[machine.get_current_state()]
+            if machine.is_stale_callback():
+                await machine.reply(STALE_KEYBOARD_MESSAGE)
+                await self._call_async(transition.move_to, machine)
+                return
+            await self._handle_state_async(machine, machine.get_current_state(), transition)
+
+    def _create_machine(self, update, user_data):
+        """Create the machine for an update, with its message decoded. Run on the executor, since either can block.
+
+        Loading the state can read from the storage, and decoding a button press can call options_func
+        to rebuild the options of the user's keyboard.
+        """
+        machine = AsyncMachine(self.bot, update, user_data, self.executor, storage=self.storage,
+                               rebuild_options=self._rebuild_options)
+        machine.get_message()
+        return machine
+
+    async def _handle_state_async(self, machine, state, transition):
+        """Handle user input in a state, recording how long it took if metrics are configured."""
+        if not self.metrics:
+            await self._move_from_async(machine, state, transition)
+            return
+        start = time.perf_counter()
+        try:
+            await self._move_from_async(machine, state, transition)
+        finally:
+            self.metrics.observe("drillbot_handler_seconds", time.perf_counter() - start, state=state)
+
+    async def _move_from_async(self, machine, state, transition):
+        """Move away from a state after user input, or refresh it if that's rejected."""
+        # menu selections are looked up directly
+        new_state = self.graph.route(state, machine.get_message())
+        if new_state:
+            await self._goto_state_async(machine, new_state)
+            return
+        # try to move away
+        try:
+            new_state = await self._call_async(transition.move_from, machine)
+        except BaseException: # pylint: disable=broad-except
+            logger.exception("Error during move_from transition.")
+            await self._send_error_message_async(machine)
+            return
+        if new_state:
+            await self._goto_state_async(machine, new_state)
+            return
+        # couldn't move away, so refresh
+        try:
+            await self._call_async(transition.move_to, machine)
+        except BaseException: # pylint: disable=broad-except
+            logger.exception("Error during move_to transition after rejected move_from.")
+            await self._send_error_message_async(machine)
+
+    async def _goto_state_async(self, machine, state):
+        """Navigate to a state."""
+        if state is None:
+            return
+        # back and home
+        if state == HOME:
+            state = self.home_state
+            machine.ascend_all()
+        elif state == BACK:
+            if not machine.can_ascend():
+                return
+            state = machine.ascend()
+        # move
+        try:
+            should_change_state = await self._call_async(self.transitions[state].move_to, machine)
+        except BaseException: # pylint: disable=broad-except
+            logger.exception("Error during move_to transition.")
+            await self._send_error_message_async(machine)
+            return
+        # refresh menu
+        if not should_change_state:
+            current_state = machine.get_current_state()
+            try:
+                await self._call_async(self.transitions[current_state].move_to, machine)
+            except BaseException: # pylint: disable=broad-except
+                logger.exception("Error during move_to transition after rejected move_to.")
+                await self._send_error_message_async(machine)
+            return
+        # descend
+        machine.descend(state)
+
+    async def _call_async(self, func, machine):
+        """Call a transition method, awaiting it if it's a coroutine or running it on the executor if not."""
+        if inspect.iscoroutinefunction(func):
+            return await func(machine)
+        result = await asyncio.get_running_loop().run_in_executor(self.executor, lambda: func(machine.sync()))
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def _debug_async(self, machine):
+        """Start a debug conversation."""
+        if self.admin_ids and machine.user_id() not in self.admin_ids:
+            logger.info("Rejecting /debug from user '%s' with id '%s'",
+                        machine.user_name(),
+                        machine.user_id())
+            await machine.reply("Error: admin only operation.")
+            return
+        machine.clear()
+        machine.enable_debug(self.debug_data)
+        logger.info("Received /debug from user '%s' with id '%s'",
+                    machine.user_name(),
+                    machine.user_id())
+        logger.info("Setting debug state: %s with data %s", self.debug_state, self.debug_data)
+        await machine.reply("Entering debug mode.")
+        await self._goto_state_async(machine, self.debug_state)
+
+    async def _restart_async(self, machine):
+        """Restart the bot, or reload its transitions in place if configure_reload was called."""
+        if self.admin_ids and machine.user_id() not in self.admin_ids:
+            logger.info("Rejecting /restart from user '%s' with id '%s'",
+                        machine.user_name(),
+                        machine.user_id())
+            await machine.reply("Error: admin only operation.")
+            return
+        logger.info("Received /restart from user '%s' with id '%s'",
+                    machine.user_name(),
+                    machine.user_id())
+        if self.transitions_factory and not self.on_restart:
+            try:
+                await asyncio.get_running_loop().run_in_executor(self.executor, self.reload)
+            except BaseException: # pylint: disable=broad-except
+                logger.exception("Error reloading transitions.")
+                await self._send_error_message_async(machine)
+                return
+            await machine.reply("Reloaded {} states.".format(len(self.transitions)))
+            return
+        await machine.reply("Restarting...")
+        if self.on_restart:
+            # something else owns the process
+            self.on_restart()
+            return
+        # the process is restarted by start_bot once run has finished the updates already received
+        self._restart = True
+        self.stop()
+
+    async def _broadcast_async(self, machine):
+        """Broadcast the rest of the message to every user, or refresh their menus if there's nothing else."""
+        if not self.admin_ids or machine.user_id() not in self.admin_ids:
+            logger.info("Rejecting /broadcast from user '%s' with id '%s'",
+                        machine.user_name(),
+                        machine.user_id())
+            await machine.reply("Error: admin only operation.")
+            return
+        if self._broadcast:
+            await machine.reply("A broadcast is already running.")
+            return
+        parts = (machine.get_message() or "").split(None, 1)
+        text = parts[1] if len(parts) > 1 else None
+        logger.info("Received /broadcast from user '%s' with id '%s'",
+                    machine.user_name(),
+                    machine.user_id())
+        await machine.reply("Broadcasting..." if text else "Refreshing all menus...")
+        self._start_broadcast(text, machine.user_id(), machine.chat_id())
+
+    async def _send_error_message_async(self, machine):
+        """Send a friendly error message for unexpected failures."""
+        if machine.is_debug():
+            await machine.reply("Unexpected error!: {}".format(traceback.format_exc()))
+        else:
+            await machine.reply("Unexpected error! See logs for details.")
+
+    def _broadcast_sources(self):
+        """Get the bot to broadcast with, and the user_data of each user."""
+        if self.bot is None:
+            raise ValueError("Run the bot before broadcasting.")
+        return self.bot, self.user_data
+
+    def _with_session(self, user_data, user_id, func):
+        """Call func with a user's current state and store its changes, returning its result, or False without one.
+
+        This is called from other threads, such as a broadcast's, so it waits for the user's lock on the event loop,
+        and func is run on the executor while it's held.
+        """
+        if self._loop is None or not self._loop.is_running():
+            # nothing else is handling updates
+            return super()._with_session(user_data, user_id, func)
+        coroutine = self._locked(user_id, self._use_session_async(user_data, user_id, func))
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _use_session_async(self, user_data, user_id, func):
+        """Call func with a user's current state on the executor, for a caller holding the user's lock."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(self._use_session, user_data, user_id, func))
+
+    def _shutdown(self):
+        """Finish any background work after polling has stopped."""
+        super()._shutdown()
+        if self.executor:
+            self.executor.shutdown()
+
+# helper
+
+def _unsupported(name):
+    """Get the error for configuring an option AsyncDrillBot doesn't support."""
+    return NotImplementedError("AsyncDrillBot doesn't support {}.".format(name))
+
+def _get_command(update):
+    """Get the lowercase bot command a message starts with, or None."""
+    if not update.message or not update.message.text or not update.message.text.startswith("/"):
+        return None
+    return update.message.text.split(None, 1)[0][1:].split("@")[0].lower()
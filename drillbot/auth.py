@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains helpers for authorizing users."""
+
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+RELOAD_INTERVAL_SECONDS = 5.0
+
+class AccessList():
+    """This class is a set of user ids, optionally loaded from a file.
+
+    File-backed lists are reloaded when the file changes, checked at most every reload_interval seconds.
+    The file has one user id per line, and anything after a '#' is ignored.
+    """
+
+    def __init__(self, ids=None, path=None, reload_interval=RELOAD_INTERVAL_SECONDS):
+        """Initialize the list from a collection of ids, or a file."""
+        self.path = path
+        self.reload_interval = reload_interval
+        self._ids = frozenset(_parse_id(user_id) for user_id in ids or ())
+        self._mtime = None
+        self._checked = 0
+        self._lock = Lock()
+        if self.path:
+            self.reload()
+
+    @staticmethod
+    def create(value):
+        """Create a list from a collection of ids or a file path, or None if there's no value."""
+        if value is None or isinstance(value, AccessList):
+            return value
+        if isinstance(value, str):
+            return AccessList(path=value)
+        return AccessList(value)
+
+    @staticmethod
+    def from_file(path, reload_interval=RELOAD_INTERVAL_SECONDS):
+        """Create a list that's loaded from a file and reloaded when it changes."""
+        return AccessList(path=path, reload_interval=reload_interval)
+
+    def __contains__(self, user_id):
+        """Check if a user id is in the list."""
+        if self.path and time.monotonic() - self._checked > self.reload_interval:
+            self._reload_if_changed()
+        return user_id in self._ids
+
+    def __bool__(self):
+        """Check if the list restricts anything. File-backed lists always do, even when empty."""
+        return bool(self.path or self._ids)
+
+    def __len__(self):
+        """Get the number of ids in the list."""
+        return len(self._ids)
+
+    def __repr__(self):
+        """Get a short representation of the list, without the ids themselves."""
+        if self.path:
+            return "AccessList({} ids from '{}')".format(len(self._ids), self.path)
+        return "AccessList({} ids)".format(len(self._ids))
+
+    def reload(self):
+        """Load the ids from the file."""
+        with open(self.path) as ids_file:
+            mtime = os.fstat(ids_file.fileno()).st_mtime
+            ids = frozenset(_parse_id(line.split("#", 1)[0]) for line in ids_file
+                            if line.split("#", 1)[0].strip())
+        self._ids = ids
+        self._mtime = mtime
+        self._checked = time.monotonic()
+        logger.info("Loaded %s ids from '%s'.", len(ids), self.path)
+
+    def _reload_if_changed(self):
+        """Reload the ids if the file has changed, keeping the old ids if it can't be read."""
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._checked = time.monotonic()
+            if os.stat(self.path).st_mtime != self._mtime:
+                self.reload()
+        except (OSError, ValueError):
+            logger.exception("Error reloading ids from '%s'.", self.path)
+        finally:
+            self._lock.release()
+
+class DenialThrottle():
+    """This class limits how often a blocked user is logged and replied to."""
+
+    def __init__(self, interval=60.0, max_users=10000):
+        """Initialize the throttle to allow one denial per user per interval."""
+        self.interval = interval
+        self.max_users = max_users
+        self._last = OrderedDict()
+        self._lock = Lock()
+
+    def allow(self, user_id):
+        """Check if a denial for this user should be reported now."""
+        now = time.monotonic()
+        with self._lock:
+            last = self._last.get(user_id)
+            if last is not None and now - last < self.interval:
+                return False
+            self._last[user_id] = now
+            self._last.move_to_end(user_id)
+            while len(self._last) > self.max_users:
+                self._last.popitem(last=False)
+            return True
+
+# helper
+
+def _parse_id(user_id):
+    """Normalize a user id to an int."""
+    return int(str(user_id).strip())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains a runner for long-running handlers, so they don't block the dispatcher."""
+
+import copy
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from threading import Lock, Timer
+
+from telegram.utils.promise import Promise
+
+logger = logging.getLogger(__name__)
+
+_NO_LOCK = nullcontext()
+
+class BackgroundRunner():
+    """This class runs handlers on a thread pool, with a timeout.
+
+    Handlers are given a machine with a copy of the conversation, which replaces it only if they finish in time.
+    Once they time out, their Telegram calls fail with HandlerTimeout.
+    """
+
+    def __init__(self, workers=4, timeout=30.0):
+        """Initialize the runner with a number of worker threads and a timeout in seconds."""
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = None
+
+    def submit(self, machine, state, func, on_timeout=None, lock=None): # pylint: disable=too-many-arguments
+        """Run func(machine) in the background, returning a promise for the conversation's next state.
+
+        The promise resolves to state if func doesn't move anywhere, fails, or times out,
+        in which case on_timeout is called with the original machine.
+        lock, if given, is called to get a context manager held while func's changes are applied
+        or it times out, such as the user's lock, so neither happens in the middle of the user's updates.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="BackgroundRunner")
+        job = _Job(machine, state, func, on_timeout, lock)
+        if self.timeout:
+            job.timer = Timer(self.timeout, job.expire)
+            job.timer.daemon = True
+            job.timer.start()
+        self._executor.submit(job.run)
+        return job
+
+    def stop(self):
+        """Stop the worker threads, waiting for running handlers to finish."""
+        if self._executor is not None:
+            self._executor.shutdown()
+
+class HandlerTimeout(TimeoutError):
+    """This exception is raised by a background handler's Telegram calls once it has timed out."""
+
+class _Job(Promise):
+    """An internal promise for a background handler, which can be abandoned when it times out."""
+
+    def __init__(self, machine, state, func, on_timeout, lock=None): # pylint: disable=too-many-arguments
+        """Initialize the job with its own copy of the conversation, not kept anywhere until it's applied."""
+        super().__init__(func, (), {})
+        self.machine = machine
+        self.state = state
+        self.on_timeout = on_timeout
+        self.abandoned = False
+        self.timer = None
+        self._lock = Lock()
+        self._apply_lock = lock
+        data = machine.info.to_bytes()
+        info = machine.info.from_bytes(data)
+        self._original = machine.info.from_bytes(data)
+        # the live state, and how many replies it had when the handler's keyboard was last shown
+        self._seen = (machine.info, machine.info.replies())
+        self._job_machine = copy.copy(machine)
+        self._job_machine.bot = _Gate(machine.bot, self)
+        self._job_machine.info = info
+        self._job_machine.user_data = {"MachineInfo": info}
+        self._job_machine.storage = None
+
+    def run(self):
+        """Run the handler, resolving to its new state unless it was abandoned."""
+        if self.abandoned:
+            return
+        succeeded = False
+        try:
+            result = self.pooled_function(self._job_machine)
+            succeeded = True
+        except Exception: # pylint: disable=broad-except
+            if not self.abandoned:
+                logger.exception("Error in background handler.")
+            result = None
+        with self._hold(), self._lock:
+            if self.timer:
+                self.timer.cancel()
+            if self.abandoned:
+                return
+            if succeeded:
+                # the handler finished in time, so its copy of the conversation replaces the original,
+                # keeping what changed in the original meanwhile, and keyboards it's still sending are stored there too
+                info = self._job_machine.info
+                live = self._live_info()
+                info.merge_changes(self._original, live)
+                seen, replies = self._seen
+                if live is not seen or live.replies() > replies:
+                    # something was sent below the handler's keyboard, such as a reply that it's busy
+                    info.keyboard_stale = True
+                self._job_machine.storage = self.machine.storage
+                self._job_machine.user_data = self.machine.user_data
+                self.machine.restore(info)
+            self._result = self.state if result is None else result
+            self.done.set()
+
+    def expire(self):
+        """Abandon the handler, leaving the conversation as it was, if it hasn't finished yet."""
+        with self._hold():
+            with self._lock:
+                if self.done.is_set():
+                    return
+                self.abandoned = True
+                self._result = self.state
+                self.done.set()
+            logger.warning("Background handler timed out for user %s in state %s.",
+                           self.machine.user_id(), self.state)
+            if self.on_timeout:
+                try:
+                    self.on_timeout(self.machine)
+                except Exception: # pylint: disable=broad-except
+                    logger.exception("Error handling a background handler timeout.")
+
+    def keyboard_shown(self):
+        """Note that the handler showed a keyboard, after any replies the live conversation had so far."""
+        self._seen = (self.machine.info, self.machine.info.replies())
+
+    def _live_info(self):
+        """Get the conversation's current state, which may have been reloaded since the handler started."""
+        if self.machine.storage:
+            return self.machine.storage.load(self.machine.user_id()) or self.machine.info
+        return self.machine.user_data.get("MachineInfo") or self.machine.info
+
+    def _hold(self):
+        """Get a context manager for the lock held while the conversation is changed, if there is one."""
+        return self._apply_lock() if self._apply_lock else _NO_LOCK
+
+class _Gate():
+    """An internal class that wraps an object so its method calls fail once a job is abandoned."""
+
+    def __init__(self, target, job):
+        """Initialize the gate for a target object."""
+        self.target = target
+        self.job = job
+
+    def __getattr__(self, name):
+        """Get an attribute of the target, wrapping methods."""
+        value = getattr(self.target, name)
+        if not callable(value):
+            return value
+        def gated(*args, **kwargs):
+            if self.job.abandoned:
+                raise HandlerTimeout("Background handler timed out, dropping its call to {}.".format(name))
+            if kwargs.get("reply_markup") is not None:
+                self.job.keyboard_shown()
+            return value(*args, **kwargs)
+        return gated
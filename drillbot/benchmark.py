@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains an offline benchmark of the DrillBot dispatch pipeline.
+
+Synthetic updates are run through a DrillBot's real handlers (auth, setup and conversation layers)
+against a FakeBot, and throughput, latency and memory per user are reported.
+Run it with `python -m <package>.drillbot.benchmark --help`.
+"""
+
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+from . import machine as machine_module # pylint: disable=relative-beyond-top-level
+from .drillbot import DrillBot # pylint: disable=relative-beyond-top-level
+from .fake import FakeTelegram # pylint: disable=relative-beyond-top-level
+from .machine import BACK_EMOJI, HOME_EMOJI # pylint: disable=relative-beyond-top-level
+from .metrics import percentile # pylint: disable=relative-beyond-top-level
+from .transition import MenuTransition, SaveTransition, NoTransition # pylint: disable=relative-beyond-top-level
+
+DEEP_LEVELS = 30
+
+def remote_bot():
+    """Create a bot with the same menus as the universal remote example."""
+    transitions = {
+        "menu": MenuTransition(title="Menu", options=OrderedDict([
+            ("Greet", "greet"),
+            ("Music", "music"),
+            ("Lights", "lights"),
+        ])),
+        "greet": SaveTransition("Enter your name", name="name",
+                                reply_action=lambda data: "Hello, {}!".format(data["name"])),
+        "music": MenuTransition(title="Music", options=OrderedDict([
+            ("Volume Down", "music_down"),
+            ("Volume Up", "music_up"),
+        ])),
+        "music_down": NoTransition(lambda data: "Volume has been lowered."),
+        "music_up": NoTransition(lambda data: "Volume has been raised."),
+        "lights": SaveTransition("Enter the name of a room", name="room", next_state="lights_menu",
+                                 options_func=lambda data: ["Bedroom", "Living room"]),
+        "lights_menu": MenuTransition(title_func=lambda data: "Lights for '{}'".format(data["room"]),
+                                      options=OrderedDict([
+                                          ("Lights Off", "lights_off"),
+                                          ("Lights On", "lights_on"),
+                                      ])),
+        "lights_off": NoTransition(lambda data: "Lights off in {}.".format(data["room"])),
+        "lights_on": NoTransition(lambda data: "Lights on in {}.".format(data["room"])),
+    }
+    return DrillBot("0:benchmark", "menu", transitions)
+
+def remote_script():
+    """Get the steps one user takes through the universal remote menus."""
+    return [
+        ("send", "/start"),
+        ("press", "Lights"),
+        ("press", "Bedroom"),
+        ("press", "Lights On"),
+        ("press", BACK_EMOJI),
+        ("press", "Living room"),
+        ("press", "Lights Off"),
+        ("press", HOME_EMOJI),
+        ("press", "Music"),
+        ("press", "Volume Up"),
+        ("press", "Volume Down"),
+        ("press", HOME_EMOJI),
+        ("press", "Greet"),
+        ("send", "Benchmark"),
+        ("press", HOME_EMOJI),
+    ]
+
+def deep_bot():
+    """Create a bot with a long chain of states, each saving a value."""
+    transitions = {}
+    for level in range(DEEP_LEVELS):
+        transitions["level{}".format(level)] = SaveTransition(
+            "Pick a value for level {}".format(level),
+            name="value{}".format(level),
+            next_state="level{}".format(level + 1),
+            options_func=lambda data: ["x", "y", "z"])
+    transitions["level{}".format(DEEP_LEVELS)] = MenuTransition(
+        title_func=lambda data: "Saved {} values".format(len(data)),
+        options=OrderedDict([("Restart", "level0")]))
+    return DrillBot("0:benchmark", "level0", transitions)
+
+def deep_script():
+    """Get the steps one user takes down the chain of states and back up."""
+    return ([("send", "/start")]
+            + [("press", "x")] * DEEP_LEVELS
+            + [("press", BACK_EMOJI)] * DEEP_LEVELS
+            + [("press", HOME_EMOJI)])
+
+SCENARIOS = {
+    "remote": (remote_bot, remote_script, 1, 50),
+    "deep": (deep_bot, deep_script, 1, 20),
+    "crowd": (remote_bot, remote_script, 2000, 1),
+}
+
+def run(scenario, users=None, rounds=None, measure_memory=True):
+    """Run a scenario, returning a dictionary of results.
+
+    Users take their steps interleaved, as if they were all using the bot at once.
+    The delay before replacing a stale keyboard is disabled, since it's a deliberate wait.
+    """
+    create_bot, create_script, default_users, default_rounds = SCENARIOS[scenario]
+    users = users or default_users
+    rounds = rounds or default_rounds
+    delay = machine_module.KEYBOARD_DELAY_SECONDS
+    machine_module.KEYBOARD_DELAY_SECONDS = 0
+    try:
+        latencies, telegram = _run_once(create_bot, create_script, users, rounds)
+        memory = _measure_memory(create_bot, create_script, users) if measure_memory else None
+    finally:
+        machine_module.KEYBOARD_DELAY_SECONDS = delay
+    latencies.sort()
+    total = sum(latencies)
+    return OrderedDict([
+        ("scenario", scenario),
+        ("users", users),
+        ("updates", len(latencies)),
+        ("updates_per_second", len(latencies) / total if total else 0.0),
+        ("p50_ms", percentile(latencies, 0.50) * 1000),
+        ("p99_ms", percentile(latencies, 0.99) * 1000),
+        ("api_calls_per_update", len(telegram.bot.calls) / len(latencies)),
+        ("memory_per_user_bytes", memory),
+    ])
+
+def compare(results, baseline, tolerance):
+    """Compare results to a baseline, returning a list of regressions beyond the tolerance."""
+    regressions = []
+    for result in results:
+        base = baseline.get(result["scenario"])
+        if not base:
+            continue
+        checks = [
+            ("updates_per_second", result["updates_per_second"] < base["updates_per_second"] * (1 - tolerance)),
+            ("p99_ms", result["p99_ms"] > base["p99_ms"] * (1 + tolerance)),
+            ("memory_per_user_bytes", result["memory_per_user_bytes"] and base["memory_per_user_bytes"]
+             and result["memory_per_user_bytes"] > base["memory_per_user_bytes"] * (1 + tolerance)),
+        ]
+        for name, regressed in checks:
+            if regressed:
+                regressions.append("{}: {} is {:.2f}, baseline {:.2f}".format(
+                    result["scenario"], name, result[name], base[name]))
+    return regressions
+
+def main(argv=None):
+    """Run benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description="Benchmark the DrillBot dispatch pipeline offline.")
+    parser.add_argument("scenarios", nargs="*", default=sorted(SCENARIOS),
+                        help="scenarios to run, from: {}".format(", ".join(sorted(SCENARIOS))))
+    parser.add_argument("--users", type=int, help="number of concurrent users")
+    parser.add_argument("--rounds", type=int, help="number of times each user repeats the scenario")
+    parser.add_argument("--no-memory", action="store_true", help="skip measuring memory per user")
+    parser.add_argument("--save", help="save results as a baseline to this file")
+    parser.add_argument("--baseline", help="fail if results regress from the baseline in this file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression, as a fraction")
+    args = parser.parse_args(argv)
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario: {}".format(scenario))
+
+    results = [run(scenario, args.users, args.rounds, not args.no_memory) for scenario in args.scenarios]
+    for result in results:
+        print("{scenario}: {updates} updates from {users} users, {updates_per_second:.0f} updates/sec, "
+              "p50 {p50_ms:.3f} ms, p99 {p99_ms:.3f} ms, {api_calls_per_update:.2f} API calls/update, "
+              "{memory} bytes/user".format(memory=result["memory_per_user_bytes"], **result))
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump({result["scenario"]: result for result in results}, baseline_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print("Regression: {}".format(regression))
+        if regressions:
+            return 1
+    return 0
+
+# helper
+
+def _run_once(create_bot, create_script, users, rounds):
+    """Run the users' steps through a fresh bot, returning each update's latency and the fake."""
+    telegram = FakeTelegram(create_bot())
+    script = create_script()
+    latencies = []
+    for _ in range(rounds):
+        for kind, value in script:
+            for user_id in range(1, users + 1):
+                update = _create_update(telegram, kind, user_id, value)
+                start = time.perf_counter()
+                telegram.dispatcher.process_update(update)
+                latencies.append(time.perf_counter() - start)
+    return latencies, telegram
+
+def _measure_memory(create_bot, create_script, users):
+    """Measure the memory retained per user after each user runs through the steps once."""
+    telegram = FakeTelegram(create_bot())
+    script = create_script()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for kind, value in script:
+            for user_id in range(1, users + 1):
+                update = _create_update(telegram, kind, user_id, value)
+                telegram.dispatcher.process_update(update)
+        # the fake's record of calls isn't part of the bot's state
+        telegram.bot.calls.clear()
+        del update
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (after - before) // users
+
+def _create_update(telegram, kind, user_id, value):
+    """Create an update for a step."""
+    if kind == "send":
+        return telegram.create_update(telegram.message(user_id, value))
+    return telegram.create_update(telegram.callback(user_id, value))
+
+if __name__ == "__main__":
+    sys.exit(main())
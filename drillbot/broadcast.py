@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains a runner for sending to many chats at once, such as a bot's whole user base."""
+
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Lock
+
+import telegram
+
+from .ratelimit import TokenBucket, MAX_RETRIES # pylint: disable=relative-beyond-top-level
+
+logger = logging.getLogger(__name__)
+
+PENDING_PER_WORKER = 4
+
+class Broadcast():
+    """This class calls a function for each of many sessions on a thread pool, within a global flood limit.
+
+    The function is called as func(bot, key, info) with a bot whose calls are paced to rate calls
+    per second, and wait out any flood limit Telegram reports. It returns whether anything was sent.
+
+    If a checkpoint file is given, finished sessions are recorded there, so running the same
+    broadcast again after an interruption picks up where it stopped. The file is removed
+    once the broadcast completes, and ignored if it was written for a different job.
+    """
+
+    def __init__(self, bot, func, job, workers=8, rate=25.0, checkpoint=None): # pylint: disable=too-many-arguments
+        """Initialize the broadcast, where job identifies it in the checkpoint."""
+        self.bot = _PacedBot(bot, rate)
+        self.func = func
+        self.job = job
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.stats = OrderedDict([("total", 0), ("done", 0), ("sent", 0), ("failed", 0), ("resumed", 0)])
+        self._cancelled = False
+        self._lock = Lock()
+        self._checkpoint_file = None
+
+    def run(self, sessions, progress=None, progress_interval=10.0):
+        """Run the broadcast for (key, info) pairs, returning its stats when it finishes or is cancelled.
+
+        Sessions are read as they're needed, with at most PENDING_PER_WORKER per worker waiting to be sent to,
+        so a large storage isn't loaded all at once. total counts the sessions read so far.
+        progress, if given, is called with the stats every progress_interval seconds and at the end.
+        """
+        finished = self._open_checkpoint()
+        # storages may list a session twice if it changes while they're being read
+        seen = set()
+        futures = set()
+        last_progress = time.monotonic()
+        logger.info("Broadcasting %s, %s sessions already done.", self.job, len(finished))
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="Broadcast") as executor:
+                for key, info in sessions:
+                    if self._cancelled:
+                        break
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    with self._lock:
+                        self.stats["total"] += 1
+                        if _checkpoint_key(key) in finished:
+                            self.stats["resumed"] += 1
+                            self.stats["done"] += 1
+                            continue
+                    futures.add(executor.submit(self._run_one, key, info))
+                    while len(futures) >= self.workers * PENDING_PER_WORKER:
+                        _, futures = wait(futures, timeout=progress_interval, return_when=FIRST_COMPLETED)
+                        last_progress = self._report_progress(progress, progress_interval, last_progress)
+                while futures:
+                    _, futures = wait(futures, timeout=progress_interval, return_when=FIRST_COMPLETED)
+                    if futures:
+                        last_progress = self._report_progress(progress, progress_interval, last_progress)
+        finally:
+            self._close_checkpoint()
+        if progress:
+            progress(dict(self.stats))
+        logger.info("Broadcast %s: %s", "cancelled" if self._cancelled else "finished", dict(self.stats))
+        return dict(self.stats)
+
+    def cancel(self):
+        """Stop the broadcast, leaving sessions that haven't been reached for a resumed run."""
+        self._cancelled = True
+
+    def _run_one(self, key, info):
+        """Run the function for one session, and record it as finished."""
+        if self._cancelled:
+            return
+        try:
+            sent = self.func(self.bot, key, info)
+        except telegram.error.Unauthorized:
+            # the user blocked the bot
+            logger.debug("Broadcast to %s not allowed.", key)
+            sent = None
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Error broadcasting to %s.", key)
+            sent = None
+        with self._lock:
+            self.stats["done"] += 1
+            if sent:
+                self.stats["sent"] += 1
+            elif sent is None:
+                self.stats["failed"] += 1
+            if self._checkpoint_file:
+                self._checkpoint_file.write("{}\n".format(_checkpoint_key(key)))
+
+    def _report_progress(self, progress, progress_interval, last_progress):
+        """Call progress with the stats if progress_interval seconds have passed, returning when it was last called."""
+        now = time.monotonic()
+        if not progress or now - last_progress < progress_interval:
+            return last_progress
+        progress(dict(self.stats))
+        return now
+
+    def _open_checkpoint(self):
+        """Open the checkpoint for appending, returning the keys it says are finished."""
+        if not self.checkpoint:
+            return set()
+        finished = set()
+        if os.path.exists(self.checkpoint):
+            with open(self.checkpoint, encoding="utf-8") as checkpoint:
+                lines = checkpoint.read().splitlines()
+            if lines and lines[0] == self.job:
+                finished = set(lines[1:])
+            else:
+                logger.info("Ignoring checkpoint %s from a different broadcast.", self.checkpoint)
+        self._checkpoint_file = open(self.checkpoint, "a" if finished else "w", encoding="utf-8", buffering=1)
+        if not finished:
+            self._checkpoint_file.write("{}\n".format(self.job))
+        return finished
+
+    def _close_checkpoint(self):
+        """Close the checkpoint, removing it if the broadcast is complete."""
+        if not self._checkpoint_file:
+            return
+        self._checkpoint_file.close()
+        self._checkpoint_file = None
+        if not self._cancelled and self.stats["done"] == self.stats["total"]:
+            os.remove(self.checkpoint)
+
+class _PacedBot():
+    """An internal class that wraps a bot so its calls are paced and retried after flood limits."""
+
+    def __init__(self, bot, rate):
+        """Initialize the wrapper with a rate in calls per second, shared by all threads."""
+        self.bot = bot
+        self._bucket = TokenBucket(rate, 1)
+        self._lock = Lock()
+        self._paused_until = 0.0
+
+    def __getattr__(self, name):
+        """Get an attribute of the bot, pacing methods."""
+        value = getattr(self.bot, name)
+        if not callable(value):
+            return value
+        def paced(*args, **kwargs):
+            for attempt in range(MAX_RETRIES + 1):
+                self._wait()
+                try:
+                    return value(*args, **kwargs)
+                except telegram.error.RetryAfter as ex:
+                    if attempt == MAX_RETRIES:
+                        raise
+                    logger.warning("Flood limit reached during broadcast, pausing for %s seconds.", ex.retry_after)
+                    with self._lock:
+                        self._paused_until = max(self._paused_until, time.monotonic() + ex.retry_after)
+        return paced
+
+    def _wait(self):
+        """Wait for a turn to make a call."""
+        with self._lock:
+            now = time.monotonic()
+            ready = max(self._bucket.reserve(max(now, self._paused_until)), now)
+        delay = ready - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+# helper
+
+def _checkpoint_key(key):
+    """Get the form a session's key is recorded in a checkpoint."""
+    return json.dumps(key, default=str)
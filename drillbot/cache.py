@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains a cache for transition callbacks, like options_func and title_func."""
+
+import functools
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import Iterator
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+GLOBAL = "global"
+PER_USER = "per_user"
+
+class CachedCallback():
+    """This class wraps a callback that takes the conversation data, caching its results.
+
+    Results expire after ttl seconds, and the least recently used are evicted past maxsize.
+    The key decides which calls share a result: GLOBAL for all of them, PER_USER for each user,
+    a tuple of data field names for each combination of their values, or a function of the data.
+
+    Results that are iterators, like generators, can only be read once, so they're read into a tuple
+    before they're cached. A cached options_func is read in full once, and pages are shown from the tuple.
+    """
+
+    def __init__(self, func, ttl=60.0, key=GLOBAL, maxsize=1024):
+        """Initialize the cache for a callback."""
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.key_func = _create_key_func(key)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __call__(self, data):
+        """Get the callback's result, from the cache if it hasn't expired."""
+        key = self.key_func(data)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = self.func(data)
+        if isinstance(value, Iterator):
+            value = tuple(value)
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, data=None):
+        """Drop the cached result for some conversation data, or all results if there's no data."""
+        with self._lock:
+            if data is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(self.key_func(data), None)
+
+    def clear(self):
+        """Drop all cached results."""
+        self.invalidate()
+
+def cached(func=None, ttl=60.0, key=GLOBAL, maxsize=1024):
+    """Cache a callback's results, either called directly or used as a decorator.
+
+    See CachedCallback for the options.
+    """
+    if func is None:
+        return lambda func: CachedCallback(func, ttl, key, maxsize)
+    return CachedCallback(func, ttl, key, maxsize)
+
+# helper
+
+def _create_key_func(key):
+    """Create a function that gets the cache key from conversation data."""
+    if callable(key):
+        return key
+    if key == GLOBAL:
+        return lambda data: None
+    if key == PER_USER:
+        return lambda data: data["user_id"]
+    if isinstance(key, str):
+        key = (key,)
+    fields = tuple(key)
+    return lambda data: tuple(data.get(field) for field in fields)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains a catalog of transitions that are built from declarative specs as they're needed."""
+
+import json
+import logging
+from collections import OrderedDict
+from collections.abc import Mapping
+from threading import Lock
+
+from .machine import END, BACK, HOME # pylint: disable=relative-beyond-top-level
+from .transition import Transition, MenuTransition, NoTransition, SaveTransition # pylint: disable=relative-beyond-top-level
+
+logger = logging.getLogger(__name__)
+
+SPECIAL_TARGETS = {"@end": END, "@back": BACK, "@home": HOME}
+
+class TransitionCatalog(Mapping):
+    """This class maps states to transitions like a dictionary, building each one from its spec when first used.
+
+    A spec is a dictionary with a type, and the arguments for that type of transition:
+
+        {"type": "menu", "title": "Rooms", "options": [["Bedroom", "bedroom"], ["Kitchen", "kitchen"]]}
+        {"type": "save", "message": "Pick a level", "name": "level", "next_state": "done",
+         "options": ["low", "high"], "reply": "Saved {level}.", "page_size": 10}
+        {"type": "reply", "reply": "Lights on in {room}."}
+
+    Titles and replies can refer to saved data, like {room}. Targets can be other states,
+    or "@back", "@home" or "@end". A spec can also be a Transition, to mix in custom ones.
+
+    Specs are given as a dictionary, or made on demand by a factory given the names of all states.
+    Only the maxsize most recently used transitions are kept, and the bot reads each state's spec
+    the first time a user reaches it, so startup doesn't read any of them. A state's missing targets
+    are logged then; set validate to check every spec for them at startup instead.
+    """
+
+    def __init__(self, specs=None, factory=None, states=None, maxsize=1024, validate=False): # pylint: disable=too-many-arguments
+        """Initialize the catalog with a dictionary of specs, or a factory and the states it makes specs for."""
+        if (specs is None) == (factory is None):
+            raise ValueError("A catalog needs either specs or a factory.")
+        if factory and states is None:
+            raise ValueError("A catalog with a factory needs the names of all states.")
+        self.specs = specs
+        self.factory = factory
+        self.states = list(specs) if specs is not None else list(states)
+        self.maxsize = maxsize
+        self.validate = validate
+        self.built = 0
+        self._known = specs if specs is not None else frozenset(self.states)
+        self._transitions = OrderedDict()
+        self._lock = Lock()
+
+    @classmethod
+    def from_json(cls, path, maxsize=1024, validate=False):
+        """Load a catalog from a JSON file, holding either the specs or an object with them under "states"."""
+        with open(path, encoding="utf-8") as catalog_file:
+            return cls(_get_specs(json.load(catalog_file)), maxsize=maxsize, validate=validate)
+
+    @classmethod
+    def from_yaml(cls, path, maxsize=1024, validate=False):
+        """Load a catalog from a YAML file, laid out like a JSON one. Requires PyYAML."""
+        try:
+            import yaml # pylint: disable=import-outside-toplevel
+        except ImportError as ex:
+            raise ImportError("Loading a catalog from YAML requires PyYAML.") from ex
+        with open(path, encoding="utf-8") as catalog_file:
+            return cls(_get_specs(yaml.safe_load(catalog_file)), maxsize=maxsize, validate=validate)
+
+    def __getitem__(self, state):
+        """Get the transition for a state, building it if it isn't one of the recently used."""
+        with self._lock:
+            transition = self._transitions.get(state)
+            if transition is not None:
+                self._transitions.move_to_end(state)
+                return transition
+        transition = _build(self.get_spec(state))
+        if not self.validate:
+            self._check_targets(state, transition)
+        with self._lock:
+            # another thread may have built it in the meantime
+            transition = self._transitions.setdefault(state, transition)
+            self._transitions.move_to_end(state)
+            self.built += 1
+            while len(self._transitions) > self.maxsize:
+                self._transitions.popitem(last=False)
+        return transition
+
+    def __iter__(self):
+        """Iterate over the names of all states."""
+        return iter(self.states)
+
+    def __len__(self):
+        """Get the number of states."""
+        return len(self.states)
+
+    def __contains__(self, state):
+        """Check if there's a state, without building its transition."""
+        try:
+            return state in self._known
+        except TypeError:
+            return False
+
+    def get_spec(self, state):
+        """Get the spec for a state."""
+        if state not in self:
+            raise KeyError(state)
+        if self.specs is not None:
+            return self.specs[state]
+        return self.factory(state)
+
+    def get_targets(self, state):
+        """Get the states a state's transition can move to, from its spec."""
+        spec = self.get_spec(state)
+        if isinstance(spec, Transition):
+            return spec.get_targets()
+        if spec["type"] == "menu":
+            return tuple(_get_options(spec).values())
+        if spec["type"] == "save":
+            return (_get_target(spec.get("next_state", "@back")),)
+        return ()
+
+    def _check_targets(self, state, transition):
+        """Log any states a newly built transition can move to that are missing."""
+        missing = [target for target in transition.get_targets()
+                   if target not in (None, END, BACK, HOME) and target not in self]
+        if missing:
+            logger.error("Transitions refer to missing states: %s",
+                         ", ".join("{} -> {}".format(state, target) for target in missing))
+
+# helper
+
+def _get_specs(data):
+    """Get the specs from a loaded catalog file."""
+    if isinstance(data, dict) and isinstance(data.get("states"), dict):
+        return data["states"]
+    return data
+
+def _get_target(target):
+    """Get the state a spec's target refers to."""
+    return SPECIAL_TARGETS.get(target, target)
+
+def _get_options(spec):
+    """Get a menu spec's options, as labels mapped to target states."""
+    options = spec["options"]
+    if isinstance(options, dict):
+        options = options.items()
+    return OrderedDict((label, _get_target(target)) for label, target in options)
+
+def _template(text):
+    """Create a callback that fills in a text with saved data."""
+    if "{" not in text:
+        return lambda data: text
+    return lambda data: text.format_map(data)
+
+def _build(spec):
+    """Build the transition for a spec."""
+    if isinstance(spec, Transition):
+        return spec
+    kind = spec.get("type")
+    if kind == "menu":
+        title = spec.get("title")
+        return MenuTransition(_get_options(spec), title=title,
+                              title_func=_template(title) if title else None)
+    if kind == "save":
+        options = spec.get("options")
+        return SaveTransition(spec["message"], spec["name"],
+                              next_state=_get_target(spec.get("next_state", "@back")),
+                              options_func=(lambda data: list(options)) if options else None,
+                              reply_action=_template(spec["reply"]) if spec.get("reply") else None,
+                              page_size=spec.get("page_size"))
+    if kind == "reply":
+        return NoTransition(_template(spec["reply"]))
+    raise ValueError("Unknown transition type in spec: {}".format(kind))
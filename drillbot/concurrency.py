@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tools for handling updates concurrently, but one at a time for each user."""
+
+import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Condition, Lock, RLock
+
+logger = logging.getLogger(__name__)
+
+class SerialExecutor():
+    """This class runs jobs on a thread pool, one at a time and in order for each key.
+
+    Each key with pending jobs takes turns on the pool with the others,
+    so a key with a long backlog doesn't hold up the rest.
+    """
+
+    def __init__(self, workers=8):
+        """Initialize the executor with a number of worker threads."""
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="SerialExecutor")
+        self._queues = {}
+        self._condition = Condition()
+
+    def submit(self, key, func, *args):
+        """Schedule func(*args) to run after any earlier jobs for the same key, returning a future for its result."""
+        future = Future()
+        with self._condition:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((func, args, future))
+                return future
+            self._queues[key] = deque([(func, args, future)])
+        self._executor.submit(self._run_next, key)
+        return future
+
+    def attach(self, dispatcher):
+        """Make a dispatcher hand its updates to this executor, keyed by user, instead of processing them itself.
+
+        Conversation state belongs to users, so each user's updates are handled in order,
+        while different users' are handled concurrently.
+        """
+        process_update = dispatcher.process_update
+        dispatcher.process_update = lambda update: self.submit(_update_key(update), process_update, update)
+
+    def pending(self):
+        """Get the number of keys with jobs waiting or running."""
+        with self._condition:
+            return len(self._queues)
+
+    def shutdown(self):
+        """Wait for all scheduled jobs to finish, and stop the worker threads."""
+        with self._condition:
+            # each key's next job is only scheduled once its last one finishes, so wait for them all
+            while self._queues:
+                self._condition.wait()
+        self._executor.shutdown(wait=True)
+
+    def _run_next(self, key):
+        """Run the next job for a key, then give other keys a turn before its next one."""
+        with self._condition:
+            func, args, future = self._queues[key][0]
+        try:
+            future.set_result(func(*args))
+        except Exception as ex: # pylint: disable=broad-except
+            logger.exception("Error running job for %s.", key)
+            future.set_exception(ex)
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        finally:
+            # even if the job didn't return, the key's later jobs still run
+            self._finish(key)
+
+    def _finish(self, key):
+        """Remove a key's finished job, and schedule its next one if there is one."""
+        with self._condition:
+            queue = self._queues[key]
+            queue.popleft()
+            if not queue:
+                del self._queues[key]
+                if not self._queues:
+                    self._condition.notify_all()
+                return
+        self._executor.submit(self._run_next, key)
+
+class KeyedLock():
+    """This class is a lock per key, such as per user, each kept only while it's held or waited for."""
+
+    def __init__(self):
+        """Initialize the locks, with none held."""
+        self._locks = {}
+        self._lock = Lock()
+
+    @contextmanager
+    def hold(self, key):
+        """Hold the lock for a key, waiting for any other thread holding it. A thread can hold it more than once."""
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [RLock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    def attach(self, dispatcher):
+        """Make a dispatcher hold the lock for each update's user while it processes the update.
+
+        Attach this before a SerialExecutor, so the lock is held on the executor's threads.
+        """
+        process_update = dispatcher.process_update
+        def locked(update):
+            with self.hold(_update_key(update)):
+                process_update(update)
+        dispatcher.process_update = locked
+
+# helper
+
+def _update_key(update):
+    """Get the key that orders an update: its user, or its chat if it has no user."""
+    user = getattr(update, "effective_user", None)
+    if user:
+        return user.id
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat else None
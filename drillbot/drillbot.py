@@ -6,19 +6,44 @@ import logging
 import os
 import traceback
 import sys
-from threading import Thread
+import time
+import zlib
+from functools import partial
+from threading import Event, Thread
+from urllib.parse import urlparse
 
-from telegram.ext import Updater, DispatcherHandlerStop, ConversationHandler
+import telegram
+from telegram.ext import Updater, DispatcherHandlerStop, TypeHandler
 
-from .machine import Machine, MachineHandlers, BACK, HOME, BACK_EMOJI, HOME_EMOJI # pylint: disable=relative-beyond-top-level
+from .machine import Machine, MachineHandlers, END, BACK, HOME, BACK_EMOJI, HOME_EMOJI # pylint: disable=relative-beyond-top-level
+from .machine import button_label, set_options_cache_size # pylint: disable=relative-beyond-top-level
+from .auth import AccessList, DenialThrottle # pylint: disable=relative-beyond-top-level
+from .background import BackgroundRunner, HandlerTimeout # pylint: disable=relative-beyond-top-level
+from .broadcast import Broadcast # pylint: disable=relative-beyond-top-level
+from .concurrency import KeyedLock, SerialExecutor # pylint: disable=relative-beyond-top-level
+from .graph import StateGraph, GraphConversationHandler # pylint: disable=relative-beyond-top-level
+from .metrics import InstrumentedBot, PrometheusMetrics # pylint: disable=relative-beyond-top-level
+from .ratelimit import OutboundQueue, ThrottledBot # pylint: disable=relative-beyond-top-level
+from .recorder import UpdateRecorder # pylint: disable=relative-beyond-top-level
+from .sender import KeyboardSender # pylint: disable=relative-beyond-top-level
+from .storage import SessionStorage # pylint: disable=relative-beyond-top-level
+from .transition import Transition # pylint: disable=relative-beyond-top-level
+from .webhook import WebhookApp, check_secret_token # pylint: disable=relative-beyond-top-level
 
 logger = logging.getLogger(__name__)
 
+STALE_KEYBOARD_MESSAGE = "That menu has changed, please choose again."
+
+DENIED_MESSAGE = "You don't have access to this bot. To get access, ask the owner to whitelist your user id: {}"
+
 class DrillBot():
     """This class is for creating a drilldown menu bot."""
 
     def __init__(self, token, home_state, transitions):
-        """Initialize this bot with a set of state transitions."""
+        """Initialize this bot with a set of state transitions.
+
+        transitions maps states to transitions, and can be a TransitionCatalog to build them as they're used.
+        """
         self.token = token
         self.home_state = home_state
         self.transitions = transitions
@@ -28,31 +53,299 @@ class DrillBot():
         self.debug_data = {}
         self.updater = None
         self.notify_auth_failure = False
+        self.keyboard_sender = None
+        self.storage = None
+        self.webhook = None
+        self.outbound = None
+        self.denials = DenialThrottle()
+        self.metrics = None
+        self.on_restart = None
+        self.background = None
+        self.background_messages = None
+        self.update_executor = None
+        self.session_locks = KeyedLock()
+        self.recorder = None
+        self.broadcast_options = {}
+        self._broadcast = None
+        self.transitions_factory = None
+        self.graph = None
+        self._dispatcher = None
+        self._conversation = None
+        self._wrapped_bot = None
 
     def start_bot(self):
         """Start the bot."""
         self.updater = Updater(self.token)
+        self.register_handlers(self.updater.dispatcher)
+
+        # start bot
+        if self.keyboard_sender:
+            self.keyboard_sender.start()
+        if self.webhook:
+            # served by a WebhookApp, so the secret token is checked
+            app = self._start_webhook_app()
+            server = app.serve(self.webhook["listen"], self.webhook["port"], self.webhook["cert"], self.webhook["key"])
+            self.updater.idle()
+            server.shutdown()
+        else:
+            self.updater.start_polling()
+            self.updater.idle()
+        self._shutdown()
+
+    def create_webhook_app(self):
+        """Start the bot without a listener, and return a WSGI app to mount instead.
+
+        Requires configure_webhook, and Telegram is told to post to its url.
+        Call the app's close method when the server shuts down, to stop the bot and finish its background work.
+        """
+        if not self.webhook:
+            raise ValueError("Call configure_webhook before creating a webhook app.")
+        self.updater = Updater(self.token)
+        self.register_handlers(self.updater.dispatcher)
+        if self.keyboard_sender:
+            self.keyboard_sender.start()
+        app = self._start_webhook_app()
+        app.on_close = self._close_webhook_app
+        return app
 
-        # register handlers
-        dispatcher = self.updater.dispatcher
-        # auth: -1
-        dispatcher.add_handler(MachineHandlers.message_handler(self._auth_layer), -1)
+    def register_handlers(self, dispatcher):
+        """Register this bot's handlers with a dispatcher."""
+        # record: -2, so every update is seen before auth can stop it
+        if self.recorder:
+            dispatcher.add_handler(TypeHandler(telegram.Update, self.recorder.record), -2)
+        # auth: -1, without user_data so blocked users don't allocate any
+        dispatcher.add_handler(MachineHandlers.message_handler(self._auth_layer, pass_user_data=False), -1)
+        dispatcher.add_handler(MachineHandlers.callback_handler(self._auth_layer, pass_user_data=False), -1)
         # setup: 0
         dispatcher.add_handler(MachineHandlers.message_handler(self._setup_layer), 0)
         dispatcher.add_handler(MachineHandlers.callback_handler(self._setup_layer), 0)
         # main: 1
         dispatcher.add_handler(MachineHandlers.command_handler("restart", self._restart), 1)
-        dispatcher.add_handler(self._create_conversation(), 1)
+        dispatcher.add_handler(MachineHandlers.command_handler("broadcast", self._broadcast_command), 1)
+        self._dispatcher = dispatcher
+        self.graph = self._compile_graph(self.transitions)
+        self._conversation = self._create_conversation()
+        dispatcher.add_handler(self._conversation, 1)
+        self._track_sessions(dispatcher.user_data)
+        # the machine the handler layers share is only needed while they handle the update
+        process_update = dispatcher.process_update
+        def process_and_forget(update):
+            try:
+                process_update(update)
+            finally:
+                Machine.forget_update()
+        dispatcher.process_update = process_and_forget
+        # each user's state is only changed while holding their lock, by their updates or broadcasts
+        self.session_locks.attach(dispatcher)
+        if self.update_executor:
+            self.update_executor.attach(dispatcher)
 
-        # start bot
-        self.updater.start_polling()
-        self.updater.idle()
+    def reload(self):
+        """Rebuild the transitions and the conversation handler in place, keeping all conversations.
+
+        Requires configure_reload. Updates keep being handled throughout, and if the factory fails
+        the current transitions stay in place.
+        """
+        if not self.transitions_factory:
+            raise ValueError("Call configure_reload before reloading.")
+        transitions = self.transitions_factory()
+        graph = self._compile_graph(transitions)
+        removed = [state for state in self.transitions if state not in transitions]
+        if removed:
+            logger.warning("States removed by reload, users in them will need to /start again: %s", removed)
+        self.transitions = transitions
+        self.graph = graph
+        if self._conversation is not None:
+            conversation = self._create_conversation()
+            # share the same conversations, so updates handled during the swap aren't lost
+            conversation.conversations = self._conversation.conversations
+            handlers = self._dispatcher.handlers[1]
+            handlers[handlers.index(self._conversation)] = conversation
+            self._conversation = conversation
+        logger.info("Reloaded %s states.", len(transitions))
+
+    def broadcast(self, text=None, progress=None, job=None):
+        """Send a message to every user with conversation state, or without text, refresh their current menus.
+
+        Refreshing shows each user's current menu again, editing their keyboard in place where it can,
+        such as after the options a menu offers have changed. Sessions are sent to concurrently and
+        paced as set by configure_broadcast, which can also make an interrupted broadcast resumable.
+        progress, if given, is called with the stats as it goes. Returns the final stats.
 
-    def configure_auth(self, allowed_ids, notify=False, admin_ids=None):
-        """Optionally configure authentication by specifying allowed user ids."""
-        self.allowed_ids = allowed_ids
+        job identifies the broadcast in the checkpoint. By default, sending the same text again resumes
+        an interrupted broadcast of it, and refreshing again resumes an interrupted refresh.
+        Pass a new job to start over instead, such as if menus have changed again since.
+        """
+        bot, user_data = self._broadcast_sources()
+        if text:
+            func = partial(self._broadcast_message, user_data, text)
+            job = job or "message {:08x}".format(zlib.crc32(text.encode("utf-8")))
+        else:
+            func = partial(self._broadcast_refresh, user_data)
+            job = job or "refresh"
+        self._broadcast = Broadcast(bot, func, job, **self.broadcast_options)
+        try:
+            return self._broadcast.run(self._sessions(user_data), progress)
+        finally:
+            self._broadcast = None
+
+    def configure_auth(self, allowed_ids, notify=False, admin_ids=None, denial_interval=60.0):
+        """Optionally configure authentication by specifying allowed user ids.
+
+        The ids can be given as a collection, an AccessList, or the path of a file
+        to load them from, which is reloaded when it changes.
+        Each blocked user is logged and notified at most once per denial_interval seconds.
+        """
+        self.allowed_ids = AccessList.create(allowed_ids)
         self.notify_auth_failure = notify
-        self.admin_ids = admin_ids
+        self.admin_ids = AccessList.create(admin_ids)
+        self.denials = DenialThrottle(denial_interval)
+
+    def configure_webhook(self, url, listen="0.0.0.0", port=8443, url_path=None, cert=None, key=None, # pylint: disable=too-many-arguments
+                          secret_token=None):
+        """Optionally receive updates via webhook instead of polling.
+
+        Telegram will post updates to url, which must reach this bot's listener
+        (or the app from create_webhook_app) at url_path, by default the url's path.
+        cert is a self-signed certificate to give Telegram, with its key to serve HTTPS with.
+
+        Set a secret_token (1-256 letters, digits, _ and -) so only Telegram can post updates:
+        it's sent with each one, and requests without it are rejected. Without one, anyone
+        who can reach the listener at url_path can post updates as any user, including admins,
+        so keep the path hard to guess.
+        """
+        check_secret_token(secret_token)
+        if url_path is None:
+            url_path = urlparse(url).path
+        self.webhook = {
+            "url": url,
+            "listen": listen,
+            "port": port,
+            "url_path": url_path,
+            "cert": cert,
+            "key": key,
+            "secret_token": secret_token,
+        }
+
+    def configure_keyboard_cache(self, size):
+        """Optionally change how many keyboards' options are cached to decode button presses, by default 4096.
+
+        The cache is shared by all users, and by all bots in the process. Presses on a keyboard whose options
+        were dropped from it rebuild them from its transition, calling options_func again,
+        so make it at least the number of different keyboards in use at once.
+        """
+        set_options_cache_size(size)
+
+    def configure_deferred_keyboards(self, workers=4):
+        """Optionally send replies and keyboards from background threads.
+
+        Stale keyboards are replaced after KEYBOARD_DELAY_SECONDS, so users see the replies before them,
+        without holding up the handlers (otherwise they're replaced right away). Messages for each chat
+        are still sent in order, and changes to a user's state in the background hold the user's lock.
+        """
+        self.keyboard_sender = KeyboardSender(workers)
+
+    def configure_rate_limit(self, per_chat_rate=1.0, group_rate=20 / 60, global_rate=30.0):
+        """Optionally queue outgoing Telegram calls to stay within flood limits.
+
+        Rates are in calls per second. Queue metrics are available from outbound.stats().
+        """
+        self.outbound = OutboundQueue(per_chat_rate=per_chat_rate,
+                                      group_rate=group_rate,
+                                      global_rate=global_rate)
+
+    def configure_metrics(self, metrics=None):
+        """Optionally record latency and error metrics, by default into a PrometheusMetrics.
+
+        Use metrics.export() or metrics.serve(port) to get the Prometheus text format.
+        """
+        if metrics is None:
+            metrics = PrometheusMetrics()
+        self.metrics = metrics
+
+    def configure_long_running(self, workers=4, timeout=30.0, working_message="Working on it...", # pylint: disable=too-many-arguments
+                               busy_message="Still working on your last request, please wait.",
+                               timeout_message="Sorry, that took too long. Please try again."):
+        """Optionally handle long-running transitions on a thread pool, so they don't block other users.
+
+        Transitions are long-running if they set long_running, or use callbacks marked with @long_running.
+        Moving into or out of one replies with working_message right away, and the result follows
+        when it finishes. Until then the user's other input is answered with busy_message.
+        If it takes longer than timeout seconds, its output is dropped, the conversation is
+        rolled back, and the user is sent timeout_message.
+        """
+        self.background = BackgroundRunner(workers, timeout)
+        self.background_messages = {
+            "working": working_message,
+            "busy": busy_message,
+            "timeout": timeout_message,
+        }
+
+    def configure_concurrency(self, workers=8):
+        """Optionally handle updates from different users concurrently, on a pool of worker threads.
+
+        Each user's updates are still handled one at a time and in the order they arrived,
+        so their conversation state is never changed by two updates at once,
+        but a user waiting on a slow transition no longer holds up everyone else.
+        """
+        self.update_executor = SerialExecutor(workers)
+
+    def configure_recording(self, path, salt=None, keep_text=False):
+        """Optionally record incoming updates to a file, to replay offline with replay.py.
+
+        Updates are anonymized as described in UpdateRecorder, and appended to the file,
+        gzipped if its name ends with .gz. Button presses are recorded by their labels.
+        """
+        self.recorder = UpdateRecorder(path, salt, keep_text, labels=self._button_label)
+
+    def configure_broadcast(self, workers=8, rate=25.0, checkpoint=None):
+        """Optionally change how broadcasts are sent, including from the /broadcast admin command.
+
+        Broadcasts make up to rate API calls per second on workers threads. Telegram allows about 30
+        per second in total, so leave room for regular traffic. With configure_rate_limit, broadcasts
+        also go through its queue, so together with regular traffic they stay within its global rate.
+        If a checkpoint path is given, an interrupted broadcast resumes where it stopped when it's sent again.
+        """
+        self.broadcast_options = {"workers": workers, "rate": rate, "checkpoint": checkpoint}
+
+    def configure_sessions(self, idle_timeout=3600.0, max_sessions=10000, spill=None):
+        """Optionally bound the memory used for conversation state.
+
+        Sessions idle for idle_timeout seconds, or the least recently used past max_sessions,
+        are evicted along with the user's user_data and conversations. If a spill storage is given
+        (such as a SqliteStorage with a small cache_size) evicted sessions are saved there and resumed
+        later, otherwise those users start over.
+        If configure_storage was called, that storage is used as the spill storage.
+        """
+        configured = self.storage.spill if isinstance(self.storage, SessionStorage) else self.storage
+        if spill is None:
+            spill = configured
+        elif configured is not None and configured is not spill:
+            raise ValueError("Sessions can't spill to a storage other than the configured one.")
+        self.storage = SessionStorage(idle_timeout, max_sessions, spill)
+
+    def configure_reload(self, transitions_factory):
+        """Optionally make /restart reload the transitions in place instead of restarting the process.
+
+        transitions_factory is called with no arguments to get the new transitions dictionary.
+        It can use importlib.reload first to pick up code changes.
+        Conversation state and in-flight updates are kept, so reloads don't drop any traffic.
+        """
+        self.transitions_factory = transitions_factory
+
+    def configure_storage(self, storage):
+        """Optionally keep conversation state in a storage, such as a SqliteStorage.
+
+        By default state is kept in memory, and lost when the bot restarts.
+        With a persistent storage, users pick up where they left off after a restart.
+        If configure_sessions was called, sessions evicted from memory are spilled to this storage.
+        """
+        if isinstance(self.storage, SessionStorage):
+            if self.storage.spill is not None and self.storage.spill is not storage:
+                raise ValueError("Sessions already spill to another storage.")
+            self.storage.spill = storage
+        else:
+            self.storage = storage
 
     def configure_debug(self, state, data=None):
         """Optionally configure debug options for testing.
@@ -67,32 +360,49 @@ class DrillBot():
 
     # handlers
 
-    def _auth_layer(self, bot, update, user_data):
+    def _auth_layer(self, bot, update):
         """Perform any authentication actions.
 
         Checks if a message is allowed by checking the user id.
         Only active if configure_auth is called.
+        Blocked users are replied to directly, without creating any conversation state.
         """
-        machine = Machine(bot, update, user_data)
-        if self.allowed_ids and machine.user_id() not in self.allowed_ids:
+        if self._is_allowed(update):
+            return
+        user_id = update.effective_user.id if update.effective_user else None
+        if self.denials.allow(user_id):
             logger.warning("Blocked request from %s, not in allowed_ids %s",
-                           machine.user_id(),
+                           user_id,
                            self.allowed_ids)
-            if self.notify_auth_failure:
+            if self.notify_auth_failure and user_id is not None:
                 logger.info("Replying with access denied notification.")
-                machine.reply("You don't have access to this bot. To get access, ask the owner to whitelist your user id: {}".format(machine.user_id()))
-            raise DispatcherHandlerStop
+                self._wrap_bot(bot).send_message(chat_id=update.effective_chat.id, text=DENIED_MESSAGE.format(user_id))
+        raise DispatcherHandlerStop
 
-    def _setup_layer(self, bot, update, user_data): # pylint: disable=no-self-use
+    def _setup_layer(self, bot, update, user_data):
         """Perform any setup actions.
 
         Calls end_callback, which is sometimes needed and always safe.
         """
-        Machine(bot, update, user_data).end_callback()
+        self._get_machine(bot, update, user_data).end_callback()
 
     def _create_conversation(self):
-        """Create the primary conversation handler."""
-        return ConversationHandler(
+        """Create the primary conversation handler.
+
+        Long-running handlers return promises, which aren't waited for when the next update comes in.
+        Until they're done, the user's input goes to the waiting handlers instead.
+        """
+        waiting = ()
+        if self.background:
+            waiting = (
+                MachineHandlers.message_handler(self._busy),
+                MachineHandlers.callback_handler(self._busy),
+            )
+        return GraphConversationHandler(
+            self.graph,
+            partial(self._state_handlers, self.transitions, {}),
+            resume=self._resume_state,
+            waiting=waiting,
             entry_points=[
                 MachineHandlers.command_handler("start", self._start),
                 MachineHandlers.command_handler("debug", self._debug),
@@ -100,32 +410,81 @@ class DrillBot():
                 MachineHandlers.callcommand_handler(HOME_EMOJI, self._home),
                 MachineHandlers.callcommand_handler(BACK_EMOJI, self._back)
             ],
-            states={s: self._create_handler(t) for s, t in self.transitions.items()},
             fallbacks=[],
             allow_reentry=True
         )
 
-    def _create_handler(self, transition):
-        """Create a handler for a transition."""
+    def _state_handlers(self, transitions, shared, state):
+        """Get the handlers for a state.
+
+        States with the standard handlers share them, kept in shared,
+        since the current state is in the breadcrumb.
+        """
+        transition = transitions[state]
+        if type(transition).get_handlers is not Transition.get_handlers:
+            return transition.get_handlers(self._create_handler(state))
+        if "handlers" not in shared:
+            shared.setdefault("handlers", transition.get_handlers(self._create_handler()))
+        return shared["handlers"]
+
+    def _create_handler(self, state=None):
+        """Create a handler function for a state, or for whichever state the user is in."""
         def handler_func(bot, update, user_data):
-            machine = Machine(bot, update, user_data)
-            # try to move away
-            try:
-                new_state = transition.move_from(machine)
-            except BaseException:
-                logger.exception("Error during move_from transition.")
-                self._send_error_message(machine)
-                return None
-            if new_state:
-                return self._goto_state(machine, new_state)
-            # couldn't move away, so refresh
-            try:
-                transition.move_to(machine)
-            except BaseException:
-                logger.exception("Error during move_to transition after rejected move_from.")
-                self._send_error_message(machine)
+            machine = self._get_machine(bot, update, user_data)
+            current_state = machine.get_current_state() if state is None else state
+            if current_state not in self.transitions:
+                # the conversation state is gone, such as after an evicted session, so start over
+                machine.ascend_all()
+                return self._goto_state(machine, self.home_state)
+            transition = self.transitions[current_state]
+            if machine.is_stale_callback():
+                return self._refresh_stale(current_state, transition, machine)
+            def handle(machine):
+                if not self.metrics:
+                    return self._handle_state(current_state, transition, machine)
+                start = time.perf_counter()
+                try:
+                    return self._handle_state(current_state, transition, machine)
+                finally:
+                    self.metrics.observe("drillbot_handler_seconds", time.perf_counter() - start,
+                                         state=current_state)
+            if self._is_long_running(current_state, *transition.get_targets(machine)):
+                return self._run_in_background(machine, handle)
+            return handle(machine)
+        return handler_func
+
+    def _handle_state(self, state, transition, machine):
+        """Handle user input in a state."""
+        # menu selections are looked up directly
+        new_state = self.graph.route(state, machine.get_message())
+        if new_state:
+            return self._goto_state(machine, new_state)
+        # try to move away
+        try:
+            new_state = self._move(state, transition, "move_from", machine)
+        except BaseException:
+            self._log_error("Error during move_from transition.")
+            self._send_error_message(machine)
             return None
-        return transition.get_handlers(handler_func)
+        if new_state:
+            return self._goto_state(machine, new_state)
+        # couldn't move away, so refresh
+        try:
+            self._move(state, transition, "move_to", machine)
+        except BaseException:
+            self._log_error("Error during move_to transition after rejected move_from.")
+            self._send_error_message(machine)
+        return None
+
+    def _refresh_stale(self, state, transition, machine):
+        """Show the current menu again after a button on an outdated keyboard was pressed."""
+        machine.reply(STALE_KEYBOARD_MESSAGE)
+        try:
+            self._move(state, transition, "move_to", machine)
+        except BaseException:
+            self._log_error("Error during move_to transition after a stale keyboard.")
+            self._send_error_message(machine)
+        return None
 
     def _goto_state(self, machine, state):
         """Navigate to a state."""
@@ -141,18 +500,18 @@ class DrillBot():
             state = machine.ascend()
         # move
         try:
-            should_change_state = self.transitions[state].move_to(machine)
+            should_change_state = self._move(state, self.transitions[state], "move_to", machine)
         except BaseException:
-            logger.exception("Error during move_to transition.")
+            self._log_error("Error during move_to transition.")
             self._send_error_message(machine)
             return None
         # refresh menu
         if not should_change_state:
             current_state = machine.get_current_state()
             try:
-                self.transitions[current_state].move_to(machine)
+                self._move(current_state, self.transitions[current_state], "move_to", machine)
             except BaseException:
-                logger.exception("Error during move_to transition after rejected move_to.")
+                self._log_error("Error during move_to transition after rejected move_to.")
                 self._send_error_message(machine)
                 return None
             return None
@@ -162,35 +521,35 @@ class DrillBot():
 
     def _start(self, bot, update, user_data):
         """Start a conversation."""
-        machine = Machine(bot, update, user_data)
+        machine = self._get_machine(bot, update, user_data)
         machine.clear()
         logger.info("Received /start from user '%s' with id '%s'",
                     machine.user_name(),
                     machine.user_id())
-        return self._goto_state(machine, self.home_state)
+        return self._navigate(machine, self.home_state)
 
     def _home(self, bot, update, user_data):
         """Go to the home state of a conversation."""
-        machine = Machine(bot, update, user_data)
+        machine = self._get_machine(bot, update, user_data)
         logger.debug("Received home command from user '%s' with id '%s'",
                      machine.user_name(),
                      machine.user_id())
-        return self._goto_state(machine, self.home_state)
+        return self._navigate(machine, self.home_state)
 
     def _back(self, bot, update, user_data):
         """Go to a previous state in a conversation."""
-        machine = Machine(bot, update, user_data)
+        machine = self._get_machine(bot, update, user_data)
         logger.debug("Received /back from user '%s' with id '%s'",
                      machine.user_name(),
                      machine.user_id())
-        return self._goto_state(machine, BACK)
+        return self._navigate(machine, BACK, machine.get_previous_state())
 
     def _debug(self, bot, update, user_data):
         """Start a debug conversation.
 
         Will begin in a different state with injected data, based on configure_debug.
         """
-        machine = Machine(bot, update, user_data)
+        machine = self._get_machine(bot, update, user_data)
         if self.admin_ids and machine.user_id() not in self.admin_ids:
             logger.info("Rejecting /debug from user '%s' with id '%s'",
                     machine.user_name(),
@@ -204,11 +563,11 @@ class DrillBot():
                     machine.user_id())
         logger.info("Setting debug state: %s with data %s", self.debug_state, self.debug_data)
         machine.reply("Entering debug mode.")
-        return self._goto_state(machine, self.debug_state)
+        return self._navigate(machine, self.debug_state)
 
     def _restart(self, bot, update, user_data):
-        """Restart the bot."""
-        machine = Machine(bot, update, user_data)
+        """Restart the bot, or reload its transitions in place if configure_reload was called."""
+        machine = self._get_machine(bot, update, user_data)
         if self.admin_ids and machine.user_id() not in self.admin_ids:
             logger.info("Rejecting /restart from user '%s' with id '%s'",
                     machine.user_name(),
@@ -218,14 +577,298 @@ class DrillBot():
         logger.info("Received /restart from user '%s' with id '%s'",
                     machine.user_name(),
                     machine.user_id())
+        if self.transitions_factory and not self.on_restart:
+            try:
+                self.reload()
+            except BaseException:
+                logger.exception("Error reloading transitions.")
+                self._send_error_message(machine)
+                return
+            machine.reply("Reloaded {} states.".format(len(self.transitions)))
+            return
         machine.reply("Restarting...")
+        if self.on_restart:
+            # something else owns the process, such as a ShardedRunner
+            self.on_restart()
+            return
         def graceful_exit():
             self.updater.stop()
+            self._shutdown()
             os.execl(sys.executable, sys.executable, *sys.argv)
         Thread(target=graceful_exit).start()
 
+    def _broadcast_command(self, bot, update, user_data):
+        """Broadcast the rest of the message to every user, or refresh their menus if there's nothing else.
+
+        Only admins can broadcast, so this requires configure_auth with admin_ids.
+        """
+        machine = self._get_machine(bot, update, user_data)
+        if not self.admin_ids or machine.user_id() not in self.admin_ids:
+            logger.info("Rejecting /broadcast from user '%s' with id '%s'",
+                    machine.user_name(),
+                    machine.user_id())
+            machine.reply("Error: admin only operation.")
+            raise DispatcherHandlerStop
+        if self._broadcast:
+            machine.reply("A broadcast is already running.")
+            return
+        parts = (update.message.text or "").split(None, 1)
+        text = parts[1] if len(parts) > 1 else None
+        logger.info("Received /broadcast from user '%s' with id '%s'",
+                    machine.user_name(),
+                    machine.user_id())
+        machine.reply("Broadcasting..." if text else "Refreshing all menus...")
+        self._start_broadcast(text, machine.user_id(), machine.chat_id())
+
+    def _busy(self, bot, update, user_data):
+        """Reply to input that comes in while a long-running handler is still going."""
+        self._get_machine(bot, update, user_data).reply(self.background_messages["busy"])
+
+    # helpers
+
+    def _is_allowed(self, update):
+        """Check if the user who sent an update is allowed to use this bot."""
+        if not self.allowed_ids:
+            return True
+        return update.effective_user is not None and update.effective_user.id in self.allowed_ids
+
+    def _track_sessions(self, user_data):
+        """Drop users' user_data and conversations when their sessions are evicted, if sessions are configured."""
+        if isinstance(self.storage, SessionStorage):
+            self.storage.on_evict = partial(self._evict_session, user_data)
+
+    def _evict_session(self, user_data, user_id):
+        """Drop a user's user_data and conversations after their session is evicted."""
+        user_data.pop(user_id, None)
+        if self._conversation is not None:
+            self._conversation.drop_user(user_id)
+
+    def _resume_state(self, update):
+        """Get the state a user's conversation was left in, if it's kept in a storage that outlives it."""
+        if not self.storage or update.effective_user is None:
+            return None
+        info = self.storage.load(update.effective_user.id)
+        if info is None or not info.breadcrumb:
+            # a button from a conversation that's gone, such as an evicted session's, so start over
+            return self.home_state if update.callback_query else None
+        return info.breadcrumb[-1]
+
+    def _button_label(self, update):
+        """Get the label of the button pressed in an update, without creating or touching any state for the user."""
+        if update.effective_user is None:
+            return None
+        user_id = update.effective_user.id
+        if self.storage:
+            # peek, so an unauthenticated sender can't refresh, load back or evict any session
+            info = self.storage.peek(user_id)
+        else:
+            _, user_data = self._broadcast_sources()
+            info = user_data.get(user_id, {}).get("MachineInfo")
+        return button_label(update.callback_query.data, info)
+
+    def _start_broadcast(self, text, user_id, chat_id):
+        """Run a broadcast on its own thread, replying to the admin who started it when it's done."""
+        def run():
+            try:
+                stats = self.broadcast(text, progress=lambda stats: logger.info("Broadcast progress: %s", stats))
+            except BaseException: # pylint: disable=broad-except
+                logger.exception("Error broadcasting.")
+                self._report(user_id, chat_id, "Broadcast failed! See logs for details.")
+                return
+            self._report(user_id, chat_id, "Broadcast done: {sent} sent, {failed} failed, {resumed} already done "
+                                           "out of {total}.".format(**stats))
+        Thread(target=run, name="Broadcast", daemon=True).start()
+
+    def _report(self, user_id, chat_id, text):
+        """Reply to a user outside of any update, such as when a broadcast they started is done."""
+        bot, user_data = self._broadcast_sources()
+        def reply(info):
+            Machine.for_session(bot, user_id, info, chat_id=chat_id).reply(text)
+            return True
+        if not self._with_session(user_data, user_id, reply):
+            # their session is gone, so there's no keyboard to keep track of
+            bot.send_message(chat_id=chat_id, text=text)
+
+    def _broadcast_sources(self):
+        """Get the bot to broadcast with, and the user_data of each user.
+
+        The bot is wrapped like the one handlers use, so broadcasts share the outbound queue with regular traffic.
+        """
+        if self._dispatcher is None:
+            raise ValueError("Start the bot, or call register_handlers, before broadcasting.")
+        return self._wrap_bot(self._dispatcher.bot), self._dispatcher.user_data
+
+    def _sessions(self, user_data):
+        """Get (user id, state) pairs for every user with conversation state."""
+        if self.storage:
+            return self.storage.items()
+        return ((key, data["MachineInfo"]) for key, data in list(user_data.items()) if "MachineInfo" in data)
+
+    def _broadcast_message(self, user_data, text, bot, user_id, info):
+        """Send a broadcast message to a user."""
+        bot.send_message(chat_id=info.keyboard_chat or user_id, text=text)
+        def mark_stale(info):
+            # the keyboard is no longer the latest message, so it's replaced the next time it's shown
+            info.replied()
+            return True
+        self._with_session(user_data, user_id, mark_stale)
+        return True
+
+    def _broadcast_refresh(self, user_data, bot, user_id, info):
+        """Show a user's current menu again, returning False if they aren't in a known state."""
+        if not info.breadcrumb or info.breadcrumb[-1] not in self.transitions:
+            return False
+        def refresh(info):
+            state = info.breadcrumb[-1] if info.breadcrumb else None
+            if state not in self.transitions:
+                return False
+            machine = Machine.for_session(bot, user_id, info, chat_id=info.keyboard_chat)
+            self._move(state, self.transitions[state], "move_to", machine)
+            return True
+        return self._with_session(user_data, user_id, refresh)
+
+    def _with_session(self, user_data, user_id, func):
+        """Call func with a user's current state and store its changes, returning its result, or False without one.
+
+        This doesn't count as use of the session, and it holds the user's lock,
+        so it runs in turn with the user's updates and they don't change the state at the same time.
+        """
+        with self.session_locks.hold(user_id):
+            return self._use_session(user_data, user_id, func)
+
+    def _use_session(self, user_data, user_id, func):
+        """Call func with a user's current state and store its changes, for a caller holding the user's lock."""
+        if self.storage:
+            info = self.storage.peek(user_id)
+        else:
+            info = user_data.get(user_id, {}).get("MachineInfo")
+        if info is None:
+            return False
+        result = func(info)
+        if self.storage:
+            self.storage.save_idle(user_id, info)
+        return result
+
+    def _get_machine(self, bot, update, user_data):
+        """Get the machine for an update, shared by all handler layers."""
+        return Machine.for_update(self._wrap_bot(bot), update, user_data, sender=self.keyboard_sender,
+                                  storage=self.storage, rebuild_options=self._rebuild_options,
+                                  locks=self.session_locks)
+
+    def _rebuild_options(self, machine):
+        """Get the options of a user's latest keyboard from the transition of the state they're in."""
+        state = machine.get_current_state()
+        if state not in self.transitions:
+            return None
+        return self.transitions[state].get_options(machine)
+
+    def _wrap_bot(self, bot):
+        """Wrap a bot for instrumentation and rate limiting, if configured."""
+        if not self.metrics and not self.outbound:
+            return bot
+        wrapped_bot = self._wrapped_bot
+        if wrapped_bot is None or wrapped_bot[0] is not bot:
+            wrapped = bot
+            if self.metrics:
+                wrapped = InstrumentedBot(wrapped, self.metrics)
+            if self.outbound:
+                wrapped = ThrottledBot(wrapped, self.outbound)
+            wrapped_bot = (bot, wrapped)
+            self._wrapped_bot = wrapped_bot
+        return wrapped_bot[1]
+
+    def _compile_graph(self, transitions):
+        """Compile and validate transitions, keeping the ids of the current graph's states."""
+        return StateGraph(transitions, self.home_state, (self.debug_state,), previous=self.graph)
+
+    def _is_long_running(self, *states):
+        """Check if moving through any of these states should happen in the background."""
+        if not self.background:
+            return False
+        states = [self.home_state if state == HOME else state for state in states]
+        return any(self.transitions[state].long_running for state in states if state in self.transitions)
+
+    def _navigate(self, machine, state, target=None):
+        """Navigate to a state, in the background if the transition to target (by default, state) is long-running."""
+        if self._is_long_running(target or state):
+            return self._run_in_background(machine, lambda job_machine: self._goto_state(job_machine, state))
+        return self._goto_state(machine, state)
+
+    def _run_in_background(self, machine, func):
+        """Acknowledge the user, and run a handler in the background, returning a promise for the next state."""
+        current_state = machine.get_current_state()
+        machine.reply(self.background_messages["working"])
+        return self.background.submit(machine, END if current_state is None else current_state, func,
+                                      on_timeout=lambda machine: machine.reply(self.background_messages["timeout"]),
+                                      lock=partial(self.session_locks.hold, machine.user_id()))
+
+    def _move(self, state, transition, direction, machine):
+        """Call a transition's move_to or move_from, recording metrics if configured."""
+        if not self.metrics:
+            return getattr(transition, direction)(machine)
+        start = time.perf_counter()
+        try:
+            return getattr(transition, direction)(machine)
+        except BaseException:
+            self.metrics.increment("drillbot_transition_errors_total",
+                                   state=state, transition=type(transition).__name__, direction=direction)
+            raise
+        finally:
+            self.metrics.observe("drillbot_transition_seconds", time.perf_counter() - start,
+                                 state=state, transition=type(transition).__name__, direction=direction)
+
+    def _start_webhook_app(self):
+        """Start handling updates from a webhook, returning the app to receive them with."""
+        self.updater.job_queue.start()
+        # like the updater, wait for the dispatcher to be ready, so it can be stopped cleanly
+        ready = Event()
+        Thread(target=self.updater.dispatcher.start, name="dispatcher", kwargs={"ready": ready}, daemon=True).start()
+        ready.wait()
+        # the updater runs without a listener of its own, so it can still be stopped
+        self.updater.running = True
+        options = {"url": self.webhook["url"]}
+        if self.webhook["secret_token"]:
+            options["secret_token"] = self.webhook["secret_token"]
+        if self.webhook["cert"]:
+            with open(self.webhook["cert"], "rb") as certificate:
+                self.updater.bot.set_webhook(certificate=certificate, **options)
+        else:
+            self.updater.bot.set_webhook(**options)
+        return WebhookApp(self.updater.bot, self.updater.update_queue, self.webhook["url_path"],
+                          secret_token=self.webhook["secret_token"])
+
+    def _close_webhook_app(self):
+        """Stop the bot after the server its webhook app is mounted in shuts down."""
+        self.updater.stop()
+        self._shutdown()
+
+    def _shutdown(self):
+        """Finish any background work after the updater has stopped."""
+        if self._broadcast:
+            # unfinished sessions are left in the checkpoint, if there is one
+            self._broadcast.cancel()
+        if self.update_executor:
+            self.update_executor.shutdown()
+        if self.background:
+            self.background.stop()
+        if self.keyboard_sender:
+            self.keyboard_sender.stop()
+        if self.outbound:
+            self.outbound.stop()
+        if self.storage:
+            self.storage.close()
+        if self.recorder:
+            self.recorder.close()
+
     # errors
 
+    def _log_error(self, message): # pylint: disable=no-self-use
+        """Log an error in a handler, quietly if it's only a background handler's call failing after it timed out."""
+        if isinstance(sys.exc_info()[1], HandlerTimeout):
+            logger.debug("%s Background handler timed out.", message)
+        else:
+            logger.exception(message)
+
     def _send_error_message(self, machine): # pylint: disable=no-self-use
         """Send a friendly error message for unexpected failures."""
         if machine.is_debug():
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains a fake Telegram for running a bot without network access."""
+
+import io
+import json
+import time
+from datetime import datetime
+from functools import lru_cache
+from queue import Queue, Empty
+
+import telegram
+from telegram.ext import Dispatcher
+
+from .webhook import WebhookApp # pylint: disable=relative-beyond-top-level
+
+class FakeBot():
+    """This class stands in for telegram.Bot, recording calls instead of making them."""
+
+    def __init__(self, username="drillbot"):
+        """Initialize the bot with no recorded calls."""
+        self.id = 1 # pylint: disable=invalid-name
+        self.username = username
+        self.first_name = username
+        self.calls = []
+        self.keyboards = {}
+        self.buttons = {}
+        self._message_id = 0
+
+    def get_me(self):
+        """Get the bot's user."""
+        return telegram.User(self.id, self.first_name, True, username=self.username)
+
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        """Record a sent message."""
+        self._record("send_message", chat_id=chat_id, text=text, reply_markup=reply_markup, **kwargs)
+        self._message_id += 1
+        if reply_markup:
+            self.keyboards[chat_id] = self._message_id
+            self._remember_buttons(chat_id, reply_markup)
+        return self._message(chat_id, self._message_id, text)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None, **kwargs):
+        """Record an edited message."""
+        self._record("edit_message_text", chat_id=chat_id, message_id=message_id,
+                     text=text, reply_markup=reply_markup, **kwargs)
+        if reply_markup:
+            self._remember_buttons(chat_id, reply_markup)
+        return self._message(chat_id, message_id, text)
+
+    def edit_message_reply_markup(self, chat_id=None, message_id=None, reply_markup=None, **kwargs):
+        """Record an edited keyboard."""
+        self._record("edit_message_reply_markup", chat_id=chat_id, message_id=message_id,
+                     reply_markup=reply_markup, **kwargs)
+        if reply_markup:
+            self._remember_buttons(chat_id, reply_markup)
+        return self._message(chat_id, message_id, None)
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        """Record a deleted message."""
+        self._record("delete_message", chat_id=chat_id, message_id=message_id, **kwargs)
+        if self.keyboards.get(chat_id) == message_id:
+            del self.keyboards[chat_id]
+        return True
+
+    def answer_callback_query(self, callback_query_id, **kwargs):
+        """Record an answered callback query."""
+        self._record("answer_callback_query", callback_query_id=callback_query_id, **kwargs)
+        return True
+
+    answerCallbackQuery = answer_callback_query
+
+    def set_webhook(self, url=None, **kwargs):
+        """Record a webhook registration."""
+        self._record("set_webhook", url=url, **kwargs)
+        return True
+
+    def count(self, method):
+        """Count the recorded calls to a method."""
+        return sum(1 for name, _ in self.calls if name == method)
+
+    def button_data(self, chat_id, text):
+        """Get the callback data of a button on a chat's latest keyboard, or the text if there's no such button."""
+        return self.buttons.get(chat_id, {}).get(text, text)
+
+    def _remember_buttons(self, chat_id, reply_markup):
+        """Remember the callback data of a keyboard's buttons, by their text."""
+        if not isinstance(reply_markup, str):
+            reply_markup = json.dumps(reply_markup if isinstance(reply_markup, dict) else reply_markup.to_dict())
+        self.buttons[chat_id] = _parse_buttons(reply_markup)
+
+    def _record(self, method, **kwargs):
+        """Record a call."""
+        self.calls.append((method, kwargs))
+
+    def _message(self, chat_id, message_id, text):
+        """Create a message as if it came from Telegram."""
+        return telegram.Message(message_id,
+                                self.get_me(),
+                                datetime.utcnow(),
+                                telegram.Chat(chat_id, telegram.Chat.PRIVATE),
+                                text=text,
+                                bot=self)
+
+class FakeTelegram():
+    """This class runs a DrillBot's handlers against a FakeBot.
+
+    Updates are posted to a WebhookApp as JSON, just like Telegram would,
+    and processed synchronously so their effects can be checked right away.
+    """
+
+    def __init__(self, drillbot, bot=None):
+        """Initialize the fake with a dispatcher running the bot's handlers."""
+        self.bot = bot or FakeBot()
+        self.dispatcher = Dispatcher(self.bot, Queue(), workers=0)
+        drillbot.register_handlers(self.dispatcher)
+        self.app = WebhookApp(self.bot, self.dispatcher.update_queue)
+        self._update_id = 0
+
+    def send(self, user_id, text, chat_id=None):
+        """Simulate a user sending a text message or command."""
+        return self.post(self.message(user_id, text, chat_id))
+
+    def press(self, user_id, text, chat_id=None):
+        """Simulate a user pressing the button with some text on their latest keyboard."""
+        return self.post(self.callback(user_id, text, chat_id))
+
+    def message(self, user_id, text, chat_id=None):
+        """Create the JSON for an update with a text message or command."""
+        return {"message": self._message_data(user_id, text, chat_id)}
+
+    def callback(self, user_id, text, chat_id=None):
+        """Create the JSON for an update with a button press on the user's latest keyboard.
+
+        The button is found by its text, and if there isn't one the text is sent as its data.
+        """
+        if chat_id is None:
+            chat_id = user_id
+        return {"callback_query": {
+            "id": str(self._update_id + 1),
+            "from": _user_data(user_id),
+            "chat_instance": str(chat_id),
+            "data": self.bot.button_data(chat_id, text),
+            "message": self._message_data(self.bot.id, None, chat_id, self.bot.keyboards.get(chat_id)),
+        }}
+
+    def create_update(self, data):
+        """Create an update from its JSON, without going through the webhook app."""
+        self._update_id += 1
+        return telegram.Update.de_json(dict(data, update_id=self._update_id), self.bot)
+
+    def post(self, data):
+        """Post an update to the webhook app and process it, returning the response status."""
+        self._update_id += 1
+        data = dict(data, update_id=self._update_id)
+        body = json.dumps(data).encode("utf-8")
+        statuses = []
+        self.app({
+            "PATH_INFO": self.app.url_path,
+            "REQUEST_METHOD": "POST",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body),
+        }, lambda status, headers: statuses.append(status))
+        self.process()
+        return statuses[0]
+
+    def process(self):
+        """Process all queued updates."""
+        while True:
+            try:
+                update = self.dispatcher.update_queue.get_nowait()
+            except Empty:
+                return
+            self.dispatcher.process_update(update)
+
+    def _message_data(self, user_id, text, chat_id=None, message_id=None):
+        """Create the JSON for a message."""
+        if chat_id is None:
+            chat_id = user_id
+        data = {
+            "message_id": message_id or self._update_id + 1,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": telegram.Chat.PRIVATE},
+            "from": _user_data(user_id),
+        }
+        if text:
+            data["text"] = text
+            if text.startswith("/"):
+                data["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return data
+
+# helper
+
+@lru_cache(maxsize=1024)
+def _parse_buttons(reply_markup):
+    """Get the callback data of a serialized keyboard's buttons, by their text."""
+    return {button["text"]: button.get("callback_data")
+            for row in json.loads(reply_markup).get("inline_keyboard", ())
+            for button in row}
+
+def _user_data(user_id):
+    """Create the JSON for a user."""
+    return {"id": user_id, "is_bot": False, "first_name": "User{}".format(user_id)}
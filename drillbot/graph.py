@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains a compiled view of a bot's states and the transitions between them."""
+
+import logging
+import threading
+
+from telegram import Update
+from telegram.ext import ConversationHandler
+from telegram.utils.promise import Promise
+
+from .catalog import TransitionCatalog # pylint: disable=relative-beyond-top-level
+from .machine import END, BACK, HOME # pylint: disable=relative-beyond-top-level
+from .transition import MenuTransition # pylint: disable=relative-beyond-top-level
+
+logger = logging.getLogger(__name__)
+
+SPECIAL_STATES = (None, END, BACK, HOME)
+
+class StateGraph():
+    """This class validates a bot's transitions and indexes them for fast dispatch.
+
+    States are interned to ids the first time they're used, and menu selections are routed
+    directly through the options of the state's transition, so a large catalog isn't read in full
+    at startup, and routes are kept only as long as their transitions are. Compiling again with
+    the previous graph keeps existing ids, so conversations survive a reload.
+    """
+
+    def __init__(self, transitions, home_state, entry_states=(), previous=None):
+        """Compile the graph, raising ValueError if any state or target is missing.
+
+        Targets are checked for every state up front, unless transitions is a catalog that isn't set
+        to validate, in which case only the home and entry states are.
+        """
+        self.validated = not isinstance(transitions, TransitionCatalog) or transitions.validate
+        validate(transitions, home_state, entry_states, check_targets=self.validated)
+        self.transitions = transitions
+        # ids are shared with the previous graph, so ones it hands out during a reload stay valid
+        self.ids = previous.ids if previous else {}
+        self.states = previous.states if previous else {}
+        self._lock = previous._lock if previous else threading.Lock() # pylint: disable=protected-access
+
+    def state_id(self, state):
+        """Get the interned id of a state, or the state itself if it's special (like END)."""
+        state_id = self.ids.get(state)
+        if state_id is not None:
+            return state_id
+        if state in SPECIAL_STATES or state not in self.transitions:
+            return state
+        with self._lock:
+            state_id = self.ids.get(state)
+            if state_id is None:
+                state_id = _StateId(len(self.ids))
+                self.ids[state] = state_id
+                self.states[state_id] = state
+        return state_id
+
+    def state(self, state_id):
+        """Get the state an interned id refers to, or None if it isn't one of this graph's states."""
+        state = self.states.get(state_id)
+        return state if state is not None and state in self.transitions else None
+
+    def route(self, state, data):
+        """Get the state a menu selection leads to, or None if it isn't a known option."""
+        if state not in self.transitions:
+            return None
+        return _menu_options(self.transitions[state]).get(data) or None
+
+class _StateId():
+    """An internal id of an interned state.
+
+    Ids are compared by identity, so they never equal a state, even one that's an int (like an IntEnum member).
+    """
+
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        """Initialize the id with its index in the graph."""
+        self.index = index
+
+    def __repr__(self):
+        """Get the string representation of the id."""
+        return "StateId({})".format(self.index)
+
+class GraphConversationHandler(ConversationHandler):
+    """This class is a conversation handler that keeps states as their interned ids.
+
+    Handlers still return states, which are converted as they're stored.
+    Each state's handlers are looked up the first time a conversation is in it.
+    """
+
+    def __init__(self, graph, handlers, resume=None, waiting=(), **kwargs):
+        """Initialize the handler for a compiled graph.
+
+        handlers is called with a state and returns the handlers for it.
+        resume, if given, is called with an update whose conversation isn't in memory (such as after
+        a restart) and returns the state to pick it up in, or None to leave it to the entry points.
+        waiting are the handlers for updates that come in while a conversation's handler is still running.
+        """
+        super().__init__(states=_States(graph, handlers, waiting), **kwargs)
+        self.graph = graph
+        self.resume = resume
+        self.conversations = _Conversations()
+
+    def drop_user(self, user_id):
+        """Forget all of a user's conversations, such as when their session is evicted."""
+        self.conversations.drop_user(user_id)
+
+    def check_update(self, update):
+        """Check if an update should be handled, resuming its conversation first if it isn't in memory."""
+        if self.resume and _has_conversation(update):
+            key = self._get_key(update)
+            if key not in self.conversations:
+                state = self.resume(update)
+                if state in self.graph.transitions:
+                    self.conversations[key] = self.graph.state_id(state)
+        return super().check_update(update)
+
+    def update_state(self, new_state, key):
+        """Store a conversation's new state."""
+        if new_state is not None and not isinstance(new_state, Promise):
+            new_state = self.graph.state_id(new_state)
+        super().update_state(new_state, key)
+
+class _States(dict):
+    """An internal dictionary of handlers by state id, which gets a state's handlers when they're first looked up."""
+
+    def __init__(self, graph, handlers, waiting=()):
+        """Initialize a dictionary with only the handlers for waiting on a running handler."""
+        super().__init__()
+        self._graph = graph
+        self._handlers = handlers
+        if waiting:
+            self[ConversationHandler.WAITING] = list(waiting)
+
+    def get(self, state_id, default=None):
+        """Get the handlers for a state id, or default if it isn't one of the graph's states."""
+        handlers = super().get(state_id)
+        if handlers is None:
+            state = self._graph.state(state_id)
+            if state is None:
+                return default
+            handlers = self.setdefault(state_id, self._handlers(state))
+        return handlers
+
+class _Conversations(dict):
+    """An internal dictionary of conversation states by key, which can also find all of a user's.
+
+    Keys are (chat id, user id), so a user's private conversation is found directly,
+    and their conversations in other chats are indexed by user.
+    """
+
+    def __init__(self):
+        """Initialize an empty dictionary."""
+        super().__init__()
+        self._shared = {}
+        self._lock = threading.Lock()
+
+    def __setitem__(self, key, state):
+        """Set a conversation's state."""
+        super().__setitem__(key, state)
+        if len(key) == 2 and key[0] != key[1]:
+            with self._lock:
+                self._shared.setdefault(key[1], set()).add(key)
+
+    def __delitem__(self, key):
+        """Remove a conversation."""
+        super().__delitem__(key)
+        if len(key) == 2 and key[0] != key[1]:
+            with self._lock:
+                keys = self._shared.get(key[1])
+                if keys:
+                    keys.discard(key)
+                    if not keys:
+                        del self._shared[key[1]]
+
+    def drop_user(self, user_id):
+        """Remove all of a user's conversations."""
+        self.pop((user_id, user_id), None)
+        with self._lock:
+            keys = self._shared.pop(user_id, ())
+        for key in keys:
+            self.pop(key, None)
+
+def validate(transitions, home_state, entry_states=(), check_targets=True):
+    """Check that every state a transition can move to exists, and warn about unreachable states.
+
+    Only targets that transitions declare with get_targets can be checked. Without check_targets,
+    only the home and entry states are, so no transitions or specs are read.
+    """
+    starts = [home_state] + [state for state in entry_states
+                             if state not in SPECIAL_STATES and state != home_state]
+    missing = ["start {}".format(state) for state in starts if state not in transitions]
+    if check_targets:
+        for state in transitions:
+            for target in _get_targets(transitions, state):
+                if target not in SPECIAL_STATES and target not in transitions:
+                    missing.append("{} -> {}".format(state, target))
+    if missing:
+        raise ValueError("Transitions refer to missing states: {}".format(", ".join(str(m) for m in missing)))
+    if not check_targets:
+        return
+    reached = set()
+    pending = list(starts)
+    while pending:
+        state = pending.pop()
+        if state in reached or state in SPECIAL_STATES:
+            continue
+        reached.add(state)
+        pending.extend(_get_targets(transitions, state))
+    unreachable = [state for state in transitions if state not in reached]
+    if unreachable:
+        logger.warning("States not reachable from %s (unless a transition's targets aren't declared): %s",
+                       starts, unreachable)
+
+# helper
+
+def _has_conversation(update):
+    """Check if an update can belong to a conversation, as ConversationHandler.check_update does."""
+    return (isinstance(update, Update) and not update.channel_post and update.effective_chat is not None
+            and not (update.callback_query and not update.callback_query.message))
+
+def _get_targets(transitions, state):
+    """Get the states a state's transition can move to, without building it if it's in a catalog."""
+    if isinstance(transitions, TransitionCatalog):
+        return transitions.get_targets(state)
+    return transitions[state].get_targets()
+
+def _menu_options(transition):
+    """Get the options of a transition's menu if it selects them the standard way, so move_from can be skipped."""
+    if type(transition).move_from is MenuTransition.move_from:
+        return transition.options
+    return {}
@@ -2,10 +2,19 @@
 # -*- coding: utf-8 -*-
 """This module contains a helper for interfacing with Telegram and keeping track of state."""
 
-import time
+import hashlib
+import json
 import logging
+import pickle
+import re
+import sys
+import threading
+import zlib
+from collections import ChainMap, OrderedDict
 from datetime import datetime
 from datetime import timedelta
+from functools import lru_cache
+from itertools import islice
 
 import telegram
 from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler, Filters
@@ -14,6 +23,8 @@ logger = logging.getLogger(__name__)
 
 HOME_EMOJI = "🏠"
 BACK_EMOJI = "↩"
+PREV_EMOJI = "◀"
+NEXT_EMOJI = "▶"
 
 CALL_COMMANDS = [HOME_EMOJI, BACK_EMOJI]
 
@@ -25,18 +36,106 @@ KEYBOARD_DELAY_SECONDS = 0.5
 
 KEYBOARD_LIFETIME = timedelta(hours=46) # can't edit messages older than 48 hours
 
+KEYBOARD_CACHE_SIZE = 256
+
+OPTIONS_CACHE_SIZE = 4096
+
+_EPOCH = datetime(1970, 1, 1)
+
+_FIELD_GROUPS = (("breadcrumb", "stack"),
+                 ("debug_data",),
+                 ("debug_mode",),
+                 ("keyboard_id", "keyboard_stale", "keyboard_date", "keyboard_version", "keyboard_render",
+                  "keyboard_chat", "keyboard_page"))
+
+_context = threading.local()
+
 class _MachineInfo():
-    """An internal class for storing state."""
+    """An internal class for storing state.
+
+    This is kept compact since there's one per user: states are interned,
+    the breadcrumb is a tuple, and frames without data are stored as None.
+    The latest keyboard's options aren't kept, only their version and the page shown,
+    since they're shared by users in a cache, or rebuilt from the transition that sent them.
+    """
+
+    __slots__ = ("breadcrumb", "stack", "debug_data", "debug_mode",
+                 "keyboard_id", "keyboard_stale", "keyboard_date", "keyboard_version", "keyboard_render",
+                 "keyboard_chat", "keyboard_page", "_merged", "_replies")
+
+    FORMAT_VERSION = 6
 
     def __init__(self):
         """Initialize the state with no data."""
-        self.breadcrumb = []
+        self.breadcrumb = ()
         self.stack = []
-        self.debug_data = {}
+        self.debug_data = None
         self.debug_mode = False
         self.keyboard_id = None
         self.keyboard_stale = False
         self.keyboard_date = None
+        self.keyboard_version = None
+        self.keyboard_render = None
+        self.keyboard_chat = None
+        self.keyboard_page = None
+        self._merged = None
+        self._replies = 0
+
+    def __getstate__(self):
+        """Get the state for pickling, as a versioned tuple."""
+        return (self.FORMAT_VERSION,
+                self.breadcrumb,
+                self.stack,
+                self.debug_data,
+                self.debug_mode,
+                self.keyboard_id,
+                self.keyboard_stale,
+                self.keyboard_date,
+                self.keyboard_version,
+                self.keyboard_render,
+                self.keyboard_chat,
+                self.keyboard_page)
+
+    def __setstate__(self, state):
+        """Restore the state from pickling."""
+        self._merged = None
+        self._replies = 0
+        self.keyboard_version = None
+        self.keyboard_render = None
+        self.keyboard_chat = None
+        self.keyboard_page = None
+        if isinstance(state, tuple) and state and isinstance(state[0], int):
+            version = state[0]
+            if not 1 <= version <= self.FORMAT_VERSION:
+                raise ValueError("Unsupported state format version: {}".format(version))
+            # earlier versions lack the fields added since, which all start as None,
+            # and the full state is the version followed by every slot that isn't private
+            state += (None,) * (1 + sum(not slot.startswith("_") for slot in self.__slots__) - len(state))
+            if version < 6:
+                # the keyboard's options were kept in place of its page, and are rebuilt instead
+                state = state[:11] + (None,) + state[12:]
+            (_,
+             breadcrumb,
+             self.stack,
+             self.debug_data,
+             self.debug_mode,
+             self.keyboard_id,
+             self.keyboard_stale,
+             self.keyboard_date,
+             self.keyboard_version,
+             self.keyboard_render,
+             self.keyboard_chat,
+             self.keyboard_page) = state
+        else:
+            # unversioned state, pickled before slots were used
+            breadcrumb = state["breadcrumb"]
+            self.stack = [frame or None for frame in state["stack"]]
+            self.debug_data = state["debug_data"] or None
+            self.debug_mode = state["debug_mode"]
+            self.keyboard_id = state["keyboard_id"]
+            self.keyboard_stale = state["keyboard_stale"]
+            self.keyboard_date = state["keyboard_date"]
+        self.breadcrumb = tuple(_intern_state(state) for state in breadcrumb)
 
     def __repr__(self):
         """Get the string representation of the state."""
@@ -49,27 +148,170 @@ class _MachineInfo():
     def to_dict(self):
         """Get the dictionary representation of the state."""
         data = dict()
-        for key in iter(self.__dict__):
-            value = self.__dict__[key]
-            if value is not None:
+        for key in self.__slots__:
+            value = getattr(self, key)
+            if value is not None and not key.startswith("_"):
                 if hasattr(value, 'to_dict'):
                     data[key] = value.to_dict()
                 else:
                     data[key] = value
         return data
 
+    # serialization
+
+    def to_bytes(self):
+        """Get a compact binary representation of the state."""
+        return pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def from_bytes(data):
+        """Create a state from its binary representation."""
+        info = pickle.loads(data)
+        if not isinstance(info, _MachineInfo):
+            raise ValueError("Not a serialized state.")
+        return info
+
+    def to_json(self, encode_state=None):
+        """Get a JSON representation of the state.
+
+        States and saved data must be JSON serializable,
+        or encode_state can be given to convert states (like Enum members) to something that is.
+        """
+        if not encode_state:
+            encode_state = lambda state: state
+        return json.dumps({
+            "version": self.FORMAT_VERSION,
+            "breadcrumb": [encode_state(state) for state in self.breadcrumb],
+            "stack": self.stack,
+            "debug_data": self.debug_data,
+            "debug_mode": self.debug_mode,
+            "keyboard_id": self.keyboard_id,
+            "keyboard_stale": self.keyboard_stale,
+            "keyboard_date": (self.keyboard_date - _EPOCH).total_seconds() if self.keyboard_date else None,
+            "keyboard_version": self.keyboard_version,
+            "keyboard_render": self.keyboard_render,
+            "keyboard_chat": self.keyboard_chat,
+            "keyboard_page": self.keyboard_page,
+        }, separators=(",", ":"))
+
+    @staticmethod
+    def from_json(text, decode_state=None):
+        """Create a state from its JSON representation, with decode_state undoing any encode_state."""
+        if not decode_state:
+            decode_state = lambda state: state
+        data = json.loads(text)
+        if data.get("version") not in range(1, _MachineInfo.FORMAT_VERSION + 1):
+            raise ValueError("Unsupported state format version: {}".format(data.get("version")))
+        info = _MachineInfo()
+        info.breadcrumb = tuple(_intern_state(decode_state(state)) for state in data["breadcrumb"])
+        info.stack = data["stack"]
+        info.debug_data = data["debug_data"]
+        info.debug_mode = data["debug_mode"]
+        info.keyboard_id = data["keyboard_id"]
+        info.keyboard_stale = data["keyboard_stale"]
+        if data["keyboard_date"] is not None:
+            info.keyboard_date = _EPOCH + timedelta(seconds=data["keyboard_date"])
+        info.keyboard_version = data.get("keyboard_version")
+        info.keyboard_render = data.get("keyboard_render")
+        info.keyboard_chat = data.get("keyboard_chat")
+        info.keyboard_page = data.get("keyboard_page")
+        return info
+
+    def replies(self):
+        """Get the number of messages sent below the keyboard since this state was created or loaded."""
+        return self._replies
+
+    def replied(self):
+        """Note that a message was sent below the keyboard, so it has to be sent again to be seen."""
+        self.keyboard_stale = True
+        self._replies += 1
+
+    def merge_changes(self, original, other):
+        """Take the fields other changed since original, where this state left them as they were.
+
+        Fields that only make sense together, like the keyboard's or the breadcrumb and stack, are taken together.
+        """
+        for fields in _FIELD_GROUPS:
+            mine = tuple(getattr(self, field) for field in fields)
+            before = tuple(getattr(original, field) for field in fields)
+            theirs = tuple(getattr(other, field) for field in fields)
+            if mine == before != theirs:
+                for field in fields:
+                    setattr(self, field, getattr(other, field))
+                self._merged = None
+
+    # data
+
+    def merged(self):
+        """Get the debug data and stack merged into one dictionary, where newer values override older ones.
+
+        This is kept up to date as the stack changes, so it should not be modified directly.
+        """
+        if self._merged is None:
+            self._merged = dict(self.debug_data or ())
+            for stack_data in self.stack:
+                if stack_data:
+                    self._merged.update(stack_data)
+        return self._merged
+
+    def update_debug_data(self, data):
+        """Add to the debug data."""
+        if data:
+            self.debug_data = dict(self.debug_data or (), **data)
+            self._merged = None
+
+    def push_frame(self, state):
+        """Push a state and an empty frame for its data."""
+        self.breadcrumb += (_intern_state(state),)
+        self.stack.append(None)
+
+    def pop_frame(self):
+        """Pop a state and its frame, restoring any values it overrode. Returns the state."""
+        frame = self.stack.pop()
+        if frame and self._merged is not None:
+            for key in frame:
+                self._restore(key)
+        state = self.breadcrumb[-1]
+        self.breadcrumb = self.breadcrumb[:-1]
+        return state
+
+    def clear_frames(self):
+        """Remove all states and frames."""
+        self.breadcrumb = ()
+        self.stack.clear()
+        self._merged = None
+
+    def set_value(self, key, value):
+        """Set a value in the current frame."""
+        if self.stack[-1] is None:
+            self.stack[-1] = {}
+        self.stack[-1][key] = value
+        if self._merged is not None:
+            self._merged[key] = value
+
+    def _restore(self, key):
+        """Set a merged value to the newest one remaining, after a frame is popped."""
+        for stack_data in reversed(self.stack):
+            if stack_data and key in stack_data:
+                self._merged[key] = stack_data[key]
+                return
+        if self.debug_data and key in self.debug_data:
+            self._merged[key] = self.debug_data[key]
+        else:
+            del self._merged[key]
+
 class MachineHandlers():
     """A static class for generating Telegram handlers."""
 
     @staticmethod
-    def message_handler(handler_func):
+    def message_handler(handler_func, pass_user_data=True):
         """Create a message handler."""
-        return MessageHandler(Filters.all, handler_func, pass_user_data=True)
+        return MessageHandler(Filters.all, handler_func, pass_user_data=pass_user_data)
 
     @staticmethod
-    def callback_handler(handler_func):
+    def callback_handler(handler_func, pass_user_data=True):
         """Create a callback handler."""
-        return CallbackQueryHandler(handler_func, pass_user_data=True)
+        return CallbackQueryHandler(handler_func, pass_user_data=pass_user_data)
 
     @staticmethod
     def command_handler(command, handler_func):
@@ -84,16 +326,84 @@ class MachineHandlers():
 class Machine():
     """This class both mediates Telegram operations and maintains state."""
 
-    def __init__(self, bot, update, user_data):
-        """Initialize this object for a given conversation."""
+    def __init__(self, bot, update, user_data, sender=None, storage=None, rebuild_options=None, locks=None): # pylint: disable=too-many-arguments
+        """Initialize this object for a given conversation.
+
+        If a sender is given, replies and keyboards are sent by it in the background,
+        holding the user's lock from locks (a KeyedLock) while keyboards change the state, if given.
+        If a storage is given, state is kept there instead of in user_data.
+        rebuild_options, if given, is called with the machine to get the options of the user's latest
+        keyboard when they aren't cached, such as after a restart, usually with Transition.get_options.
+        """
         self.bot = bot
         self.update = update
         self.user_data = user_data
-        self.info = self.user_data.setdefault("MachineInfo", _MachineInfo())
+        self.sender = sender
+        self.storage = storage
+        self.rebuild_options = rebuild_options
+        self.locks = locks
+        self._user_id = None
+        self._chat_id = None
+        self._message = None
+        self._stale_callback = False
+        if self.storage:
+            self.info = self.storage.load(self.user_id())
+        else:
+            self.info = self.user_data.get("MachineInfo")
+        if self.info is None:
+            self.clear()
+
+    @classmethod
+    def for_update(cls, bot, update, user_data, sender=None, storage=None, rebuild_options=None, locks=None): # pylint: disable=too-many-arguments
+        """Get the machine for an update, creating it for the first handler layer that asks.
+
+        Each thread handles one update at a time, so the machine is remembered per thread.
+        """
+        machine = getattr(_context, "machine", None)
+        if machine is None or machine.update is not update:
+            machine = _context.machine = cls(bot, update, user_data, sender=sender, storage=storage,
+                                             rebuild_options=rebuild_options, locks=locks)
+        return machine
+
+    @staticmethod
+    def forget_update():
+        """Forget this thread's machine once its update is handled, so it doesn't keep the update and its data alive."""
+        _context.machine = None
+
+    @classmethod
+    def for_session(cls, bot, user_id, info, chat_id=None):
+        """Create a machine for a user's state outside of any update, such as for a broadcast.
+
+        It acts as if the user sent an empty message to the chat, by default their private chat.
+        The state is changed in place, and isn't stored anywhere, so that's left to the caller.
+        """
+        if chat_id is None:
+            chat_id = user_id
+        chat_type = telegram.Chat.PRIVATE if chat_id == user_id else telegram.Chat.GROUP
+        message = telegram.Message(0, telegram.User(user_id, "", False), datetime.utcnow(),
+                                   telegram.Chat(chat_id, chat_type), bot=bot)
+        return cls(bot, telegram.Update(0, message=message), {"MachineInfo": info})
 
     def clear(self):
         """Clear out all conversation state."""
-        self.info = self.user_data["MachineInfo"] = _MachineInfo()
+        if self.storage:
+            self.info = _MachineInfo()
+            self._changed()
+        else:
+            self.info = self.user_data["MachineInfo"] = _MachineInfo()
+
+    def restore(self, info):
+        """Replace all conversation state, such as with an earlier copy of it."""
+        self.info = info
+        if self.storage:
+            self._changed()
+        else:
+            self.user_data["MachineInfo"] = info
+
+    def _changed(self):
+        """Notify the storage, if any, that the state has changed."""
+        if self.storage:
+            self.storage.save(self.user_id(), self.info)
 
     # debugging
 
@@ -109,7 +419,8 @@ class Machine():
         if data is None:
             data = {}
         self.info.debug_mode = True
-        self.info.debug_data.update(data)
+        self.info.update_debug_data(data)
+        self._changed()
 
     def log_state(self):
         """Log the state for debugging purposes."""
@@ -123,36 +434,45 @@ class Machine():
             return None
         return self.info.breadcrumb[-1]
 
-    def get_data(self):
-        """Get a summary of stored data as a dictionary.
+    def get_previous_state(self):
+        """Get the state before the current one, which ascending would return to, or None."""
+        if len(self.info.breadcrumb) < 2:
+            return None
+        return self.info.breadcrumb[-2]
+
+    def get_data(self, snapshot=False):
+        """Get a summary of stored data as a mapping.
 
-        The dictionary is populated from the stack, where newer values override older ones.
+        The mapping is populated from the stack, where newer values override older ones.
         Basic data like the user_id is populated first, so they can be overridden if needed.
         Debug data, if present, is populated after that.
+
+        By default this is a view that doesn't copy the stored data, and changes to it are discarded.
+        Pass snapshot to get an independent dictionary instead.
         """
-        data = {
-            "user_id": self.update.effective_user.id,
+        basic_data = {
+            "user_id": self.user_id(),
             "date": self.update.effective_message.date,
         }
-        data.update(self.info.debug_data)
-        for stack_data in self.info.stack:
-            data.update(stack_data)
+        data = ChainMap({}, self.info.merged(), basic_data)
+        if snapshot:
+            return dict(data)
         return data
 
     # write stack
 
     def descend(self, state):
         """Navigate to a new state."""
-        self.info.breadcrumb.append(state)
-        self.info.stack.append({})
+        self.info.push_frame(state)
+        self._changed()
         logger.debug("Breadcrumb: %s", self.info.breadcrumb)
 
     def ascend(self):
         """Navigate to the previous state."""
-        self.info.stack.pop()
-        self.info.stack.pop()
-        self.info.breadcrumb.pop()
-        return self.info.breadcrumb.pop()
+        self.info.pop_frame()
+        state = self.info.pop_frame()
+        self._changed()
+        return state
 
     def can_ascend(self):
         """Check if there is a previous state to navigate to."""
@@ -160,8 +480,8 @@ class Machine():
 
     def ascend_all(self):
         """Navigate all the way up to have no-state, as if freshly initialized."""
-        self.info.breadcrumb.clear()
-        self.info.stack.clear()
+        self.info.clear_frames()
+        self._changed()
 
     def save(self, key, value):
         """Save some data to the current state's memory.
@@ -169,41 +489,90 @@ class Machine():
         Note that this data is persisted as you descend,
         but is lost if you ascend above this state.
         """
-        self.info.stack[-1][key] = value
+        self.info.set_value(key, value)
+        self._changed()
 
     # reply
 
     def reply(self, text):
         """Send a message."""
         if text:
-            self.bot.send_message(chat_id=self.chat_id(), text=text)
-            self.info.keyboard_stale = True
-
-    def send_keyboard(self, title, menu_options, options=None):
+            chat_id = self.chat_id()
+            if self.sender:
+                self.sender.submit(chat_id, lambda: self.bot.send_message(chat_id=chat_id, text=text))
+            else:
+                self.bot.send_message(chat_id=chat_id, text=text)
+            self.info.replied()
+            self._changed()
+
+    def send_keyboard(self, title, menu_options, options=None, reply_markup=None, page_size=None, page=0): # pylint: disable=too-many-arguments
         """Send an inline keyboard with commands.
 
         This will edit the last-sent keyboard if it's the most recent message in the chat,
         otherwise it will delete the previous keyboard and send a new one.
+
+        The keyboard can be precompiled with create_keyboard and passed as reply_markup,
+        otherwise it's looked up in a cache of recently used keyboards.
+        Either way, the options are kept in a cache shared by all users so callback data from
+        the keyboard can be decoded. If they're dropped from it, such as after a restart,
+        they're rebuilt with rebuild_options.
+
+        With a page_size, options can be any iterable (such as a generator) and only the given page
+        of it is read and shown, with buttons for the previous and next pages. See get_page.
         """
-        # format keyboard
+        if page_size:
+            visible = tuple(islice(options or (), page * page_size, (page + 1) * page_size + 1))
+            has_next = len(visible) > page_size
+            options = visible[:page_size]
+            if page or has_next:
+                title = "{} (page {})".format(title, page + 1)
+                menu_options = _page_commands(page, has_next) + tuple(menu_options)
         text = "{}:".format(title)
-        keyboard = _grouper(options, 3)
-        keyboard.append([option for option in menu_options])
-        # convert to inline keyboard
-        buttons = [[telegram.InlineKeyboardButton(col, callback_data=col)
-                    for col in row]
-                   for row in keyboard]
-        reply_markup = telegram.InlineKeyboardMarkup(buttons)
+        options = tuple(options or ())
+        if reply_markup is None:
+            reply_markup = _cached_keyboard(tuple(menu_options), options)
+        version = _options_version(options)
+        _remember_options(version, options)
+        page = page if page_size and page else None
+        # whether to replace the keyboard is decided now, since replies sent after this one make it stale again
+        stale = self.info.keyboard_stale
+        if version != self.info.keyboard_version or page != self.info.keyboard_page or stale:
+            self.info.keyboard_version = version
+            self.info.keyboard_page = page
+            self.info.keyboard_stale = False
+            self._changed()
+        if self.sender:
+            # replacing a stale keyboard is delayed, so the user sees the replies before it, in the background
+            delay = KEYBOARD_DELAY_SECONDS if stale else 0
+            self.sender.submit(self.chat_id(), lambda: self._show_deferred_keyboard(text, reply_markup, stale), delay)
+        else:
+            self._show_keyboard(text, reply_markup, stale)
+
+    def _show_deferred_keyboard(self, text, reply_markup, stale):
+        """Show a keyboard from the sender's thread, holding the user's lock so it's in turn with their updates."""
+        if self.locks is None:
+            self._show_keyboard(text, reply_markup, stale)
+            return
+        with self.locks.hold(self.user_id()):
+            self._show_keyboard(text, reply_markup, stale)
+
+    def _show_keyboard(self, text, reply_markup, stale):
+        """Edit the last-sent keyboard, or replace it if it's stale or can't be edited.
+
+        Edits that wouldn't change the keyboard are skipped, and if only its buttons changed,
+        only they are edited.
+        """
         # ignore keyboards sent too long ago to edit or delete
         if self.info.keyboard_id:
             keyboard_age = datetime.utcnow() - self.info.keyboard_date
             if keyboard_age > KEYBOARD_LIFETIME:
                 self.info.keyboard_id = None
         # remove stale keyboard
-        if self.info.keyboard_id and self.info.keyboard_stale:
-            time.sleep(KEYBOARD_DELAY_SECONDS)
+        if self.info.keyboard_id and stale:
             self.bot.delete_message(chat_id=self.chat_id(), message_id=self.info.keyboard_id)
             self.info.keyboard_id = None
+        # the text's fingerprint in the high bits and the markup's in the low bits, to fit in one int
+        render = _fingerprint(text) << 32 | _fingerprint(reply_markup)
         # send
         if not self.info.keyboard_id:
             message = self.bot.send_message(chat_id=self.chat_id(),
@@ -211,17 +580,40 @@ class Machine():
                                             reply_markup=reply_markup)
             self.info.keyboard_id = message.message_id
             self.info.keyboard_date = datetime.utcnow()
-            self.info.keyboard_stale = False
+            self.info.keyboard_render = render
+            # only kept for group chats, since a private chat's id is the user's
+            self.info.keyboard_chat = self.chat_id() if self.chat_id() != self.user_id() else None
+            self._changed()
             return
         # edit
+        last_render = self.info.keyboard_render
+        if render == last_render:
+            return
         try:
-            self.bot.edit_message_text(chat_id=self.chat_id(),
-                                       message_id=self.info.keyboard_id,
-                                       text=text,
-                                       reply_markup=reply_markup)
+            if last_render is not None and render >> 32 == last_render >> 32:
+                self.bot.edit_message_reply_markup(chat_id=self.chat_id(),
+                                                   message_id=self.info.keyboard_id,
+                                                   reply_markup=reply_markup)
+            else:
+                self.bot.edit_message_text(chat_id=self.chat_id(),
+                                           message_id=self.info.keyboard_id,
+                                           text=text,
+                                           reply_markup=reply_markup)
         except telegram.error.BadRequest as ex:
             if "Message is not modified" not in str(ex):
                 raise
+        self.info.keyboard_render = render
+        self._changed()
+
+    def shown_options(self, options, page_size=None):
+        """Get the options the user's latest keyboard shows out of a menu's options, such as for Transition.get_options.
+
+        With a page_size, that's the page of them the keyboard was on.
+        """
+        if page_size:
+            page = self.info.keyboard_page or 0
+            return tuple(islice(options or (), page * page_size, (page + 1) * page_size))
+        return tuple(options or ())
 
     def end_callback(self):
         """Complete a callback query.
@@ -232,35 +624,173 @@ class Machine():
         if self.update.callback_query:
             self.bot.answerCallbackQuery(callback_query_id=self.update.callback_query.id)
         else:
-            self.info.keyboard_stale = True
+            self.info.replied()
+            self._changed()
 
     # message info
 
     def get_message(self):
         """Get the message sent by the user.
 
-        If the trigger for this update was a callback query, instead return the data from that.
+        If the trigger for this update was a callback query, instead return the option that was chosen.
+        That's None if it came from an outdated keyboard, see is_stale_callback.
         """
-        if self.update.message:
-            return self.update.message.text
-        if self.update.callback_query:
-            return self.update.callback_query.data
+        if self._message is None:
+            if self.update.message:
+                self._message = self.update.message.text
+            elif self.update.callback_query:
+                self._message = self._decode(self.update.callback_query.data)
+        return self._message
+
+    def get_page(self):
+        """Get the page a previous or next page button asks for, or None if this update isn't one."""
+        message = self.get_message()
+        if message and message[0] in (PREV_EMOJI, NEXT_EMOJI) and message[1:].isdigit():
+            return int(message[1:])
         return None
 
+    def is_stale_callback(self):
+        """Check if this update is a button press on a keyboard that no longer matches the menu."""
+        self.get_message()
+        return self._stale_callback
+
+    def _decode(self, data):
+        """Get the option a button's callback data refers to."""
+        rebuild = (lambda: self.rebuild_options(self)) if self.rebuild_options else None
+        option = button_label(data, self.info, rebuild)
+        if option is None:
+            logger.debug("Stale callback data '%s' for keyboard version %s.", data, self.info.keyboard_version)
+            self._stale_callback = True
+        return option
+
     def user_id(self):
         """Get the user id."""
-        return self.update.effective_user.id
+        if self._user_id is None:
+            self._user_id = self.update.effective_user.id
+        return self._user_id
 
     def chat_id(self):
         """Get the chat id."""
-        return self.update.effective_chat.id
+        if self._chat_id is None:
+            self._chat_id = self.update.effective_chat.id
+        return self._chat_id
 
     def user_name(self):
         """Get the user's full name."""
         return self.update.effective_user.full_name
 
+def create_keyboard(menu_options, options=None):
+    """Create the reply markup for an inline keyboard with commands, serialized so it can be reused.
+
+    Options are sent as short tokens of the menu's version and the option's index,
+    so labels aren't limited by the size of callback data. Commands are sent as is,
+    or can be given as (text, callback data) pairs.
+    """
+    options = tuple(options or ())
+    version = _options_version(options)
+    # format keyboard
+    keyboard = _grouper([(option, "#{}:{:x}".format(version, index)) for index, option in enumerate(options)], 3)
+    keyboard.append([option if isinstance(option, tuple) else (option, option) for option in menu_options])
+    # convert to inline keyboard
+    buttons = [[telegram.InlineKeyboardButton(text, callback_data=data)
+                for text, data in row]
+               for row in keyboard]
+    return telegram.InlineKeyboardMarkup(buttons).to_json()
+
+def button_label(data, info, rebuild=None):
+    """Get the option a button's callback data refers to, decoded against a user's conversation state.
+
+    Commands are returned as is, and None is returned for options from any keyboard but the user's latest.
+    If that keyboard's options aren't cached, rebuild is called to get them, if given,
+    and they're only used if their version still matches.
+    """
+    match = _TOKEN.match(data)
+    if not match:
+        # commands, and keyboards sent before options were encoded
+        return data
+    if info is None or match.group(1) != info.keyboard_version:
+        return None
+    options = _recall_options(info.keyboard_version)
+    if options is None and rebuild:
+        options = tuple(rebuild() or ())
+        if _options_version(options) != info.keyboard_version:
+            return None
+        _remember_options(info.keyboard_version, options)
+    index = int(match.group(2), 16)
+    return options[index] if options is not None and index < len(options) else None
+
+def set_options_cache_size(size):
+    """Set how many keyboards' options are cached to decode button presses, shared by all users."""
+    global OPTIONS_CACHE_SIZE # pylint: disable=global-statement
+    OPTIONS_CACHE_SIZE = size
+    with _keyboard_options_lock:
+        while len(_keyboard_options) > OPTIONS_CACHE_SIZE:
+            _keyboard_options.popitem(last=False)
+
 # helper
 
+_cached_keyboard = lru_cache(maxsize=KEYBOARD_CACHE_SIZE)(create_keyboard)
+
+# versions were 8 digits before they were 16
+_TOKEN = re.compile(r"#([0-9a-f]{8}(?:[0-9a-f]{8})?):([0-9a-f]+)$")
+
+_keyboard_options = OrderedDict()
+
+_keyboard_options_lock = threading.Lock()
+
+def _remember_options(version, options):
+    """Cache the options of a keyboard by its version, keeping only the most recently used."""
+    with _keyboard_options_lock:
+        _keyboard_options[version] = options
+        _keyboard_options.move_to_end(version)
+        while len(_keyboard_options) > OPTIONS_CACHE_SIZE:
+            _keyboard_options.popitem(last=False)
+
+def _recall_options(version):
+    """Get the cached options of a keyboard by its version, or None if they aren't cached."""
+    with _keyboard_options_lock:
+        options = _keyboard_options.get(version)
+        if options is not None:
+            _keyboard_options.move_to_end(version)
+        return options
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _options_version(options):
+    """Get a short version for a tuple of options, which changes when they do.
+
+    It's 64 bits, so different options sharing a version, and decoding to each other's options, is unlikely.
+    """
+    text = "\x1f".join(str(option) for option in options).encode("utf-8")
+    return hashlib.blake2b(text, digest_size=8).hexdigest()
+
+def _fingerprint(content):
+    """Get a short fingerprint of a keyboard's text or markup, to tell if it needs editing."""
+    if not isinstance(content, str):
+        content = content.to_json() if hasattr(content, "to_json") else json.dumps(content)
+    return _crc32(content)
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _crc32(text):
+    """Get the crc32 of some text."""
+    return zlib.crc32(text.encode("utf-8"))
+
+def _intern_state(state):
+    """Get the canonical instance of a state, so equal states share memory.
+
+    Only string states are interned, since other kinds (like Enum members) are usually canonical already.
+    They're interned with sys.intern, which releases them once nothing refers to them.
+    """
+    return sys.intern(state) if type(state) is str else state # pylint: disable=unidiomatic-typecheck
+
+def _page_commands(page, has_next):
+    """Get the buttons for moving to the previous and next pages, as (text, callback data) pairs."""
+    commands = ()
+    if page:
+        commands += ((PREV_EMOJI, "{}{}".format(PREV_EMOJI, page - 1)),)
+    if has_next:
+        commands += ((NEXT_EMOJI, "{}{}".format(NEXT_EMOJI, page + 1)),)
+    return commands
+
 def _grouper(iterable, group_count):
     """Groups a list into a list of lists with a max length of group_count each."""
     results = []
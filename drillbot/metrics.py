@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains instrumentation for measuring where a bot spends its time."""
+
+import bisect
+import logging
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+MAX_LABEL_VALUES = 200
+
+OTHER_LABEL_VALUE = "other"
+
+INSTRUMENTED_METHODS = [
+    "send_message",
+    "edit_message_text",
+    "edit_message_reply_markup",
+    "delete_message",
+    "answer_callback_query",
+]
+
+class MetricsSink():
+    """This is a base class for metrics sinks, which by default discards everything.
+
+    Subclass it to forward metrics elsewhere. Labels are passed as keyword arguments.
+    """
+
+    def observe(self, name, value, **labels):
+        """Record a value, such as a latency in seconds, in a histogram."""
+
+    def increment(self, name, amount=1, **labels):
+        """Increase a counter."""
+
+class PrometheusMetrics(MetricsSink):
+    """This class keeps metrics in memory and exports them in the Prometheus text format.
+
+    To keep the number of series bounded, each label of a metric takes at most max_label_values
+    distinct values, such as state names; later values are recorded as "other".
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, max_label_values=MAX_LABEL_VALUES):
+        """Initialize the sink with histogram bucket bounds, in seconds."""
+        self.buckets = tuple(sorted(buckets))
+        self.max_label_values = max_label_values
+        self._histograms = {}
+        self._counters = {}
+        self._label_values = {}
+        self._lock = Lock()
+
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram."""
+        with self._lock:
+            key = self._key(name, labels)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+
+    def increment(self, name, amount=1, **labels):
+        """Increase a counter."""
+        with self._lock:
+            key = self._key(name, labels)
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def export(self):
+        """Get all metrics in the Prometheus text format."""
+        with self._lock:
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+            counters = dict(self._counters)
+        lines = []
+        for name in sorted({name for name, _ in histograms}):
+            lines.append("# TYPE {} histogram".format(name))
+            for (key_name, labels), histogram in sorted(histograms.items(), key=_sort_key):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), histogram):
+                    cumulative += count
+                    bound_label = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append("{}_bucket{} {}".format(
+                        name, _format_labels(labels + (("le", bound_label),)), cumulative))
+                lines.append("{}_sum{} {}".format(name, _format_labels(labels), histogram[-1]))
+                lines.append("{}_count{} {}".format(name, _format_labels(labels), cumulative))
+        for name in sorted({name for name, _ in counters}):
+            lines.append("# TYPE {} counter".format(name))
+            for (key_name, labels), value in sorted(counters.items(), key=_sort_key):
+                if key_name == name:
+                    lines.append("{}{} {}".format(name, _format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host=""):
+        """Serve the metrics over HTTP from a background thread, for Prometheus to scrape."""
+        metrics = self
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self): # pylint: disable=invalid-name
+                """Respond with the exported metrics."""
+                body = metrics.export().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args): # pylint: disable=redefined-builtin
+                """Log requests at debug level instead of to stderr."""
+                logger.debug(format, *args)
+        server = HTTPServer((host, port), _Handler)
+        Thread(target=server.serve_forever, name="PrometheusMetrics", daemon=True).start()
+        return server
+
+    def _key(self, name, labels):
+        """Get the key of a series, bucketing label values past the cap into "other". Call with the lock held."""
+        bounded = []
+        for label, value in sorted(labels.items()):
+            seen = self._label_values.setdefault((name, label), set())
+            if value not in seen:
+                if len(seen) >= self.max_label_values:
+                    value = OTHER_LABEL_VALUE
+                else:
+                    seen.add(value)
+            bounded.append((label, value))
+        return name, tuple(bounded)
+
+def percentile(values, fraction):
+    """Get a percentile of sorted values, such as latencies, or 0.0 if there are none."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class InstrumentedBot():
+    """This class wraps a bot to count and time its Telegram API calls by method."""
+
+    def __init__(self, bot, metrics):
+        """Initialize the wrapper for a bot."""
+        self.bot = bot
+        self.metrics = metrics
+        for method in INSTRUMENTED_METHODS:
+            setattr(self, method, self._instrument(method, getattr(bot, method)))
+        self.answerCallbackQuery = self.answer_callback_query # pylint: disable=invalid-name
+
+    def __getattr__(self, name):
+        """Pass through any other attribute of the bot."""
+        return getattr(self.bot, name)
+
+    def _instrument(self, method, func):
+        """Wrap a bot method to record its latency and errors."""
+        def instrumented(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                self.metrics.increment("drillbot_telegram_errors_total", method=method)
+                raise
+            finally:
+                self.metrics.observe("drillbot_telegram_seconds", time.perf_counter() - start, method=method)
+        return instrumented
+
+# helper
+
+def _sort_key(item):
+    """Sort metrics by name and labels."""
+    (name, labels), _ = item
+    return name, [(key, str(value)) for key, value in labels]
+
+def _format_labels(labels):
+    """Format labels for the Prometheus text format."""
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, _escape(value)) for key, value in labels) + "}"
+
+def _escape(value):
+    """Escape a label value."""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
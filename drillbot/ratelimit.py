@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains an outbound rate limiter for Telegram API calls."""
+
+import heapq
+import logging
+import time
+from concurrent.futures import Future
+from threading import Condition, Event, Thread
+
+import telegram
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_CALLBACK = 0
+PRIORITY_MESSAGE = 1
+
+MAX_RETRIES = 3
+
+class TokenBucket():
+    """This class is a token bucket that hands out reservations."""
+
+    def __init__(self, rate, burst):
+        """Initialize a full bucket that refills at rate tokens per second."""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def reserve(self, now):
+        """Take a token, returning the time at which it can be used."""
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return now
+        return now - self.tokens / self.rate
+
+    def is_idle(self, now):
+        """Check if the bucket would be full by now, so it can be discarded."""
+        return self.tokens + (now - self.last) * self.rate >= self.burst
+
+class OutboundQueue(): # pylint: disable=too-many-instance-attributes
+    """This class schedules Telegram API calls within per-chat and global flood limits.
+
+    Calls for a chat are reserved from that chat's bucket in the order they're submitted,
+    then released by a single scheduler thread once the global bucket allows. Each call is
+    made by the thread that submitted it, so slow calls don't hold up the others.
+    Callback answers don't count against a chat and skip ahead of other ready calls,
+    and a pending edit of a message is updated in place by later edits to it.
+    """
+
+    def __init__(self, per_chat_rate=1.0, group_rate=20 / 60, global_rate=30.0, burst=3):
+        """Initialize the queue with limits in calls per second, and start its scheduler.
+
+        Groups (chats with negative ids) are limited by group_rate instead of per_chat_rate.
+        """
+        self.per_chat_rate = per_chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._delayed = []
+        self._ready = []
+        self._pending = {}
+        self._counter = 0
+        self._condition = Condition()
+        self._running = True
+        self._stats = {
+            "submitted": 0,
+            "sent": 0,
+            "coalesced": 0,
+            "retried": 0,
+            "failed": 0,
+            "max_queue_depth": 0,
+            "total_wait": 0.0,
+            "max_wait": 0.0,
+        }
+        self._thread = Thread(target=self._run, name="OutboundQueue", daemon=True)
+        self._thread.start()
+
+    def call(self, func, kwargs, chat_id=None, priority=PRIORITY_MESSAGE, coalesce_key=None, merge=None): # pylint: disable=too-many-arguments
+        """Make a call once the flood limits allow it, returning its result.
+
+        The call is made on this thread. If it's merged into a pending call with the same coalesce_key,
+        that call's result is returned, and if it hits a flood limit, it's queued again to be retried
+        once the limit has passed. By default a merged call replaces the pending one, otherwise
+        merge is called with the pending call's func and kwargs and this one's, and returns the ones to make.
+        """
+        item, merged = self._submit(func, kwargs, chat_id, priority, coalesce_key, merge)
+        if item is None:
+            # stopped, so there's no scheduler to wait for
+            return func(**kwargs)
+        if merged:
+            return item.future.result()
+        wait = None
+        for attempt in range(MAX_RETRIES + 1):
+            item.released.wait()
+            if wait is None:
+                wait = time.monotonic() - item.submitted
+            try:
+                result = item.func(**item.kwargs)
+            except telegram.error.RetryAfter as ex:
+                if attempt == MAX_RETRIES:
+                    self._finish(item, wait, exception=ex)
+                    raise
+                logger.warning("Flood limit reached, retrying after %s seconds.", ex.retry_after)
+                self._retry(item, ex.retry_after)
+            except BaseException as ex:
+                self._finish(item, wait, exception=ex)
+                raise
+            else:
+                self._finish(item, wait, result=result)
+                return result
+
+    def _submit(self, func, kwargs, chat_id, priority, coalesce_key, merge): # pylint: disable=too-many-arguments
+        """Queue a call, returning it and whether it was merged into a pending one, or None if stopped."""
+        with self._condition:
+            if not self._running:
+                return None, False
+            self._stats["submitted"] += 1
+            if coalesce_key is not None and coalesce_key in self._pending:
+                item = self._pending[coalesce_key]
+                if merge:
+                    func, kwargs = merge(item.func, item.kwargs, func, kwargs)
+                item.func = func
+                item.kwargs = kwargs
+                self._stats["coalesced"] += 1
+                return item, True
+            now = time.monotonic()
+            self._counter += 1
+            item = _Call(func, kwargs, priority, self._counter, now, coalesce_key)
+            if coalesce_key is not None:
+                self._pending[coalesce_key] = item
+            ready_time = self._reserve(chat_id, now) if chat_id is not None else now
+            heapq.heappush(self._delayed, (ready_time, item.seq, item))
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._depth())
+            self._condition.notify()
+            return item, False
+
+    def stats(self):
+        """Get metrics about the queue, including its depth and the time calls spent waiting."""
+        with self._condition:
+            stats = dict(self._stats)
+            stats["queue_depth"] = self._depth()
+        started = stats["sent"] + stats["failed"]
+        stats["mean_wait"] = stats["total_wait"] / started if started else 0.0
+        return stats
+
+    def stop(self):
+        """Stop the scheduler, after releasing any calls that are already queued.
+
+        Calls made after this aren't limited.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def _reserve(self, chat_id, now):
+        """Reserve a token from a chat's bucket, returning when it can be used."""
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {key: value for key, value in self._chats.items()
+                               if not value.is_idle(now)}
+            # groups have negative ids, and channels may be given by @username
+            rate = self.group_rate if isinstance(chat_id, str) or chat_id < 0 else self.per_chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.burst)
+        return bucket.reserve(now)
+
+    def _depth(self):
+        """Get the number of queued calls."""
+        return len(self._delayed) + len(self._ready)
+
+    def _next(self):
+        """Wait for the next call that's ready to run, or None when stopped and empty."""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, _, item = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (item.priority, item.seq, item))
+                if self._ready:
+                    _, _, item = heapq.heappop(self._ready)
+                    if item.coalesce_key is not None:
+                        del self._pending[item.coalesce_key]
+                    return item
+                if self._delayed:
+                    self._condition.wait(self._delayed[0][0] - now)
+                elif self._running:
+                    self._condition.wait()
+                else:
+                    return None
+
+    def _run(self):
+        """Release calls to their callers as they become ready, within the global limit."""
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            delay = self._global.reserve(time.monotonic()) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            item.released.set()
+
+    def _retry(self, item, delay):
+        """Queue a call again after it hit a flood limit, to be released once delay seconds have passed."""
+        with self._condition:
+            self._stats["retried"] += 1
+            if self._running:
+                item.released.clear()
+                heapq.heappush(self._delayed, (time.monotonic() + delay, item.seq, item))
+                self._condition.notify()
+                return
+        # stopped, so there's no scheduler to release it
+        time.sleep(delay)
+
+    def _finish(self, item, wait, result=None, exception=None):
+        """Record a completed call and resolve its future."""
+        with self._condition:
+            self._stats["failed" if exception else "sent"] += 1
+            self._stats["total_wait"] += wait
+            self._stats["max_wait"] = max(self._stats["max_wait"], wait)
+        if exception:
+            item.future.set_exception(exception)
+        else:
+            item.future.set_result(result)
+
+class ThrottledBot():
+    """This class wraps a bot so its calls go through an OutboundQueue.
+
+    Calls still block until they're made, so results and errors are returned as usual.
+    Methods that aren't throttled are passed through to the bot.
+    """
+
+    def __init__(self, bot, queue):
+        """Initialize the wrapper for a bot."""
+        self.bot = bot
+        self.queue = queue
+
+    def __getattr__(self, name):
+        """Pass through any other attribute of the bot."""
+        return getattr(self.bot, name)
+
+    def send_message(self, chat_id, text, **kwargs):
+        """Send a message."""
+        kwargs.update(chat_id=chat_id, text=text)
+        return self.queue.call(self.bot.send_message, kwargs, chat_id=chat_id)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        """Edit a message, replacing any pending edit of the same message."""
+        kwargs.update(text=text, chat_id=chat_id, message_id=message_id)
+        return self.queue.call(self.bot.edit_message_text, kwargs, chat_id=chat_id,
+                               coalesce_key=("edit", chat_id, message_id), merge=self._merge_edits)
+
+    def edit_message_reply_markup(self, chat_id=None, message_id=None, **kwargs):
+        """Edit a message's keyboard, merged with any pending edit of the same message."""
+        kwargs.update(chat_id=chat_id, message_id=message_id)
+        return self.queue.call(self.bot.edit_message_reply_markup, kwargs, chat_id=chat_id,
+                               coalesce_key=("edit", chat_id, message_id), merge=self._merge_edits)
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        """Delete a message."""
+        kwargs.update(chat_id=chat_id, message_id=message_id)
+        return self.queue.call(self.bot.delete_message, kwargs, chat_id=chat_id)
+
+    def answer_callback_query(self, callback_query_id, **kwargs):
+        """Answer a callback query, ahead of other calls."""
+        kwargs.update(callback_query_id=callback_query_id)
+        return self.queue.call(self.bot.answer_callback_query, kwargs,
+                               priority=PRIORITY_CALLBACK)
+
+    answerCallbackQuery = answer_callback_query
+
+    def _merge_edits(self, pending_func, pending_kwargs, func, kwargs):
+        """Merge an edit into a pending edit of the same message, so the message ends up as the latest edit left it.
+
+        A keyboard edit keeps a pending text edit's text, while a text edit replaces whatever is pending.
+        """
+        if func == self.bot.edit_message_reply_markup and pending_func == self.bot.edit_message_text:
+            return pending_func, dict(pending_kwargs, reply_markup=kwargs.get("reply_markup"))
+        return func, kwargs
+
+class _Call(): # pylint: disable=too-few-public-methods
+    """An internal class for a queued call."""
+
+    def __init__(self, func, kwargs, priority, seq, submitted, coalesce_key): # pylint: disable=too-many-arguments
+        """Initialize the call with a future for its result, for any calls merged into it."""
+        self.func = func
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.submitted = submitted
+        self.coalesce_key = coalesce_key
+        self.future = Future()
+        self.released = Event()
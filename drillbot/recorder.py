@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains a recorder that captures a bot's incoming updates for replaying offline.
+
+Each update is written as one line of JSON, like:
+
+    {"t":1700000000.123,"u":48151623,"m":"/start"}
+    {"t":1700000001.456,"u":48151623,"b":"Lights"}
+
+where t is when it arrived, u is a pseudonym for the user (and c for the chat, if it's not the same),
+m is a message's text and b is the label of a pressed button (or d, its callback data, if the label
+wasn't known). See replay.py for feeding a recording back into a bot.
+"""
+
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+class UpdateRecorder():
+    """This class appends anonymized updates to a file, gzipped if its name ends with .gz.
+
+    User and chat ids are replaced with pseudonyms from a keyed hash, and names aren't recorded.
+    Unless keep_text is set, the text of messages is replaced with a hash too, except for commands,
+    which keep their name but not their arguments. Button labels are kept, since they come from the bot.
+
+    Pseudonyms are only consistent across recordings that share a salt, which is random by default.
+    """
+
+    def __init__(self, path, salt=None, keep_text=False, labels=None):
+        """Initialize the recorder, opening the file for appending.
+
+        labels, if given, is called with a button press's update and returns the pressed button's label,
+        or None if it isn't known. Otherwise, and for unknown labels, the callback data is recorded.
+        """
+        self.path = path
+        self.salt = salt.encode("utf-8") if isinstance(salt, str) else (salt or os.urandom(16))
+        self.keep_text = keep_text
+        self.labels = labels
+        self.recorded = 0
+        if path.endswith(".gz"):
+            self._file = gzip.open(path, "at", encoding="utf-8")
+        else:
+            self._file = open(path, "a", encoding="utf-8", buffering=1)
+        self._lock = Lock()
+
+    def record(self, bot, update): # pylint: disable=unused-argument
+        """Record an update, if it's a message or a button press. Can be used as a handler callback."""
+        entry = self.entry(update)
+        if entry is None:
+            return
+        line = json.dumps(entry, separators=(",", ":"), ensure_ascii=False, default=str)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            self._file.write("\n")
+            self.recorded += 1
+
+    def entry(self, update):
+        """Get the anonymized entry for an update, or None if it isn't recorded."""
+        user = update.effective_user
+        chat = update.effective_chat
+        if not user or not chat:
+            return None
+        entry = {"t": round(time.time(), 3), "u": self.pseudonym(user.id)}
+        if chat.id != user.id:
+            entry["c"] = self.pseudonym(chat.id)
+        if update.callback_query and update.callback_query.data:
+            data = update.callback_query.data
+            label = self.labels(update) if self.labels else None
+            if label is None:
+                entry["d"] = data
+            else:
+                entry["b"] = label
+        elif update.message and update.message.text:
+            entry["m"] = self._anonymize_text(update.message.text)
+        else:
+            return None
+        return entry
+
+    def pseudonym(self, value):
+        """Get a stable pseudonym for a user or chat id, as a positive int."""
+        digest = hmac.new(self.salt, str(value).encode("utf-8"), hashlib.sha256).digest()
+        return int.from_bytes(digest[:6], "big")
+
+    def close(self):
+        """Flush and close the file."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        logger.info("Recorded %s updates to %s.", self.recorded, self.path)
+
+    def _anonymize_text(self, text):
+        """Get the text of a message as it's recorded."""
+        if self.keep_text:
+            return text
+        if text.startswith("/"):
+            return text.split(None, 1)[0]
+        digest = hmac.new(self.salt, text.encode("utf-8"), hashlib.sha256).hexdigest()
+        return "text-{}".format(digest[:8])
+
+def read_recording(path):
+    """Read the entries of a recording, in order, skipping any truncated last line."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as recording:
+        number = 0
+        try:
+            for number, line in enumerate(recording, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning("Skipping unreadable line %s of %s.", number, path)
+        except EOFError:
+            # a gzipped recording that wasn't closed, like after a crash
+            logger.warning("Recording %s ends after line %s without being closed.", path, number)
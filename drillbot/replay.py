@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains a tool that replays a recording of updates into a bot offline.
+
+Updates from a recording (see recorder.py) are run through a DrillBot's real handlers
+against a FakeBot, and latency and API calls are reported for the state each update arrived in.
+Run it with `python -m <package>.drillbot.replay --help`.
+"""
+
+import argparse
+import importlib
+import json
+import sys
+import time
+from collections import OrderedDict
+
+from . import machine as machine_module # pylint: disable=relative-beyond-top-level
+from .fake import FakeTelegram # pylint: disable=relative-beyond-top-level
+from .metrics import percentile # pylint: disable=relative-beyond-top-level
+from .recorder import read_recording # pylint: disable=relative-beyond-top-level
+
+def replay(drillbot, entries, speed=None):
+    """Replay recorded entries into a bot, returning a list of results per state, busiest first.
+
+    With a speed, entries are spaced out as they were recorded, sped up by that factor,
+    otherwise they're replayed as fast as possible. Updates are handled one at a time so results
+    are repeatable, so the bot's recorder and concurrency aren't used, and long-running transitions
+    and deferred keyboards are handled synchronously, so each update's work is measured as part of it.
+    The delay before replacing a stale keyboard is disabled, since it's a deliberate wait.
+    """
+    drillbot.recorder = None
+    drillbot.update_executor = None
+    drillbot.background = None
+    drillbot.keyboard_sender = None
+    telegram = FakeTelegram(drillbot)
+    stats = {}
+    delay = machine_module.KEYBOARD_DELAY_SECONDS
+    machine_module.KEYBOARD_DELAY_SECONDS = 0
+    try:
+        first = started = None
+        for entry in entries:
+            if speed:
+                if first is None:
+                    first, started = entry["t"], time.monotonic()
+                wait = (entry["t"] - first) / speed - (time.monotonic() - started)
+                if wait > 0:
+                    time.sleep(wait)
+            update = _create_update(telegram, entry)
+            if update is None:
+                continue
+            state = _current_state(drillbot, update)
+            start = time.perf_counter()
+            telegram.dispatcher.process_update(update)
+            latency = time.perf_counter() - start
+            latencies, calls = stats.setdefault(state, ([], [0]))
+            latencies.append(latency)
+            calls[0] += len(telegram.bot.calls)
+            telegram.bot.calls.clear()
+    finally:
+        machine_module.KEYBOARD_DELAY_SECONDS = delay
+    results = []
+    for state, (latencies, calls) in stats.items():
+        latencies.sort()
+        results.append(OrderedDict([
+            ("state", state),
+            ("updates", len(latencies)),
+            ("total_ms", sum(latencies) * 1000),
+            ("p50_ms", percentile(latencies, 0.50) * 1000),
+            ("p99_ms", percentile(latencies, 0.99) * 1000),
+            ("api_calls_per_update", calls[0] / len(latencies)),
+        ]))
+    results.sort(key=lambda result: result["total_ms"], reverse=True)
+    return results
+
+def load_bot(spec):
+    """Create a bot from a 'module:function' spec, calling the function with no arguments."""
+    module_name, _, function_name = spec.partition(":")
+    if not function_name:
+        raise ValueError("Expected 'module:function', got '{}'.".format(spec))
+    return getattr(importlib.import_module(module_name), function_name)()
+
+def main(argv=None):
+    """Replay a recording from the command line."""
+    parser = argparse.ArgumentParser(description="Replay a recording of updates into a DrillBot offline.")
+    parser.add_argument("recording", help="recording file, gzipped if it ends with .gz")
+    parser.add_argument("--bot", required=True,
+                        help="function that creates the bot, as module:function")
+    parser.add_argument("--speed", type=float,
+                        help="replay at the recorded pace sped up by this factor, instead of as fast as possible")
+    parser.add_argument("--save", help="save results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    results = replay(load_bot(args.bot), read_recording(args.recording), args.speed)
+    for result in results:
+        print("{state}: {updates} updates, {total_ms:.1f} ms total, p50 {p50_ms:.3f} ms, p99 {p99_ms:.3f} ms, "
+              "{api_calls_per_update:.2f} API calls/update".format(**result))
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2, default=str)
+    return 0
+
+# helper
+
+def _create_update(telegram, entry):
+    """Create an update for a recorded entry, or None if it's not one that can be replayed."""
+    chat_id = entry.get("c")
+    if "m" in entry:
+        return telegram.create_update(telegram.message(entry["u"], entry["m"], chat_id))
+    if "b" in entry:
+        # press the button by its label, so recordings still work if the bot's menus change
+        return telegram.create_update(telegram.callback(entry["u"], entry["b"], chat_id))
+    if "d" in entry:
+        return telegram.create_update(telegram.callback(entry["u"], entry["d"], chat_id))
+    return None
+
+def _current_state(drillbot, update):
+    """Get the name of the state a user's conversation is in before an update."""
+    conversation = drillbot._conversation # pylint: disable=protected-access
+    state = conversation.conversations.get(conversation._get_key(update)) # pylint: disable=protected-access
+    if isinstance(state, tuple):
+        # waiting on a long-running transition
+        state = state[0]
+    if state is None:
+        return "(none)"
+    return str(drillbot.graph.states.get(state, state))
+
+if __name__ == "__main__":
+    sys.exit(main())
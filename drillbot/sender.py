@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains a background sender for deferred Telegram operations."""
+
+import heapq
+import logging
+import time
+from threading import Condition, Thread
+
+logger = logging.getLogger(__name__)
+
+class KeyboardSender():
+    """This class runs keyboard replacements and replies off the handler threads.
+
+    Jobs are partitioned across workers by chat id, and jobs for the same chat
+    always run in the order they were submitted, even if an earlier one was delayed.
+    """
+
+    def __init__(self, workers=4):
+        """Initialize the sender with a number of worker threads."""
+        self._workers = [_SenderWorker("KeyboardSender_{}".format(i)) for i in range(workers)]
+
+    def start(self):
+        """Start the worker threads."""
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self):
+        """Stop the worker threads, waiting for pending jobs to finish."""
+        for worker in self._workers:
+            worker.stop()
+        for worker in self._workers:
+            worker.join()
+
+    def submit(self, chat_id, job, delay=0):
+        """Schedule a job for a chat, to be run no sooner than delay seconds from now."""
+        self._workers[hash(chat_id) % len(self._workers)].submit(chat_id, job, delay)
+
+class _SenderWorker(Thread):
+    """An internal worker thread with a queue of scheduled jobs."""
+
+    def __init__(self, name):
+        """Initialize the worker with an empty queue."""
+        super().__init__(name=name, daemon=True)
+        self._condition = Condition()
+        self._queue = []
+        self._counter = 0
+        self._last_due = {}
+        self._running = True
+
+    def submit(self, chat_id, job, delay):
+        """Add a job to the queue, keeping jobs in order for each chat."""
+        with self._condition:
+            due = max(time.monotonic() + delay, self._last_due.get(chat_id, 0))
+            self._last_due[chat_id] = due
+            self._counter += 1
+            heapq.heappush(self._queue, (due, self._counter, chat_id, job))
+            self._condition.notify()
+
+    def stop(self):
+        """Ask the worker to exit once the queue is empty."""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def run(self):
+        """Run jobs as they become due."""
+        while True:
+            with self._condition:
+                while True:
+                    if not self._queue:
+                        if not self._running:
+                            return
+                        self._condition.wait()
+                        continue
+                    due = self._queue[0][0]
+                    remaining = due - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                due, _, chat_id, job = heapq.heappop(self._queue)
+                if self._last_due.get(chat_id) == due:
+                    del self._last_due[chat_id]
+            try:
+                job()
+            except BaseException: # pylint: disable=broad-except
+                logger.exception("Error during deferred send for chat %s.", chat_id)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains a runner that shards a bot across worker processes by user id."""
+
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+from collections import deque
+
+import telegram
+from telegram.ext import Updater
+
+logger = logging.getLogger(__name__)
+
+RESTART = "restart"
+
+POLL_TIMEOUT = 10
+
+OVERFLOW_POLL_TIMEOUT = 1
+
+class ShardedRunner():
+    """This class runs a bot as one polling process feeding several worker processes.
+
+    Each user is always handled by the same worker, so their conversation state stays
+    in that worker's memory and their updates are handled in order. Updates without a user
+    are sharded by chat instead.
+    Workers that die are restarted, and stopping drains the updates already handed out.
+    A shard whose queue is full doesn't hold up the others: its updates are held back in order,
+    up to overflow_size of them, and past that they're dropped and counted in dropped.
+
+    The bot is created by calling create_bot in each worker, so configure storage,
+    rate limits and so on there. Limits apply per worker, so divide global rates by the
+    number of shards. create_bot must be picklable when processes are spawned instead of forked.
+    """
+
+    def __init__(self, token, create_bot, shards=None, queue_size=1000, drain_timeout=30.0, # pylint: disable=too-many-arguments
+                 overflow_size=10000):
+        """Initialize the runner, by default with a shard per CPU."""
+        self.token = token
+        self.create_bot = create_bot
+        self.shards = shards or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.drain_timeout = drain_timeout
+        self.overflow_size = overflow_size
+        self.restarts = 0
+        self.dropped = 0
+        self._context = multiprocessing.get_context()
+        self._queues = []
+        self._overflow = []
+        self._workers = []
+        self._control = None
+        self._running = False
+
+    def start(self):
+        """Start the workers and poll for updates, blocking until stopped."""
+        self._control = self._context.Queue()
+        self._queues = [self._context.Queue(self.queue_size) for _ in range(self.shards)]
+        self._overflow = [deque() for _ in range(self.shards)]
+        self._workers = [self._start_worker(shard) for shard in range(self.shards)]
+        previous_handlers = {sig: signal.signal(sig, self._on_signal) for sig in (signal.SIGINT, signal.SIGTERM)}
+        restart = False
+        try:
+            restart = self._poll(telegram.Bot(self.token))
+        finally:
+            for sig, handler in previous_handlers.items():
+                signal.signal(sig, handler)
+            self._drain()
+        if restart:
+            logger.info("Restarting all shards.")
+            os.execl(sys.executable, sys.executable, *sys.argv)
+
+    def stop(self):
+        """Stop polling, after which the workers are drained."""
+        self._running = False
+
+    def shard_for(self, update):
+        """Get the shard that handles an update, by its user, or its chat if it has no user.
+
+        Conversation state is kept per user, so a user's updates from every chat go to the same shard.
+        """
+        if update.effective_user:
+            key = update.effective_user.id
+        elif update.effective_chat:
+            key = update.effective_chat.id
+        else:
+            key = 0
+        return key % self.shards
+
+    def _poll(self, bot):
+        """Poll for updates and hand them to workers, returning whether a restart was requested."""
+        bot.delete_webhook()
+        offset = None
+        self._running = True
+        while self._running:
+            if self._restart_requested():
+                return True
+            self._check_workers()
+            self._flush_overflow()
+            # while updates are held back, poll briefly so they're queued soon after there's room
+            timeout = OVERFLOW_POLL_TIMEOUT if any(self._overflow) else POLL_TIMEOUT
+            try:
+                updates = bot.get_updates(offset=offset, timeout=timeout)
+            except telegram.error.TimedOut:
+                continue
+            except telegram.error.TelegramError:
+                logger.exception("Error polling for updates.")
+                time.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                self._hand_out(self.shard_for(update), update.to_json())
+        return False
+
+    def _hand_out(self, shard, data):
+        """Queue an update for a shard without waiting, holding it back if the shard's queue is full.
+
+        Held back updates are queued in order once there's room. Past overflow_size of them, the update is dropped.
+        """
+        overflow = self._overflow[shard]
+        if not overflow:
+            try:
+                self._queues[shard].put_nowait(data)
+                return
+            except queue.Full:
+                logger.warning("Shard %s's queue is full, holding back its updates.", shard)
+        if len(overflow) >= self.overflow_size:
+            self.dropped += 1
+            logger.error("Shard %s is too far behind, dropping an update.", shard)
+            return
+        overflow.append(data)
+
+    def _flush_overflow(self):
+        """Queue the held back updates of shards that have room for them."""
+        for shard, overflow in enumerate(self._overflow):
+            while overflow:
+                try:
+                    self._queues[shard].put_nowait(overflow[0])
+                except queue.Full:
+                    break
+                overflow.popleft()
+
+    def _restart_requested(self):
+        """Check if a worker has asked for a restart."""
+        try:
+            return self._control.get_nowait() == RESTART
+        except queue.Empty:
+            return False
+
+    def _check_workers(self):
+        """Restart any workers that have died."""
+        for shard, worker in enumerate(self._workers):
+            if worker.is_alive():
+                continue
+            logger.error("Shard %s exited with code %s, restarting it.", shard, worker.exitcode)
+            self.restarts += 1
+            self._workers[shard] = self._start_worker(shard)
+
+    def _start_worker(self, shard):
+        """Start a worker process for a shard."""
+        worker = self._context.Process(target=_run_worker,
+                                       args=(self.create_bot, shard, self._queues[shard], self._control),
+                                       name="DrillBotShard_{}".format(shard),
+                                       daemon=True)
+        worker.start()
+        return worker
+
+    def _drain(self):
+        """Let the workers finish their queued updates, then stop them."""
+        logger.info("Draining %s shards.", len(self._workers))
+        deadline = time.monotonic() + self.drain_timeout
+        for shard, shard_queue in enumerate(self._queues):
+            overflow = self._overflow[shard]
+            try:
+                while overflow:
+                    shard_queue.put(overflow[0], timeout=max(0, deadline - time.monotonic()))
+                    overflow.popleft()
+                shard_queue.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                # the worker is stuck or dead, so it's terminated below
+                logger.warning("Shard %s's queue is full, it can't be told to stop. Dropping %s held back updates.",
+                               shard, len(overflow))
+                self.dropped += len(overflow)
+                overflow.clear()
+        for shard, worker in enumerate(self._workers):
+            worker.join(max(0, deadline - time.monotonic()))
+            if worker.is_alive():
+                logger.warning("Shard %s didn't drain in time, terminating it.", shard)
+                worker.kill()
+                worker.join()
+
+    def _on_signal(self, signum, frame): # pylint: disable=unused-argument
+        """Stop when interrupted."""
+        logger.info("Received signal %s, stopping.", signum)
+        self.stop()
+
+# helper
+
+def _run_worker(create_bot, shard, updates, control):
+    """Handle a shard's updates in order until given None."""
+    # the runner decides when workers stop, so an interrupt doesn't cut an update short
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    drillbot = create_bot()
+    drillbot.updater = Updater(drillbot.token)
+    drillbot.on_restart = lambda: control.put(RESTART)
+    dispatcher = drillbot.updater.dispatcher
+    drillbot.register_handlers(dispatcher)
+    if drillbot.keyboard_sender:
+        drillbot.keyboard_sender.start()
+    logger.info("Shard %s started.", shard)
+    try:
+        while True:
+            data = updates.get()
+            if data is None:
+                break
+            dispatcher.process_update(telegram.Update.de_json(json.loads(data), dispatcher.bot))
+    finally:
+        drillbot.updater.stop()
+        drillbot._shutdown() # pylint: disable=protected-access
+        logger.info("Shard %s stopped.", shard)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains storage backends for conversation state."""
+
+import logging
+import pickle
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+class Storage(ABC):
+    """This is an abstract base class for conversation state storage.
+
+    A storage maps a key (the user id) to that user's machine state.
+    Loaded states are mutated in place, and save is called after every change,
+    so implementations are free to defer the actual write.
+    """
+
+    @abstractmethod
+    def load(self, key):
+        """Get the state for a key, or None if there isn't one."""
+
+    @abstractmethod
+    def save(self, key, info):
+        """Store the state for a key."""
+
+    def peek(self, key):
+        """Get the state for a key without counting it as use, such as for a broadcast.
+
+        This is the same as load by default, for storages that don't track use.
+        """
+        return self.load(key)
+
+    def save_idle(self, key, info):
+        """Store the state for a key without counting it as use. This is the same as save by default."""
+        self.save(key, info)
+
+    def items(self):
+        """Get (key, state) pairs for all stored states, such as to broadcast to every user.
+
+        Not every storage can list its states, so this raises NotImplementedError by default.
+        """
+        raise NotImplementedError("{} can't list its states.".format(type(self).__name__))
+
+    def flush(self):
+        """Write out any pending changes."""
+
+    def close(self):
+        """Write out any pending changes and release resources."""
+        self.flush()
+
+class SessionStorage(Storage):
+    """This class keeps state in memory, evicting sessions that go idle or exceed a cap.
+
+    Sessions idle for more than idle_timeout seconds, and the least recently used past max_sessions,
+    are evicted the next time the storage is used. Evicted sessions are saved to the spill storage
+    if there is one (such as a SqliteStorage with a small cache_size), and loaded back from it
+    when the user returns; otherwise they're forgotten, and the user starts over.
+    on_evict, if set, is called with the key of each evicted session, outside the storage's lock.
+    """
+
+    def __init__(self, idle_timeout=3600.0, max_sessions=10000, spill=None):
+        """Initialize an empty storage."""
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.spill = spill
+        self.on_evict = None
+        self.evictions = 0
+        self._sessions = OrderedDict()
+        self._lock = Lock()
+
+    def size(self):
+        """Get the number of sessions in memory."""
+        return len(self._sessions)
+
+    def load(self, key):
+        """Get the state for a key, from the spill storage if it was evicted."""
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is not None:
+                evicted = self._put(key, entry[0])
+        if entry is None:
+            info = self.spill.load(key) if self.spill else None
+            if info is None:
+                return None
+            with self._lock:
+                # another thread may have created it in the meantime
+                entry = self._sessions.get(key)
+                if entry is not None:
+                    info = entry[0]
+                evicted = self._put(key, info)
+        else:
+            info = entry[0]
+        self._evicted(evicted)
+        return info
+
+    def save(self, key, info):
+        """Store the state for a key, marking the session as active."""
+        with self._lock:
+            evicted = self._put(key, info)
+        self._evicted(evicted)
+
+    def peek(self, key):
+        """Get the state for a key without refreshing its session, or loading it back if it was evicted."""
+        with self._lock:
+            entry = self._sessions.get(key)
+        if entry is not None:
+            return entry[0]
+        return self.spill.peek(key) if self.spill else None
+
+    def save_idle(self, key, info):
+        """Store the state for a key without refreshing its session, or in the spill storage if it was evicted."""
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is not None:
+                self._sessions[key] = (info, entry[1])
+                return
+        if self.spill:
+            self.spill.save_idle(key, info)
+
+    def items(self):
+        """Get (key, state) pairs for the sessions in memory, then those only in the spill storage."""
+        with self._lock:
+            sessions = [(key, info) for key, (info, _) in self._sessions.items()]
+        yield from sessions
+        if self.spill:
+            keys = {key for key, _ in sessions}
+            for key, info in self.spill.items():
+                if key not in keys:
+                    yield key, info
+
+    def flush(self):
+        """Write out any pending changes in the spill storage."""
+        if self.spill:
+            self.spill.flush()
+
+    def close(self):
+        """Save all sessions to the spill storage, if there is one, and close it."""
+        if not self.spill:
+            return
+        with self._lock:
+            sessions = list(self._sessions.items())
+        for key, (info, _) in sessions:
+            self.spill.save(key, info)
+        self.spill.close()
+
+    def _put(self, key, info):
+        """Add or refresh a session, returning the sessions evicted to make room.
+
+        Must be called while holding the lock.
+        """
+        now = time.monotonic()
+        self._sessions[key] = (info, now)
+        self._sessions.move_to_end(key)
+        evicted = []
+        while self._sessions:
+            oldest_key, (oldest_info, last_used) = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - last_used <= self.idle_timeout:
+                break
+            del self._sessions[oldest_key]
+            evicted.append((oldest_key, oldest_info))
+        self.evictions += len(evicted)
+        return evicted
+
+    def _evicted(self, evicted):
+        """Spill evicted sessions, then notify on_evict of each one.
+
+        This is called after releasing the lock, so on_evict can use the storage,
+        and an on_evict that fails doesn't stop the other sessions from being spilled and notified.
+        """
+        if not evicted:
+            return
+        if self.spill:
+            for key, info in evicted:
+                self.spill.save(key, info)
+        logger.debug("Evicted %s sessions, %s remaining.", len(evicted), len(self._sessions))
+        if not self.on_evict:
+            return
+        for key, _ in evicted:
+            try:
+                self.on_evict(key)
+            except Exception: # pylint: disable=broad-except
+                logger.exception("Error handling evicted session %s.", key)
+
+class SqliteStorage(Storage):
+    """This class stores state in SQLite, with an LRU cache in front of it.
+
+    Writes are batched: changed states are kept in memory and written out
+    by a background thread every flush_interval seconds,
+    or sooner if more than batch_size states are waiting.
+    """
+
+    def __init__(self, path, cache_size=10000, flush_interval=1.0, batch_size=500):
+        """Initialize the storage, creating the database if needed."""
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._lock = Lock()
+        self._db_lock = Lock()
+        self._flush_lock = Lock()
+        self._condition = Condition(self._lock)
+        self._running = True
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS machine_info (key PRIMARY KEY, data BLOB NOT NULL)")
+        self._thread = Thread(target=self._flush_loop, name="SqliteStorage", daemon=True)
+        self._thread.start()
+
+    def load(self, key):
+        """Get the state for a key, from the cache if possible."""
+        with self._lock:
+            info = self._cache.get(key)
+            if info is None:
+                info = self._dirty.get(key)
+            if info is not None:
+                self._cache_put(key, info)
+                return info
+        info = self._read(key)
+        if info is None:
+            return None
+        with self._lock:
+            # another thread may have loaded or created it in the meantime
+            info = self._cache.get(key) or self._dirty.get(key) or info
+            self._cache_put(key, info)
+        return info
+
+    def save(self, key, info):
+        """Mark the state for a key as changed, to be written in the next batch."""
+        with self._lock:
+            self._cache_put(key, info)
+            self._dirty[key] = info
+            if len(self._dirty) >= self.batch_size:
+                self._condition.notify()
+
+    def peek(self, key):
+        """Get the state for a key, without adding it to the cache."""
+        with self._lock:
+            info = self._cache.get(key)
+            if info is None:
+                info = self._dirty.get(key)
+            if info is not None:
+                return info
+        return self._read(key)
+
+    def save_idle(self, key, info):
+        """Mark the state for a key as changed, without moving it up in the cache."""
+        with self._lock:
+            if key in self._cache:
+                self._cache[key] = info
+            self._dirty[key] = info
+            if len(self._dirty) >= self.batch_size:
+                self._condition.notify()
+
+    def items(self):
+        """Get (key, state) pairs for all stored states, reading the database in batches.
+
+        A state that changes while they're being read may be listed twice.
+        """
+        self.flush()
+        rowid = 0
+        while True:
+            with self._db_lock:
+                rows = self._connection.execute(
+                    "SELECT rowid, key, data FROM machine_info WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (rowid, self.batch_size)).fetchall()
+            if not rows:
+                return
+            for rowid, key, data in rows:
+                with self._lock:
+                    info = self._cache.get(key) or self._dirty.get(key)
+                # prefer the loaded state, so changes to it aren't lost
+                yield key, info if info is not None else pickle.loads(data)
+
+    def flush(self):
+        """Write all changed states to the database."""
+        # one flush at a time, so an older batch can't be written over a newer one
+        with self._flush_lock:
+            with self._lock:
+                batch = self._dirty
+                self._dirty = {}
+            rows = []
+            for key, info in batch.items():
+                try:
+                    rows.append((key, pickle.dumps(info, pickle.HIGHEST_PROTOCOL)))
+                except BaseException: # pylint: disable=broad-except
+                    # most likely changed while being serialized, so try again next time
+                    logger.exception("Error serializing state for key %s.", key)
+                    with self._lock:
+                        self._dirty.setdefault(key, info)
+            if not rows:
+                return
+            try:
+                with self._db_lock, self._connection:
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO machine_info (key, data) VALUES (?, ?)", rows)
+            except BaseException:
+                with self._lock:
+                    for key, info in batch.items():
+                        self._dirty.setdefault(key, info)
+                raise
+            logger.debug("Flushed %s states.", len(rows))
+
+    def close(self):
+        """Stop the background thread, write pending changes, and close the database."""
+        with self._lock:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
+        self._connection.close()
+
+    def _read(self, key):
+        """Read the state for a key from the database, or None if there isn't one."""
+        with self._db_lock:
+            row = self._connection.execute(
+                "SELECT data FROM machine_info WHERE key = ?", (key,)).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def _cache_put(self, key, info):
+        """Add a state to the cache, evicting the least recently used states if full.
+
+        Must be called while holding the lock.
+        """
+        self._cache[key] = info
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _flush_loop(self):
+        """Periodically write changed states to the database."""
+        while True:
+            with self._lock:
+                if self._running and len(self._dirty) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+                if not self._running:
+                    return
+            try:
+                self.flush()
+            except BaseException: # pylint: disable=broad-except
+                logger.exception("Error flushing states.")
@@ -5,10 +5,19 @@
 import logging
 from abc import ABC, abstractmethod
 
-from .machine import MachineHandlers, CALL_COMMANDS, BACK  # pylint: disable=relative-beyond-top-level
+from .cache import CachedCallback # pylint: disable=relative-beyond-top-level
+from .machine import MachineHandlers, CALL_COMMANDS, BACK, create_keyboard  # pylint: disable=relative-beyond-top-level
 
 logger = logging.getLogger(__name__)
 
+def long_running(func):
+    """Mark a callback as long-running, so transitions using it are handled in the background.
+
+    This only has an effect if the bot has called configure_long_running.
+    """
+    func.long_running = True
+    return func
+
 class Transition(ABC):
     """This is an abstract base class for all transitions.
 
@@ -23,8 +32,13 @@ class Transition(ABC):
     and the move_from tells us how to interpret the user input.
 
     Optionally, you can also override the handlers the state uses.
+
+    Set long_running for transitions whose move_to or move_from can take a while,
+    so they're run in the background instead of blocking other users.
     """
 
+    long_running = False
+
     @abstractmethod
     def move_to(self, machine):
         """Move to a state. Return false to reject the move."""
@@ -40,6 +54,30 @@ class Transition(ABC):
             MachineHandlers.message_handler(handler_func),
         ]
 
+    def get_targets(self, machine=None): # pylint: disable=no-self-use,unused-argument
+        """Get the states move_from can return, as far as they're known.
+
+        If a machine is given, only the states its current input can lead to.
+        """
+        return ()
+
+    def get_options(self, machine): # pylint: disable=no-self-use,unused-argument
+        """Get the options of the keyboard move_to last sent the user, or None if it doesn't send one.
+
+        They're used to decode the keyboard's buttons when its options are no longer cached,
+        such as after a restart, so transitions that send keyboards with options should override this.
+        """
+        return None
+
+    def invalidate_cache(self, data=None):
+        """Drop the results of this transition's cached callbacks, for some conversation data or all of them.
+
+        Callbacks are cached by wrapping them with cached, from the cache module.
+        """
+        for value in vars(self).values():
+            if isinstance(value, CachedCallback):
+                value.invalidate(data)
+
 class MenuTransition(Transition):
     """This class is a transition that presents a menu with multiple options."""
 
@@ -51,10 +89,13 @@ class MenuTransition(Transition):
             title_func = lambda data: title
         self.options = options
         self.title_func = title_func
+        self.keyboard = create_keyboard(CALL_COMMANDS, self.options)
+        self.long_running = _is_long_running(title_func)
 
     def move_to(self, machine):
         """Send an keyboard menu."""
-        machine.send_keyboard(self.title_func(machine.get_data()), CALL_COMMANDS, self.options)
+        machine.send_keyboard(self.title_func(machine.get_data()), CALL_COMMANDS, self.options,
+                              reply_markup=self.keyboard)
         return True
 
     def move_from(self, machine):
@@ -64,6 +105,16 @@ class MenuTransition(Transition):
             machine.reply("Unrecognized command!")
         return result
 
+    def get_options(self, machine):
+        """Get the options of the menu."""
+        return machine.shown_options(self.options)
+
+    def get_targets(self, machine=None):
+        """Get the states in the menu, or the one selected."""
+        if machine:
+            return (self.options.get(machine.get_message(), None),)
+        return tuple(self.options.values())
+
 class NoTransition(Transition):
     """This class is a non-transition, one that doesn't actually move into the state."""
 
@@ -71,6 +122,7 @@ class NoTransition(Transition):
         """Initialize the non-transition with a reply."""
         super().__init__()
         self.reply = reply
+        self.long_running = _is_long_running(reply)
 
     def move_to(self, machine):
         """Don't actually move the state, instead reply with a message."""
@@ -90,8 +142,14 @@ class SaveTransition(Transition):
             next_state=BACK,
             parse_func=None,
             options_func=None,
-            reply_action=None):
-        """Initialize a save transition."""
+            reply_action=None,
+            page_size=None):
+        """Initialize a save transition.
+
+        With a page_size, options are shown that many at a time, and options_func can return
+        a generator or other lazy iterable, since only the visible page is read from it.
+        It's called again for each page, unless it's cached, in which case it's read in full once.
+        """
         super().__init__()
         if not parse_func:
             parse_func = lambda text: text
@@ -103,14 +161,26 @@ class SaveTransition(Transition):
         self.parse_func = parse_func
         self.options_func = options_func
         self.reply_action = reply_action
+        self.page_size = page_size
+        self.long_running = _is_long_running(parse_func, options_func, reply_action)
 
     def move_to(self, machine):
-        """Send a keyboard with possible options."""
-        machine.send_keyboard(self.message, CALL_COMMANDS, self.options_func(machine.get_data()))
+        """Send a keyboard with possible options, or the page of them that was asked for."""
+        options = self.options_func(machine.get_data())
+        if self.page_size:
+            machine.send_keyboard(self.message, CALL_COMMANDS, options,
+                                  page_size=self.page_size, page=machine.get_page() or 0)
+        else:
+            machine.send_keyboard(self.message, CALL_COMMANDS, options)
         return True
 
     def move_from(self, machine):
-        """Parse and save the reply, either from the keyboard or typed."""
+        """Parse and save the reply, either from the keyboard or typed.
+
+        Page buttons stay in this state, and the keyboard is refreshed with that page.
+        """
+        if self.page_size and machine.get_page() is not None:
+            return None
         try:
             machine.save(self.name, self.parse_func(machine.get_message()))
             if self.reply_action:
@@ -119,3 +189,17 @@ class SaveTransition(Transition):
             machine.reply(str(ex))
             return BACK
         return self.next_state
+
+    def get_options(self, machine):
+        """Get the options on the page the keyboard was on."""
+        return machine.shown_options(self.options_func(machine.get_data()), self.page_size)
+
+    def get_targets(self, machine=None):
+        """Get the next state."""
+        return (self.next_state,)
+
+# helper
+
+def _is_long_running(*funcs):
+    """Check if any of the callbacks are marked as long-running."""
+    return any(getattr(func, "long_running", False) for func in funcs)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains a WSGI app for receiving updates via webhook."""
+
+import hmac
+import json
+import logging
+import re
+import ssl
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+import telegram
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN"
+
+MAX_BODY_SIZE = 1 << 20
+
+HANDSHAKE_TIMEOUT = 10.0
+
+class WebhookApp():
+    """This class is a WSGI app that feeds webhook updates to a dispatcher.
+
+    Mount it in any WSGI server; Telegram should be told to post to url_path.
+    With a secret_token, requests that don't carry it in the X-Telegram-Bot-Api-Secret-Token header
+    are rejected, so only Telegram can post updates. Call close when the server shuts down.
+    Requests whose Content-Length is over max_body_size bytes are rejected before they're read.
+    """
+
+    def __init__(self, bot, update_queue, url_path="/", secret_token=None, on_close=None, # pylint: disable=too-many-arguments
+                 max_body_size=MAX_BODY_SIZE):
+        """Initialize the app for a bot and its dispatcher's update queue.
+
+        on_close, if given, is called once by close, such as to stop the bot.
+        """
+        if not url_path.startswith("/"):
+            url_path = "/" + url_path
+        self.bot = bot
+        self.update_queue = update_queue
+        self.url_path = url_path
+        self.secret_token = secret_token
+        self.on_close = on_close
+        self.max_body_size = max_body_size
+        self.closed = False
+        self._lock = Lock()
+
+    def __call__(self, environ, start_response):
+        """Handle a single request."""
+        if environ.get("PATH_INFO", "") != self.url_path:
+            return _respond(start_response, "404 Not Found")
+        if environ.get("REQUEST_METHOD") != "POST":
+            return _respond(start_response, "405 Method Not Allowed")
+        if self.secret_token and not hmac.compare_digest(environ.get(SECRET_HEADER, "").encode("utf-8"),
+                                                         self.secret_token.encode("utf-8")):
+            logger.warning("Received webhook request without the secret token.")
+            return _respond(start_response, "403 Forbidden")
+        if self.closed:
+            return _respond(start_response, "503 Service Unavailable")
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            logger.warning("Received webhook request with an invalid Content-Length.")
+            return _respond(start_response, "400 Bad Request")
+        if length > self.max_body_size:
+            logger.warning("Received webhook request of %s bytes, over the limit of %s.", length, self.max_body_size)
+            return _respond(start_response, "413 Payload Too Large")
+        try:
+            data = json.loads(environ["wsgi.input"].read(length).decode("utf-8"))
+            if not isinstance(data, dict):
+                raise ValueError("Expected an update object.")
+            update = telegram.Update.de_json(data, self.bot)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logger.warning("Received malformed webhook request.")
+            return _respond(start_response, "400 Bad Request")
+        logger.debug("Received update %s via webhook.", update.update_id)
+        self.update_queue.put(update)
+        return _respond(start_response, "200 OK")
+
+    def serve(self, listen="0.0.0.0", port=8443, cert=None, key=None):
+        """Serve this app on a background thread, over HTTPS if a certificate and key are given.
+
+        Returns the server, whose shutdown method stops it.
+        """
+        server = make_server(listen, port, self, server_class=_ThreadingWSGIServer, handler_class=_QuietHandler)
+        if cert and key:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert, key)
+            server.socket = context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+        Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+        logger.info("Listening for webhook updates on %s:%s%s", listen, port, self.url_path)
+        return server
+
+    def close(self):
+        """Stop accepting updates, and call on_close the first time this is called."""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.on_close:
+            self.on_close()
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """An internal WSGI server that handles each request on its own thread."""
+
+    daemon_threads = True
+
+    def process_request_thread(self, request, client_address):
+        """Handle a request, first doing its TLS handshake, so a slow client doesn't hold up accepting others."""
+        if isinstance(request, ssl.SSLSocket):
+            try:
+                request.settimeout(HANDSHAKE_TIMEOUT)
+                request.do_handshake()
+                request.settimeout(None)
+            except OSError as error:
+                logger.debug("TLS handshake with %s failed: %s", client_address, error)
+                self.shutdown_request(request)
+                return
+        super().process_request_thread(request, client_address)
+
+class _QuietHandler(WSGIRequestHandler):
+    """An internal request handler that logs requests at debug level, instead of printing them."""
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        """Log a request."""
+        logger.debug(format, *args)
+
+def check_secret_token(secret_token):
+    """Raise ValueError if a secret token isn't one Telegram accepts: 1-256 letters, digits, _ and -."""
+    if secret_token is not None and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", secret_token):
+        raise ValueError("A webhook secret token must be 1-256 letters, digits, underscores and hyphens.")
+
+# helper
+
+def _respond(start_response, status):
+    """Send an empty response with a status."""
+    start_response(status, [("Content-Type", "text/plain"), ("Content-Length", "0")])
+    return [b""]
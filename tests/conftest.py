@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains fixtures shared by the tests, which run bots against a FakeTelegram."""
+
+from collections import OrderedDict
+
+import pytest
+
+from telegram_drillbot.drillbot import machine
+from telegram_drillbot.drillbot.drillbot import DrillBot
+from telegram_drillbot.drillbot.fake import FakeTelegram
+from telegram_drillbot.drillbot.transition import MenuTransition, SaveTransition
+
+@pytest.fixture(autouse=True)
+def no_keyboard_delay(monkeypatch):
+    """Replace stale keyboards right away, instead of waiting for replies to be seen first."""
+    monkeypatch.setattr(machine, "KEYBOARD_DELAY_SECONDS", 0)
+
+@pytest.fixture
+def transitions():
+    """Get the transitions of a small bot, with a menu leading to a pick of devices."""
+    return {
+        "menu": MenuTransition(OrderedDict([("Devices", "devices"), ("Rooms", "rooms")])),
+        "devices": SaveTransition("Pick a device", "device", options_func=lambda data: ["lamp", "fan"],
+                                  next_state="menu"),
+        "rooms": SaveTransition("Pick a room", "room", next_state="menu", page_size=3,
+                                options_func=lambda data: ("room {}".format(i) for i in range(8))),
+    }
+
+@pytest.fixture
+def drillbot(transitions):
+    """Get a bot that starts at the menu, with user 1 as its admin."""
+    bot = DrillBot("1:test", "menu", transitions)
+    bot.configure_auth(None, admin_ids=[1])
+    return bot
+
+@pytest.fixture
+def fake(drillbot): # pylint: disable=redefined-outer-name
+    """Get a FakeTelegram running the bot's handlers."""
+    return FakeTelegram(drillbot)
+
+def sent(fake): # pylint: disable=redefined-outer-name
+    """Get the (method, text) of each call made since the last time, other than answering callbacks."""
+    calls = [(method, kwargs.get("text")) for method, kwargs in fake.bot.calls
+             if method != "answer_callback_query"]
+    fake.bot.calls.clear()
+    return calls
+
+def state(fake, user_id): # pylint: disable=redefined-outer-name
+    """Get the state a user's conversation is in."""
+    info = fake.dispatcher.user_data[user_id]["MachineInfo"]
+    return info.breadcrumb[-1] if info.breadcrumb else None
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for the asyncio variant of the bot."""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from telegram_drillbot.drillbot.aio import AsyncDrillBot
+from telegram_drillbot.drillbot.fake import FakeTelegram
+from telegram_drillbot.drillbot.storage import SessionStorage
+
+from conftest import sent
+
+@pytest.fixture
+def async_bot(transitions):
+    """Get an async bot set up as run would, with metrics, and a FakeTelegram to create its updates."""
+    drillbot = AsyncDrillBot("1:test", "menu", transitions, workers=2)
+    drillbot.configure_metrics()
+    fake = FakeTelegram(drillbot)
+    drillbot.bot = drillbot._wrap_bot(fake.bot) # pylint: disable=protected-access
+    drillbot.executor = ThreadPoolExecutor(max_workers=2)
+    yield drillbot, fake
+    drillbot.executor.shutdown()
+
+def test_menu_selection(async_bot): # pylint: disable=redefined-outer-name
+    """Check that menu selections are routed to their states, and handling them is timed."""
+    drillbot, fake = async_bot
+    _handle(drillbot, fake, fake.message(1, "/start"))
+    _handle(drillbot, fake, fake.callback(1, "Devices"))
+    assert sent(fake) == [("send_message", "Menu:"), ("edit_message_text", "Pick a device:")]
+    assert drillbot.user_data[1]["MachineInfo"].breadcrumb[-1] == "devices"
+    assert 'drillbot_handler_seconds_count{state="menu"} 1' in drillbot.metrics.export()
+
+@pytest.mark.parametrize("option", ["configure_webhook", "configure_concurrency",
+                                    "configure_deferred_keyboards", "configure_long_running"])
+def test_unsupported_options(transitions, option):
+    """Check that options the async bot doesn't support are rejected, instead of ignored."""
+    drillbot = AsyncDrillBot("1:test", "menu", transitions)
+    with pytest.raises(NotImplementedError):
+        getattr(drillbot, option)()
+
+def test_state_is_loaded_off_the_loop(async_bot): # pylint: disable=redefined-outer-name
+    """Check that conversation state is loaded on the executor, since a storage may block."""
+    drillbot, fake = async_bot
+    threads = []
+    class _Storage(SessionStorage):
+        def load(self, key):
+            threads.append(threading.get_ident())
+            return super().load(key)
+    drillbot.storage = _Storage()
+    _handle(drillbot, fake, fake.message(1, "/start"))
+    _handle(drillbot, fake, fake.callback(1, "Devices"))
+    assert threads
+    assert threading.get_ident() not in threads
+    assert drillbot.storage.peek(1).breadcrumb[-1] == "devices"
+
+def test_restart_hook_takes_precedence(async_bot, transitions): # pylint: disable=redefined-outer-name
+    """Check that like the regular bot, an on_restart hook is used over reloading in place."""
+    drillbot, fake = async_bot
+    restarts = []
+    drillbot.configure_reload(lambda: dict(transitions))
+    drillbot.on_restart = lambda: restarts.append(True)
+    _handle(drillbot, fake, fake.message(1, "/restart"))
+    assert restarts == [True]
+    assert drillbot.transitions is transitions
+    assert sent(fake) == [("send_message", "Restarting...")]
+
+# helper
+
+def _handle(drillbot, fake, data):
+    """Handle an update with the async bot."""
+    asyncio.run(drillbot.process_update(fake.create_update(data)))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for authorizing users."""
+
+import os
+
+from telegram_drillbot.drillbot.auth import AccessList, DenialThrottle
+from telegram_drillbot.drillbot.drillbot import DENIED_MESSAGE
+from telegram_drillbot.drillbot.fake import FakeTelegram
+
+from conftest import sent
+
+def test_allow_list_is_reloaded(drillbot, tmp_path):
+    """Check that changes to an allow list's file take effect without restarting the bot."""
+    path = tmp_path / "allowed.txt"
+    path.write_text("2 # the first user\n\n")
+    drillbot.configure_auth(AccessList.from_file(str(path), reload_interval=0), notify=True)
+    fake = FakeTelegram(drillbot)
+    fake.send(2, "/start")
+    fake.send(3, "/start")
+    assert sent(fake) == [("send_message", "Menu:"), ("send_message", DENIED_MESSAGE.format(3))]
+    path.write_text("3\n")
+    os.utime(str(path), (0, 0))
+    fake.send(3, "/start")
+    fake.send(2, "/start")
+    assert sent(fake) == [("send_message", "Menu:"), ("send_message", DENIED_MESSAGE.format(2))]
+
+def test_unreadable_allow_list_keeps_old_ids(tmp_path):
+    """Check that an allow list whose file can't be read keeps the ids it had."""
+    path = tmp_path / "allowed.txt"
+    path.write_text("2\n")
+    allowed = AccessList.from_file(str(path), reload_interval=0)
+    path.write_text("not an id\n")
+    os.utime(str(path), (0, 0))
+    assert 2 in allowed
+    assert len(allowed) == 1
+
+def test_denials_are_throttled(drillbot):
+    """Check that a blocked user is notified once per interval, however many updates they send."""
+    drillbot.configure_auth([2], notify=True)
+    fake = FakeTelegram(drillbot)
+    for _ in range(3):
+        fake.send(3, "/start")
+        fake.press(3, "Devices")
+    assert sent(fake) == [("send_message", DENIED_MESSAGE.format(3))]
+    assert not fake.dispatcher.user_data[3]
+
+def test_denial_throttle_forgets_oldest_users():
+    """Check that the throttle only remembers its most recently denied users."""
+    throttle = DenialThrottle(interval=60, max_users=2)
+    assert [throttle.allow(user_id) for user_id in (1, 2, 1, 3)] == [True, True, False, True]
+    assert not throttle.allow(2)
+    assert throttle.allow(1)
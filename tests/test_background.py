@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for long-running handlers, which run in the background with a timeout."""
+
+import logging
+import time
+from collections import OrderedDict
+from threading import Event
+
+import pytest
+
+from telegram_drillbot.drillbot.drillbot import DrillBot
+from telegram_drillbot.drillbot.fake import FakeTelegram
+from telegram_drillbot.drillbot.transition import MenuTransition, NoTransition, SaveTransition, long_running
+
+from conftest import sent, state
+
+@pytest.fixture
+def release():
+    """Get an event that lets the slow handler finish."""
+    event = Event()
+    yield event
+    event.set()
+
+@pytest.fixture
+def slow_bot(release): # pylint: disable=redefined-outer-name
+    """Get a bot whose pick menu waits for release before showing its options."""
+    @long_running
+    def devices(data): # pylint: disable=unused-argument
+        release.wait(5)
+        return ["lamp", "fan"]
+    bot = DrillBot("1:test", "menu", {
+        "menu": MenuTransition(OrderedDict([("Pick", "pick"), ("Fast", "fast")])),
+        "pick": SaveTransition("Pick a device", "device", options_func=devices, next_state="menu"),
+        "fast": NoTransition(lambda data: "fast"),
+    })
+    bot.configure_long_running(timeout=0.5)
+    yield bot
+    release.set()
+    bot.background.stop()
+
+def test_finishes_in_time(slow_bot, release): # pylint: disable=redefined-outer-name
+    """Check that a background handler moves the conversation once it's done, and input meanwhile is turned away."""
+    fake = FakeTelegram(slow_bot)
+    fake.send(1, "/start")
+    fake.press(1, "Pick")
+    fake.press(1, "Fast")
+    assert sent(fake) == [("send_message", "Menu:"),
+                          ("send_message", "Working on it..."),
+                          ("send_message", "Still working on your last request, please wait.")]
+    release.set()
+    # the conversation moves once the handler has returned, after it's shown its keyboard
+    _wait_for(lambda: state(fake, 1) == "pick")
+    assert sent(fake) == [("delete_message", None), ("send_message", "Pick a device:")]
+
+def test_busy_reply_after_keyboard(slow_bot, release): # pylint: disable=redefined-outer-name
+    """Check that a reply that it's busy, sent below a background handler's keyboard, gets the keyboard sent again."""
+    fake = FakeTelegram(slow_bot)
+    fake.send(1, "/start")
+    fake.press(1, "Pick")
+    send_message = fake.bot.send_message
+    def press_meanwhile(chat_id, text, **kwargs):
+        result = send_message(chat_id, text, **kwargs)
+        if text == "Pick a device:":
+            fake.press(1, "Fast")
+        return result
+    fake.bot.send_message = press_meanwhile
+    release.set()
+    _wait_for(lambda: state(fake, 1) == "pick")
+    assert sent(fake)[-1] == ("send_message", "Still working on your last request, please wait.")
+    fake.press(1, "🏠")
+    assert sent(fake) == [("delete_message", None), ("send_message", "Menu:")]
+
+def test_timeout_rolls_back(slow_bot, release, caplog): # pylint: disable=redefined-outer-name
+    """Check that a handler that times out leaves the conversation where it was, and its late calls are dropped."""
+    fake = FakeTelegram(slow_bot)
+    fake.send(1, "/start")
+    fake.press(1, "Pick")
+    _wait_for(lambda: any(kwargs.get("text") == "Sorry, that took too long. Please try again."
+                          for _, kwargs in list(fake.bot.calls)))
+    release.set()
+    slow_bot.background.stop()
+    assert sent(fake) == [("send_message", "Menu:"),
+                          ("send_message", "Working on it..."),
+                          ("send_message", "Sorry, that took too long. Please try again.")]
+    assert state(fake, 1) == "menu"
+    # timing out is expected, so it isn't logged as an error
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+    # the user carries on from the menu
+    fake.press(1, "Fast")
+    assert sent(fake)[0] == ("send_message", "fast")
+
+# helper
+
+def _wait_for(condition, timeout=5.0):
+    """Wait until a condition is true, failing the test if it takes longer than timeout seconds."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out waiting."
+        time.sleep(0.01)
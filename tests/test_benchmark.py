@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for the offline benchmark, so performance regressions are caught with the tests."""
+
+import json
+
+from telegram_drillbot.drillbot import benchmark
+
+def test_run_scenario():
+    """Check that a scenario runs every user's steps, and reports on them."""
+    result = benchmark.run("remote", users=2, rounds=1, measure_memory=False)
+    assert result["updates"] == 2 * len(benchmark.remote_script())
+    assert result["updates_per_second"] > 0
+    assert 0 < result["p50_ms"] <= result["p99_ms"]
+    assert result["api_calls_per_update"] > 1
+
+def test_compare_flags_slowdown():
+    """Check that results worse than the baseline by more than the tolerance are flagged, and others aren't."""
+    result = benchmark.run("remote", users=1, rounds=1)
+    assert benchmark.compare([result], {"remote": result}, 0.2) == []
+    slower = dict(result, updates_per_second=result["updates_per_second"] / 2, p99_ms=result["p99_ms"] * 2,
+                  memory_per_user_bytes=result["memory_per_user_bytes"] * 2)
+    regressions = benchmark.compare([slower], {"remote": result}, 0.2)
+    assert [regression.split(" is ")[0] for regression in regressions] == [
+        "remote: updates_per_second", "remote: p99_ms", "remote: memory_per_user_bytes"]
+    assert benchmark.compare([slower], {"deep": result}, 0.2) == []
+
+def test_main_fails_on_regression(tmp_path, capsys):
+    """Check that the command line saves a baseline, and exits with an error when results regress from it."""
+    path = str(tmp_path / "baseline.json")
+    args = ["remote", "--rounds", "1", "--no-memory"]
+    assert benchmark.main(args + ["--save", path]) == 0
+    with open(path) as baseline_file:
+        baseline = json.load(baseline_file)
+    baseline["remote"]["updates_per_second"] *= 100
+    with open(path, "w") as baseline_file:
+        json.dump(baseline, baseline_file)
+    assert benchmark.main(args + ["--baseline", path]) == 1
+    assert "Regression: remote: updates_per_second" in capsys.readouterr().out
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for broadcasting to every user, and resuming interrupted broadcasts."""
+
+import os
+from collections import OrderedDict
+
+import pytest
+
+from telegram_drillbot.drillbot.broadcast import Broadcast, PENDING_PER_WORKER
+from telegram_drillbot.drillbot.drillbot import DrillBot
+from telegram_drillbot.drillbot.transition import MenuTransition
+
+from conftest import sent
+
+USERS = range(1, 6)
+
+@pytest.fixture
+def checkpoint(drillbot, fake, tmp_path):
+    """Get the path of the checkpoint for broadcasts to users who have all started the bot."""
+    path = str(tmp_path / "broadcast.txt")
+    # one worker, so the broadcast reaches users one at a time and can be stopped after any of them
+    drillbot.configure_broadcast(workers=1, rate=1000, checkpoint=path)
+    for user_id in USERS:
+        fake.send(user_id, "/start")
+    sent(fake)
+    return path
+
+def test_broadcast_message(drillbot, fake, checkpoint): # pylint: disable=redefined-outer-name
+    """Check that a broadcast reaches every user, and its checkpoint is removed once it's done."""
+    stats = drillbot.broadcast("Hello!")
+    assert stats == {"total": 5, "done": 5, "sent": 5, "failed": 0, "resumed": 0}
+    assert sent(fake) == [("send_message", "Hello!")] * 5
+    assert not os.path.exists(checkpoint)
+
+def test_resume_broadcast(drillbot, fake, checkpoint): # pylint: disable=redefined-outer-name
+    """Check that sending an interrupted broadcast again only reaches the users it hadn't yet."""
+    send_message = fake.bot.send_message
+    def interrupt(chat_id, text, **kwargs):
+        result = send_message(chat_id, text, **kwargs)
+        if fake.bot.count("send_message") == 2:
+            drillbot._broadcast.cancel() # pylint: disable=protected-access
+        return result
+    fake.bot.send_message = interrupt
+    stats = drillbot.broadcast("Hello!")
+    assert (stats["done"], stats["sent"]) == (2, 2)
+    assert os.path.exists(checkpoint)
+    fake.bot.send_message = send_message
+    stats = drillbot.broadcast("Hello!")
+    assert stats == {"total": 5, "done": 5, "sent": 3, "failed": 0, "resumed": 2}
+    assert sorted(kwargs["chat_id"] for method, kwargs in fake.bot.calls if method == "send_message") == list(USERS)
+    assert not os.path.exists(checkpoint)
+
+def test_resume_refresh(drillbot, fake, checkpoint, transitions): # pylint: disable=redefined-outer-name
+    """Check that refreshing again after an interrupted refresh only reaches the users it hadn't yet."""
+    options = OrderedDict([("Devices", "devices"), ("Rooms", "rooms"), ("Lights", "devices")])
+    drillbot.configure_reload(lambda: dict(transitions, menu=MenuTransition(options)))
+    drillbot.reload()
+    edit = fake.bot.edit_message_reply_markup
+    def interrupt(**kwargs):
+        result = edit(**kwargs)
+        if fake.bot.count("edit_message_reply_markup") == 2:
+            drillbot._broadcast.cancel() # pylint: disable=protected-access
+        return result
+    fake.bot.edit_message_reply_markup = interrupt
+    stats = drillbot.broadcast()
+    assert stats["done"] == 2
+    assert os.path.exists(checkpoint)
+    fake.bot.edit_message_reply_markup = edit
+    stats = drillbot.broadcast()
+    assert (stats["done"], stats["resumed"]) == (5, 2)
+    assert sorted(kwargs["chat_id"] for method, kwargs in fake.bot.calls
+                  if method == "edit_message_reply_markup") == list(USERS)
+    assert not os.path.exists(checkpoint)
+
+def test_broadcast_before_handlers_are_registered(transitions):
+    """Check that broadcasting before the bot has a dispatcher fails clearly."""
+    with pytest.raises(ValueError):
+        DrillBot("1:test", "menu", transitions).broadcast("Hello!")
+
+def test_other_broadcast_starts_over(drillbot, fake, checkpoint): # pylint: disable=redefined-outer-name
+    """Check that a checkpoint left by a different broadcast is ignored."""
+    drillbot.broadcast("Hello!")
+    with open(checkpoint, "w", encoding="utf-8") as checkpoint_file:
+        checkpoint_file.write("another job\n1\n2\n")
+    stats = drillbot.broadcast("Goodbye!")
+    assert (stats["sent"], stats["resumed"]) == (5, 0)
+
+def test_broadcast_marks_keyboards_stale(drillbot, fake, checkpoint): # pylint: disable=redefined-outer-name,unused-argument
+    """Check that after a broadcast message, a user's menu is sent again below it instead of edited above it."""
+    drillbot.broadcast("Hello!")
+    sent(fake)
+    fake.press(1, "Devices")
+    assert sent(fake) == [("delete_message", None), ("send_message", "Pick a device:")]
+
+def test_sessions_are_read_as_needed():
+    """Check that a broadcast only reads a few sessions ahead of the ones it's sending to, and skips repeated ones."""
+    read = []
+    def sessions():
+        for key in range(100):
+            read.append(key)
+            yield key, None
+            yield key, None
+    ahead = []
+    def func(bot, key, info): # pylint: disable=unused-argument
+        ahead.append(len(read) - key)
+        return True
+    stats = Broadcast(object(), func, "job", workers=2).run(sessions())
+    assert stats == {"total": 100, "done": 100, "sent": 100, "failed": 0, "resumed": 0}
+    assert max(ahead) <= 2 * PENDING_PER_WORKER + 1
+
+def test_broadcast_shares_outbound_queue(drillbot, fake, checkpoint): # pylint: disable=redefined-outer-name,unused-argument
+    """Check that broadcasts go through the rate limiter, along with regular traffic."""
+    drillbot.configure_rate_limit(per_chat_rate=1000, global_rate=1000)
+    try:
+        drillbot.broadcast("Hello!")
+        assert drillbot.outbound.stats()["submitted"] == 5
+    finally:
+        drillbot.outbound.stop()
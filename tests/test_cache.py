@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for caching transition callbacks."""
+
+import time
+
+from telegram_drillbot.drillbot.cache import PER_USER, cached
+from telegram_drillbot.drillbot.fake import FakeTelegram
+from telegram_drillbot.drillbot.transition import SaveTransition
+
+from conftest import state
+
+def test_options_are_cached_until_they_expire(drillbot, transitions):
+    """Check that cached options are reused by every user until their ttl passes."""
+    calls = []
+    transitions["devices"].options_func = cached(lambda data: calls.append(1) or ["lamp", "fan"], ttl=0.2)
+    fake = FakeTelegram(drillbot)
+    for user_id in (1, 2):
+        fake.send(user_id, "/start")
+        fake.press(user_id, "Devices")
+    assert len(calls) == 1
+    assert "fan" in fake.bot.buttons[2]
+    time.sleep(0.25)
+    fake.press(1, "lamp")
+    fake.press(1, "Devices")
+    assert len(calls) == 2
+
+def test_invalidate_cache(drillbot, transitions):
+    """Check that invalidating a transition's cache makes its options be read again."""
+    devices = ["lamp"]
+    transitions["devices"].options_func = cached(lambda data: list(devices), ttl=3600)
+    fake = FakeTelegram(drillbot)
+    fake.send(1, "/start")
+    fake.press(1, "Devices")
+    fake.press(1, "lamp")
+    devices.append("fan")
+    fake.press(1, "Devices")
+    assert "fan" not in fake.bot.buttons[1]
+    transitions["devices"].invalidate_cache()
+    fake.press(1, "lamp")
+    fake.press(1, "Devices")
+    assert "fan" in fake.bot.buttons[1]
+    fake.press(1, "fan")
+    assert state(fake, 1) == "menu"
+
+def test_per_user_key_and_generators(drillbot, transitions):
+    """Check that per-user results are kept apart, and generators are read once and cached in full."""
+    options = cached(lambda data: ("room {} of {}".format(i, data["user_id"]) for i in range(8)), key=PER_USER)
+    transitions["rooms"] = SaveTransition("Pick a room", "room", next_state="menu", page_size=3,
+                                          options_func=options)
+    fake = FakeTelegram(drillbot)
+    for user_id in (1, 2):
+        fake.send(user_id, "/start")
+        fake.press(user_id, "Rooms")
+    assert "room 0 of 1" in fake.bot.buttons[1]
+    assert "room 0 of 2" in fake.bot.buttons[2]
+    fake.press(1, "room 0 of 1")
+    fake.press(1, "Rooms")
+    assert (options.hits, options.misses) == (1, 2)
+    assert options({"user_id": 1})[7] == "room 7 of 1"
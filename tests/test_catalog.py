@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for building transitions from declarative specs as they're needed."""
+
+import json
+
+import pytest
+
+from telegram_drillbot.drillbot.catalog import TransitionCatalog
+from telegram_drillbot.drillbot.drillbot import DrillBot
+from telegram_drillbot.drillbot.fake import FakeTelegram
+
+from conftest import sent, state
+
+SPECS = {
+    "menu": {"type": "menu", "title": "Home", "options": [["Rooms", "rooms"], ["Status", "status"]]},
+    "rooms": {"type": "menu", "title": "Rooms", "options": {"Bedroom": "bedroom", "Kitchen": "kitchen"}},
+    "bedroom": {"type": "save", "message": "Pick a level", "name": "level", "next_state": "status",
+                "options": ["low", "high"], "reply": "Saved {level}."},
+    "kitchen": {"type": "save", "message": "Pick a level", "name": "level", "next_state": "@home",
+                "options": ["low", "high"]},
+    "status": {"type": "reply", "reply": "Level is {level}."},
+}
+
+def test_catalog_drives_bot(tmp_path):
+    """Check that a bot runs from a catalog file, filling in saved data, and only builds the states it reaches."""
+    path = tmp_path / "catalog.json"
+    path.write_text(json.dumps({"states": SPECS}))
+    catalog = TransitionCatalog.from_json(str(path))
+    fake = FakeTelegram(DrillBot("1:test", "menu", catalog))
+    assert catalog.built == 0
+    fake.send(1, "/start")
+    fake.press(1, "Rooms")
+    fake.press(1, "Bedroom")
+    fake.press(1, "high")
+    assert sent(fake)[-5:-1] == [("edit_message_text", "Pick a level:"), ("send_message", "Saved high."),
+                                 ("send_message", "Level is high."), ("delete_message", None)]
+    # a reply state doesn't move the conversation, so the user is asked again
+    assert state(fake, 1) == "bedroom"
+    assert catalog.built == 4
+
+def test_catalog_keeps_recently_used(caplog):
+    """Check that only the most recently used transitions are kept, and missing targets are logged when built."""
+    made = []
+    def factory(state):
+        made.append(state)
+        if state == "status":
+            return {"type": "menu", "options": [["Gone", "missing"]]}
+        return SPECS[state]
+    catalog = TransitionCatalog(factory=factory, states=list(SPECS), maxsize=2)
+    assert "rooms" in catalog and "missing" not in catalog and [] not in catalog
+    for name in ("menu", "rooms", "menu", "bedroom", "rooms"):
+        catalog[name] # pylint: disable=pointless-statement
+    assert made == ["menu", "rooms", "bedroom", "rooms"]
+    assert catalog.get_targets("bedroom") == ("status",)
+    catalog["status"] # pylint: disable=pointless-statement
+    assert "status -> missing" in caplog.text
+    with pytest.raises(KeyError):
+        catalog["missing"] # pylint: disable=pointless-statement
+
+def test_invalid_catalogs():
+    """Check that catalogs without specs, or with unknown types, are rejected."""
+    with pytest.raises(ValueError):
+        TransitionCatalog()
+    with pytest.raises(ValueError):
+        TransitionCatalog(factory=SPECS.get)
+    with pytest.raises(ValueError):
+        TransitionCatalog({"menu": {"type": "unknown"}})["menu"] # pylint: disable=expression-not-assigned
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for handling different users' updates concurrently, in order for each user."""
+
+import pytest
+
+from telegram_drillbot.drillbot.concurrency import SerialExecutor
+
+def test_jobs_run_in_order_per_key():
+    """Check that each key's jobs run one at a time in the order they were submitted."""
+    executor = SerialExecutor(workers=4)
+    results = {key: [] for key in range(3)}
+    for i in range(20):
+        for key in results:
+            executor.submit(key, results[key].append, i)
+    executor.shutdown()
+    assert results == {key: list(range(20)) for key in results}
+
+def test_key_continues_after_base_exception():
+    """Check that a job raising something other than an Exception doesn't stop its key's later jobs."""
+    executor = SerialExecutor(workers=1)
+    def interrupt():
+        raise KeyboardInterrupt()
+    first = executor.submit(1, interrupt)
+    second = executor.submit(1, lambda: "done")
+    assert second.result(timeout=5) == "done"
+    with pytest.raises(KeyboardInterrupt):
+        first.result()
+    executor.shutdown()
+    assert executor.pending() == 0
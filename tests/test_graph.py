@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for the compiled graph of a bot's states."""
+
+from collections import OrderedDict
+from enum import IntEnum
+
+import pytest
+
+from telegram_drillbot.drillbot.drillbot import DrillBot
+from telegram_drillbot.drillbot.fake import FakeTelegram
+from telegram_drillbot.drillbot.graph import StateGraph
+from telegram_drillbot.drillbot.machine import END
+from telegram_drillbot.drillbot.transition import MenuTransition, NoTransition, SaveTransition
+
+from conftest import sent, state
+
+class State(IntEnum):
+    """States that are ints, numbered like the ids states are interned to."""
+    MENU = 1
+    DEVICES = 2
+
+def test_int_states():
+    """Check that states that are ints are never mistaken for interned ids, or ids for states."""
+    graph = StateGraph(_int_transitions(), State.MENU)
+    menu, devices = graph.state_id(State.MENU), graph.state_id(State.DEVICES)
+    assert graph.state(menu) is State.MENU
+    assert graph.state(devices) is State.DEVICES
+    assert graph.state_id(devices) is devices
+    assert graph.state(State.MENU) is None
+    assert graph.state(State.DEVICES) is None
+    assert graph.state_id(END) == END
+
+def test_int_states_conversation():
+    """Check that a bot whose states are ints moves between them."""
+    drillbot = DrillBot("1:test", State.MENU, _int_transitions())
+    drillbot.configure_auth(None, admin_ids=[1])
+    fake = FakeTelegram(drillbot)
+    fake.send(1, "/start")
+    fake.press(1, "Devices")
+    assert state(fake, 1) is State.DEVICES
+    fake.press(1, "lamp")
+    assert state(fake, 1) is State.MENU
+    assert sent(fake)[-1] == ("edit_message_text", "Menu:")
+
+def test_missing_start(transitions):
+    """Check that a home state without a transition is rejected."""
+    with pytest.raises(ValueError, match="start nowhere"):
+        StateGraph(transitions, "nowhere")
+
+def test_dangling_target(transitions):
+    """Check that a transition leading to a state without a transition is rejected."""
+    transitions["menu"] = MenuTransition(OrderedDict([("Devices", "devices"), ("Lights", "lights")]))
+    with pytest.raises(ValueError, match="menu -> lights"):
+        StateGraph(transitions, "menu")
+
+def test_route(transitions):
+    """Check that menu selections are routed to their states, and anything else isn't routed."""
+    transitions["fast"] = NoTransition(lambda data: "fast")
+    graph = StateGraph(transitions, "menu", ("fast",))
+    assert graph.route("menu", "Rooms") == "rooms"
+    assert graph.route("menu", "Lights") is None
+    # other transitions read their own input
+    assert graph.route("devices", "lamp") is None
+    assert graph.route("fast", "Rooms") is None
+    assert graph.route("nowhere", "Rooms") is None
+
+# helper
+
+def _int_transitions():
+    """Get the transitions of a bot whose states are ints."""
+    return {
+        State.MENU: MenuTransition(OrderedDict([("Devices", State.DEVICES)])),
+        State.DEVICES: SaveTransition("Pick a device", "device", options_func=lambda data: ["lamp", "fan"],
+                                      next_state=State.MENU),
+    }
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for inline keyboards, including outdated and paginated ones."""
+
+import time
+
+import pytest
+
+from telegram_drillbot.drillbot import machine
+from telegram_drillbot.drillbot.drillbot import STALE_KEYBOARD_MESSAGE
+from telegram_drillbot.drillbot.fake import FakeTelegram
+
+from conftest import sent, state
+
+def test_keyboard_is_edited_in_place(fake):
+    """Check that moving between menus edits the keyboard, instead of sending a new one."""
+    fake.send(1, "/start")
+    fake.press(1, "Devices")
+    assert sent(fake) == [("send_message", "Menu:"), ("edit_message_text", "Pick a device:")]
+    fake.press(1, "fan")
+    assert sent(fake) == [("edit_message_text", "Menu:")]
+    assert state(fake, 1) == "menu"
+
+def test_stale_keyboard(fake):
+    """Check that a button from an outdated keyboard shows the current menu again, instead of acting."""
+    fake.send(1, "/start")
+    rooms = fake.bot.button_data(1, "Rooms")
+    fake.press(1, "Devices")
+    sent(fake)
+    _press_data(fake, 1, rooms)
+    assert sent(fake) == [("send_message", STALE_KEYBOARD_MESSAGE),
+                          ("delete_message", None),
+                          ("send_message", "Pick a device:")]
+    assert state(fake, 1) == "devices"
+    # the new keyboard works as usual
+    fake.press(1, "lamp")
+    assert state(fake, 1) == "menu"
+
+def test_deferred_keyboard_waits_for_user(drillbot, fake):
+    """Check that a keyboard sent in the background waits its turn with the user's updates."""
+    drillbot.configure_deferred_keyboards(workers=1)
+    drillbot.keyboard_sender.start()
+    try:
+        with drillbot.session_locks.hold(1):
+            fake.send(1, "/start")
+            time.sleep(0.1)
+            assert not sent(fake)
+        deadline = time.monotonic() + 5
+        while not fake.bot.count("send_message") and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert sent(fake) == [("send_message", "Menu:")]
+    finally:
+        drillbot.keyboard_sender.stop()
+
+def test_pages(fake):
+    """Check that options are shown a page at a time, and can be picked from any page."""
+    fake.send(1, "/start")
+    fake.press(1, "Rooms")
+    assert list(fake.bot.buttons[1])[:4] == ["room 0", "room 1", "room 2", "▶"]
+    fake.press(1, "▶")
+    assert list(fake.bot.buttons[1])[:5] == ["room 3", "room 4", "room 5", "◀", "▶"]
+    fake.press(1, "▶")
+    assert list(fake.bot.buttons[1])[:3] == ["room 6", "room 7", "◀"]
+    fake.press(1, "◀")
+    assert sent(fake)[-1] == ("edit_message_text", "Pick a room (page 2):")
+    assert state(fake, 1) == "rooms"
+    fake.press(1, "room 4")
+    assert state(fake, 1) == "menu"
+    assert fake.dispatcher.user_data[1]["MachineInfo"].merged() == {"room": "room 4"}
+
+def test_stale_page(fake):
+    """Check that a button from an earlier page is treated as outdated."""
+    fake.send(1, "/start")
+    fake.press(1, "Rooms")
+    first = fake.bot.button_data(1, "room 0")
+    fake.press(1, "▶")
+    sent(fake)
+    _press_data(fake, 1, first)
+    assert sent(fake)[0] == ("send_message", STALE_KEYBOARD_MESSAGE)
+    assert state(fake, 1) == "rooms"
+    assert "room" not in fake.dispatcher.user_data[1]["MachineInfo"].merged()
+
+# helper
+
+def _press_data(fake, user_id, data):
+    """Press a button with some callback data on the user's latest keyboard, such as one from an older keyboard."""
+    update = fake.callback(user_id, None)
+    update["callback_query"]["data"] = data
+    return fake.post(update)
+
+@pytest.mark.parametrize("cache_size, rebuilds", [(None, 0), (10, 300)])
+def test_options_cache_size(drillbot, transitions, monkeypatch, cache_size, rebuilds):
+    """Check that presses on many users' different keyboards are decoded from the cache if it fits them,
+    and otherwise by rebuilding the options, which calls options_func again."""
+    monkeypatch.setattr(machine, "OPTIONS_CACHE_SIZE", machine.OPTIONS_CACHE_SIZE)
+    if cache_size:
+        drillbot.configure_keyboard_cache(cache_size)
+    calls = []
+    def devices(data):
+        calls.append(data["user_id"])
+        return ["lamp {}".format(data["user_id"]), "fan"]
+    transitions["devices"].options_func = devices
+    fake = FakeTelegram(drillbot)
+    users = range(1, 301)
+    for user_id in users:
+        fake.send(user_id, "/start")
+        fake.press(user_id, "Devices")
+    calls.clear()
+    for user_id in users:
+        fake.press(user_id, "lamp {}".format(user_id))
+    assert len(calls) == rebuilds
+    assert [fake.dispatcher.user_data[user_id]["MachineInfo"].merged() for user_id in (1, 300)] == [
+        {"device": "lamp 1"}, {"device": "lamp 300"}]
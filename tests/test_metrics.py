@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for measuring where a bot spends its time."""
+
+from telegram_drillbot.drillbot.fake import FakeTelegram
+from telegram_drillbot.drillbot.metrics import PrometheusMetrics
+
+def test_label_values_are_capped(drillbot):
+    """Check that label values past the cap, such as new state names, are recorded as "other"."""
+    drillbot.configure_metrics(PrometheusMetrics(max_label_values=1))
+    fake = FakeTelegram(drillbot)
+    fake.send(1, "/start")
+    fake.press(1, "Devices")
+    fake.press(1, "lamp")
+    exported = drillbot.metrics.export()
+    assert 'drillbot_handler_seconds_count{state="menu"} 1' in exported
+    assert 'drillbot_handler_seconds_count{state="other"} 1' in exported
+    assert 'state="devices"' not in exported
+
+def test_export_format():
+    """Check that histograms are exported with cumulative buckets, and label values are escaped."""
+    metrics = PrometheusMetrics(buckets=(1.0, 0.1))
+    for value in (0.05, 0.5, 5.0):
+        metrics.observe("drillbot_test_seconds", value, state="a\"b")
+    metrics.increment("drillbot_test_total", 2, state="a")
+    assert metrics.export() == "\n".join([
+        "# TYPE drillbot_test_seconds histogram",
+        'drillbot_test_seconds_bucket{state="a\\"b",le="0.1"} 1',
+        'drillbot_test_seconds_bucket{state="a\\"b",le="1.0"} 2',
+        'drillbot_test_seconds_bucket{state="a\\"b",le="+Inf"} 3',
+        'drillbot_test_seconds_sum{state="a\\"b"} 5.55',
+        'drillbot_test_seconds_count{state="a\\"b"} 3',
+        "# TYPE drillbot_test_total counter",
+        'drillbot_test_total{state="a"} 2',
+    ]) + "\n"
+
+def test_bot_is_instrumented(drillbot, transitions):
+    """Check that Telegram calls, handlers, and failing transitions are all recorded."""
+    def fail(data):
+        raise RuntimeError("no devices")
+    transitions["devices"].options_func = fail
+    drillbot.configure_metrics()
+    fake = FakeTelegram(drillbot)
+    fake.send(1, "/start")
+    fake.press(1, "Devices")
+    exported = drillbot.metrics.export()
+    assert 'drillbot_telegram_seconds_count{method="answer_callback_query"} 1' in exported
+    assert 'drillbot_handler_seconds_count{state="menu"} 1' in exported
+    assert ('drillbot_transition_errors_total{direction="move_to",state="devices",transition="SaveTransition"} 1'
+            in exported)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for rate limiting outgoing Telegram calls."""
+
+import time
+from threading import Thread
+
+import pytest
+
+from telegram_drillbot.drillbot.fake import FakeBot
+from telegram_drillbot.drillbot.ratelimit import OutboundQueue, ThrottledBot
+
+from conftest import sent
+
+@pytest.fixture
+def limited(drillbot, fake):
+    """Get the bot's outbound queue, limiting each chat to a burst of 3 then 10 calls per second."""
+    drillbot.configure_rate_limit(per_chat_rate=10, global_rate=1000)
+    yield drillbot.outbound
+    drillbot.outbound.stop()
+
+def test_calls_to_a_chat_are_throttled(fake, limited): # pylint: disable=redefined-outer-name
+    """Check that calls to a chat past its burst wait for its bucket, while other chats go right away."""
+    start = time.monotonic()
+    for _ in range(5):
+        fake.send(1, "/start")
+    assert time.monotonic() - start >= 0.15
+    assert sent(fake).count(("send_message", "Menu:")) == 5
+    assert limited.stats()["max_wait"] >= 0.05
+    start = time.monotonic()
+    fake.send(2, "/start")
+    assert time.monotonic() - start < 0.1
+    stats = limited.stats()
+    assert stats["sent"] == stats["submitted"]
+    assert stats["queue_depth"] == 0
+
+def test_pending_edits_are_coalesced():
+    """Check that a pending edit of a message is replaced by a later edit of it, instead of both being made."""
+    fake_bot = FakeBot()
+    queue = OutboundQueue(per_chat_rate=2, burst=1)
+    bot = ThrottledBot(fake_bot, queue)
+    try:
+        bot.send_message(1, "Menu:")
+        first = Thread(target=bot.edit_message_text, args=("one",), kwargs={"chat_id": 1, "message_id": 1})
+        first.start()
+        _wait_for(lambda: queue.stats()["submitted"] == 2)
+        assert bot.edit_message_text("two", chat_id=1, message_id=1).text == "two"
+        first.join()
+    finally:
+        queue.stop()
+    assert [(method, kwargs["text"]) for method, kwargs in fake_bot.calls] == [
+        ("send_message", "Menu:"), ("edit_message_text", "two")]
+    assert queue.stats()["coalesced"] == 1
+
+def test_edits_are_merged_in_order():
+    """Check that text and keyboard edits of a message merge so it ends up as the latest edit left it."""
+    fake_bot = FakeBot()
+    queue = OutboundQueue(per_chat_rate=2, burst=1)
+    bot = ThrottledBot(fake_bot, queue)
+    try:
+        bot.send_message(1, "Menu:")
+        edits = [
+            (bot.edit_message_text, ("one",), {"reply_markup": _markup("a")}),
+            (bot.edit_message_reply_markup, (), {"reply_markup": _markup("b")}),
+        ]
+        threads = []
+        for count, (func, args, kwargs) in enumerate(edits, 2):
+            threads.append(Thread(target=func, args=args, kwargs=dict(kwargs, chat_id=1, message_id=1)))
+            threads[-1].start()
+            _wait_for(lambda count=count: queue.stats()["submitted"] == count)
+        for thread in threads:
+            thread.join()
+        # a keyboard edit keeps the pending text, and a text edit replaces the pending keyboard
+        bot.send_message(1, "Other:")
+        first = Thread(target=bot.edit_message_reply_markup,
+                       kwargs={"chat_id": 1, "message_id": 2, "reply_markup": _markup("c")})
+        first.start()
+        _wait_for(lambda: queue.stats()["submitted"] == 5)
+        bot.edit_message_text("two", chat_id=1, message_id=2, reply_markup=_markup("d"))
+        first.join()
+    finally:
+        queue.stop()
+    assert [(method, kwargs.get("text"), kwargs["reply_markup"]) for method, kwargs in fake_bot.calls] == [
+        ("send_message", "Menu:", None), ("edit_message_text", "one", _markup("b")),
+        ("send_message", "Other:", None), ("edit_message_text", "two", _markup("d"))]
+
+# helper
+
+def _wait_for(condition, timeout=5.0):
+    """Wait until a condition holds."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+def _markup(label):
+    """Get a keyboard with one button."""
+    return {"inline_keyboard": [[{"text": label, "callback_data": label}]]}
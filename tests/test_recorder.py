@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for recording updates and replaying them offline."""
+
+import gzip
+import time
+
+from telegram_drillbot.drillbot.drillbot import DrillBot
+from telegram_drillbot.drillbot.fake import FakeTelegram
+from telegram_drillbot.drillbot.recorder import read_recording
+from telegram_drillbot.drillbot.replay import replay
+from telegram_drillbot.drillbot.transition import SaveTransition, long_running
+
+def test_recording_is_anonymized(drillbot, tmp_path):
+    """Check that ids and free text are replaced, while commands and button labels are kept."""
+    path = str(tmp_path / "updates.jsonl")
+    drillbot.configure_recording(path, salt="salt")
+    fake = FakeTelegram(drillbot)
+    fake.send(1, "/start with arguments")
+    fake.press(1, "Devices")
+    fake.press(1, "lamp")
+    fake.send(1, "my secret", chat_id=-5)
+    drillbot.recorder.close()
+    entries = list(read_recording(path))
+    user = drillbot.recorder.pseudonym(1)
+    assert user != 1
+    assert [{key: value for key, value in entry.items() if key != "t"} for entry in entries] == [
+        {"u": user, "m": "/start"},
+        {"u": user, "b": "Devices"},
+        {"u": user, "b": "lamp"},
+        {"u": user, "c": drillbot.recorder.pseudonym(-5), "m": entries[3]["m"]},
+    ]
+    assert entries[3]["m"].startswith("text-")
+    with open(path, encoding="utf-8") as recording:
+        assert "secret" not in recording.read()
+
+def test_unfinished_recordings_are_read(tmp_path):
+    """Check that a recording cut off mid-line, or a gzipped one that wasn't closed, can still be read."""
+    path = str(tmp_path / "updates.jsonl")
+    with open(path, "w", encoding="utf-8") as recording:
+        recording.write('{"t":1,"u":2,"m":"/start"}\n{"t":2,"u":2,"b":"Dev')
+    assert list(read_recording(path)) == [{"t": 1, "u": 2, "m": "/start"}]
+    path = str(tmp_path / "updates.jsonl.gz")
+    with open(path, "wb") as recording:
+        recording.write(gzip.compress(b'{"t":1,"u":2,"m":"/start"}\n' * 100)[:-8])
+    assert len(list(read_recording(path))) == 100
+
+def test_replay(transitions):
+    """Check that replaying a recording drives the bot through the same states, and reports on each."""
+    drillbot = DrillBot("1:test", "menu", transitions)
+    entries = [
+        {"t": 1, "u": 7, "m": "/start"},
+        {"t": 2, "u": 7, "b": "Devices"},
+        {"t": 3, "u": 7, "b": "fan"},
+        {"t": 4, "u": 7, "b": "Rooms"},
+    ]
+    results = {result["state"]: result for result in replay(drillbot, entries)}
+    assert {state: result["updates"] for state, result in results.items()} == {"(none)": 1, "menu": 2, "devices": 1}
+    assert results["devices"]["api_calls_per_update"] > 0
+    info = drillbot._dispatcher.user_data[7]["MachineInfo"] # pylint: disable=protected-access
+    assert info.breadcrumb[-1] == "rooms"
+    assert info.merged() == {"device": "fan"}
+
+def test_replay_runs_background_work_in_line(transitions):
+    """Check that long-running transitions and deferred keyboards finish within the update that started them."""
+    @long_running
+    def devices(data): # pylint: disable=unused-argument
+        time.sleep(0.05)
+        return ["lamp", "fan"]
+    transitions["devices"] = SaveTransition("Pick a device", "device", options_func=devices, next_state="menu")
+    drillbot = DrillBot("1:test", "menu", transitions)
+    drillbot.configure_long_running(timeout=5)
+    drillbot.configure_deferred_keyboards()
+    entries = [
+        {"t": 1, "u": 7, "m": "/start"},
+        {"t": 2, "u": 7, "b": "Devices"},
+        {"t": 3, "u": 7, "b": "fan"},
+    ]
+    results = {result["state"]: result for result in replay(drillbot, entries)}
+    assert results["menu"]["p50_ms"] >= 50
+    assert results["devices"]["api_calls_per_update"] > 0
+    info = drillbot._dispatcher.user_data[7]["MachineInfo"] # pylint: disable=protected-access
+    assert info.breadcrumb[-1] == "menu"
+    assert info.merged() == {"device": "fan"}
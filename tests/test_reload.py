@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for reloading a bot's transitions in place."""
+
+from collections import OrderedDict
+
+from telegram_drillbot.drillbot.transition import MenuTransition, SaveTransition
+
+from conftest import sent, state
+
+def test_restart_reloads_in_place(drillbot, fake, transitions):
+    """Check that /restart swaps in new transitions, and conversations carry on in them."""
+    transitions = dict(transitions, devices=SaveTransition("Pick a device", "device", next_state="menu",
+                                                           options_func=lambda data: ["lamp", "heater"]))
+    drillbot.configure_reload(lambda: transitions)
+    fake.send(1, "/start")
+    fake.press(1, "Devices")
+    fake.send(1, "/restart")
+    assert sent(fake)[-1] == ("send_message", "Reloaded 3 states.")
+    assert drillbot.transitions is transitions
+    assert state(fake, 1) == "devices"
+    fake.press(1, "heater")
+    assert state(fake, 1) == "menu"
+    assert fake.dispatcher.user_data[1]["MachineInfo"].merged() == {"device": "heater"}
+
+def test_failed_reload_keeps_transitions(drillbot, fake, transitions):
+    """Check that if the factory fails, the bot keeps running with its current transitions."""
+    def factory():
+        raise RuntimeError("bad transitions")
+    drillbot.configure_reload(factory)
+    fake.send(1, "/start")
+    fake.send(1, "/restart")
+    assert sent(fake)[-1] == ("send_message", "Unexpected error! See logs for details.")
+    assert drillbot.transitions is transitions
+    fake.press(1, "Devices")
+    assert state(fake, 1) == "devices"
+
+def test_reload_drops_removed_states(drillbot, fake):
+    """Check that states removed by a reload can't be reached, while the rest of the menu still works."""
+    drillbot.configure_reload(lambda: {"menu": MenuTransition(OrderedDict([("Rooms", "rooms")])),
+                                       "rooms": SaveTransition("Pick a room", "room", next_state="menu")})
+    fake.send(1, "/start")
+    fake.send(1, "/restart")
+    fake.send(1, "/start")
+    assert "Devices" not in fake.bot.buttons[1]
+    fake.press(1, "Rooms")
+    assert state(fake, 1) == "rooms"
+
+def test_restart_is_admin_only(drillbot, fake, transitions):
+    """Check that only admins can reload."""
+    drillbot.configure_reload(lambda: dict(transitions))
+    fake.send(2, "/restart")
+    assert sent(fake) == [("send_message", "Error: admin only operation.")]
+    assert drillbot.transitions is transitions
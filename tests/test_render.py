@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for skipping keyboard edits that wouldn't change anything."""
+
+from collections import OrderedDict
+
+from telegram_drillbot.drillbot.transition import MenuTransition
+
+from conftest import sent
+
+def test_unchanged_keyboard_is_not_edited(drillbot, fake):
+    """Check that showing the same keyboard again makes no Telegram call."""
+    fake.send(1, "/start")
+    fake.press(1, "Devices")
+    sent(fake)
+    drillbot.broadcast()
+    assert sent(fake) == []
+
+def test_only_changed_parts_are_edited(drillbot, fake, transitions):
+    """Check that if only the buttons changed, only they're edited, and otherwise the text is too."""
+    menu = {"title": "Menu", "options": OrderedDict([("Devices", "devices"), ("Rooms", "rooms")])}
+    drillbot.configure_reload(lambda: dict(transitions, menu=MenuTransition(menu["options"], menu["title"])))
+    drillbot.reload()
+    fake.send(1, "/start")
+    sent(fake)
+    menu["options"] = OrderedDict(menu["options"], Lights="devices")
+    drillbot.reload()
+    drillbot.broadcast()
+    assert sent(fake) == [("edit_message_reply_markup", None)]
+    assert "Lights" in fake.bot.buttons[1]
+    menu["title"] = "Main menu"
+    drillbot.reload()
+    drillbot.broadcast()
+    assert sent(fake) == [("edit_message_text", "Main menu:")]
+
+def test_fingerprint_survives_storage(drillbot, fake):
+    """Check that the last shown keyboard is remembered across a round trip through JSON."""
+    fake.send(1, "/start")
+    info = fake.dispatcher.user_data[1]["MachineInfo"]
+    assert info.keyboard_render is not None
+    assert type(info).from_json(info.to_json()).keyboard_render == info.keyboard_render
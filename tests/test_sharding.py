@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for sharding a bot across worker processes."""
+
+from collections import deque
+from queue import Queue
+
+import telegram
+
+from telegram_drillbot.drillbot.sharding import ShardedRunner
+
+def test_shard_for():
+    """Check that updates are sharded by their user, or their chat if they don't have one."""
+    runner = ShardedRunner("1:test", None, shards=4)
+    chat = {"id": -6, "type": "group"}
+    assert runner.shard_for(_update(message={"message_id": 1, "date": 0, "chat": chat, "text": "hi",
+                                             "from": {"id": 7, "first_name": "a", "is_bot": False}})) == 3
+    assert runner.shard_for(_update(channel_post={"message_id": 1, "date": 0, "text": "hi",
+                                                  "chat": {"id": -5, "type": "channel"}})) == 3
+    assert runner.shard_for(_update()) == 0
+
+def test_full_shard_does_not_block_others():
+    """Check that a full shard's updates are held back in order, then dropped, while other shards keep receiving."""
+    runner = _runner(shards=2, queue_size=1, overflow_size=2)
+    for data in ("a1", "a2", "a3", "a4"):
+        runner._hand_out(0, data) # pylint: disable=protected-access
+    runner._hand_out(1, "b1") # pylint: disable=protected-access
+    assert runner._queues[1].get_nowait() == "b1" # pylint: disable=protected-access
+    assert runner.dropped == 1
+    received = []
+    for _ in range(2):
+        received.append(runner._queues[0].get_nowait()) # pylint: disable=protected-access
+        runner._flush_overflow() # pylint: disable=protected-access
+    runner._hand_out(0, "a5") # pylint: disable=protected-access
+    received.append(runner._queues[0].get_nowait()) # pylint: disable=protected-access
+    runner._flush_overflow() # pylint: disable=protected-access
+    received.append(runner._queues[0].get_nowait()) # pylint: disable=protected-access
+    assert received == ["a1", "a2", "a3", "a5"]
+
+# helper
+
+def _runner(shards, queue_size, overflow_size):
+    """Get a runner with in-process queues and no workers, to hand updates out to."""
+    runner = ShardedRunner("1:test", None, shards=shards, queue_size=queue_size, overflow_size=overflow_size)
+    runner._queues = [Queue(queue_size) for _ in range(shards)] # pylint: disable=protected-access
+    runner._overflow = [deque() for _ in range(shards)] # pylint: disable=protected-access
+    return runner
+
+def _update(**data):
+    """Create an update from its JSON."""
+    return telegram.Update.de_json(dict(data, update_id=1), None)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for conversation state, the machine that keeps it during an update, and serializing it."""
+
+from datetime import datetime
+
+import pytest
+
+from telegram_drillbot.drillbot import machine
+from telegram_drillbot.drillbot.machine import Machine, _MachineInfo
+
+def test_handler_layers_share_machine(fake, monkeypatch):
+    """Check that the handler layers share one machine per update, which is forgotten once it's handled."""
+    machines = []
+    for_update = Machine.for_update.__func__
+    def noting(cls, *args, **kwargs):
+        machines.append(for_update(cls, *args, **kwargs))
+        return machines[-1]
+    monkeypatch.setattr(Machine, "for_update", classmethod(noting))
+    fake.send(1, "/start")
+    # the setup and conversation layers, since the auth layer doesn't need one
+    assert len(machines) >= 2
+    assert len(set(map(id, machines))) == 1
+    assert getattr(machine._context, "machine", None) is None # pylint: disable=protected-access
+    fake.press(1, "Devices")
+    assert len(set(map(id, machines))) == 2
+
+def test_ascending_restores_shadowed_values():
+    """Check that going back after a value was saved again further down restores the one it overrode."""
+    info = _MachineInfo()
+    info.update_debug_data({"room": "attic", "mode": "test"})
+    info.push_frame("menu")
+    info.set_value("room", "hall")
+    info.push_frame("rooms")
+    info.set_value("room", "kitchen")
+    info.set_value("device", "lamp")
+    info.push_frame("devices")
+    info.set_value("device", "fan")
+    info.set_value("room", "garage")
+    assert info.merged() == {"room": "garage", "device": "fan", "mode": "test"}
+    expected = [{"room": "kitchen", "device": "lamp", "mode": "test"},
+                {"room": "hall", "mode": "test"},
+                {"room": "attic", "mode": "test"}]
+    for merged in expected:
+        info.pop_frame()
+        # the kept merge matches merging the stack over again
+        assert info.merged() == merged == _MachineInfo.from_bytes(info.to_bytes()).merged()
+    info.push_frame("menu")
+    info.set_value("room", "hall")
+    info.merged()
+    info.clear_frames()
+    assert info.merged() == {"room": "attic", "mode": "test"}
+
+def test_bytes_round_trip():
+    """Check that a state with data and a keyboard is the same after converting it to bytes and back."""
+    info = _populated()
+    restored = _MachineInfo.from_bytes(info.to_bytes())
+    assert restored.to_dict() == info.to_dict()
+    assert restored.merged() == {"device": "fan", "room": "kitchen", "debug": True}
+
+def test_json_round_trip():
+    """Check that a state with data and a keyboard is the same after converting it to JSON and back."""
+    info = _populated()
+    restored = _MachineInfo.from_json(info.to_json())
+    assert restored.to_dict() == info.to_dict()
+    assert restored.breadcrumb == ("menu", "rooms", "devices")
+
+def test_old_format_is_upgraded(monkeypatch):
+    """Check that a state saved before keyboard pages were kept loads, with the options it kept dropped."""
+    state = (5, ("menu", "rooms"), [None, {"room": "kitchen"}], None, False,
+             42, False, datetime(2020, 1, 1), "0123456789abcdef", 7, None, ["lamp", "fan"])
+    restored = _MachineInfo.from_bytes(_blob(monkeypatch, state))
+    assert restored.breadcrumb == ("menu", "rooms")
+    assert restored.keyboard_version == "0123456789abcdef"
+    assert restored.keyboard_page is None
+
+@pytest.mark.parametrize("version", [0, _MachineInfo.FORMAT_VERSION + 1])
+def test_unsupported_format_is_rejected(monkeypatch, version):
+    """Check that a state in a format this version doesn't know is rejected instead of misread."""
+    state = (version,) + _populated().__getstate__()[1:]
+    with pytest.raises(ValueError, match="Unsupported state format version"):
+        _MachineInfo.from_bytes(_blob(monkeypatch, state))
+    text = _populated().to_json().replace('"version":{}'.format(_MachineInfo.FORMAT_VERSION),
+                                          '"version":{}'.format(version))
+    with pytest.raises(ValueError, match="Unsupported state format version"):
+        _MachineInfo.from_json(text)
+
+# helper
+
+def _populated():
+    """Get a state with frames of data, debug data, and a keyboard on its second page."""
+    info = _MachineInfo()
+    info.push_frame("menu")
+    info.push_frame("rooms")
+    info.set_value("room", "kitchen")
+    info.push_frame("devices")
+    info.set_value("device", "fan")
+    info.update_debug_data({"debug": True})
+    info.keyboard_id = 42
+    info.keyboard_stale = True
+    info.keyboard_date = datetime(2020, 1, 1, 12, 30)
+    info.keyboard_version = "0123456789abcdef"
+    info.keyboard_render = 1 << 40 | 7
+    info.keyboard_chat = -100
+    info.keyboard_page = 1
+    return info
+
+def _blob(monkeypatch, state):
+    """Get the bytes of a state pickled as the given tuple, such as by an earlier version."""
+    with monkeypatch.context() as patch:
+        patch.setattr(_MachineInfo, "__getstate__", lambda self: state)
+        return _MachineInfo().to_bytes()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for keeping conversation state in a storage that outlives the bot."""
+
+import pytest
+
+from telegram_drillbot.drillbot import machine
+from telegram_drillbot.drillbot.drillbot import DrillBot
+from telegram_drillbot.drillbot.fake import FakeTelegram
+from telegram_drillbot.drillbot.storage import SqliteStorage, SessionStorage
+
+from conftest import sent
+
+@pytest.fixture
+def restart(transitions, tmp_path):
+    """Get a function that starts the bot again with the same database, as if after a restart.
+
+    It returns the bot and a FakeTelegram running it.
+    """
+    path = str(tmp_path / "state.db")
+    bots = []
+    def start(bot=None):
+        if bots:
+            bots[-1].storage.close()
+        drillbot = DrillBot("1:test", "menu", transitions)
+        drillbot.configure_storage(SqliteStorage(path))
+        bots.append(drillbot)
+        # keep the same Telegram, so the keyboards sent before the restart are still there
+        return drillbot, FakeTelegram(drillbot, bot=bot)
+    yield start
+    bots[-1].storage.close()
+
+def test_resume_after_restart(restart): # pylint: disable=redefined-outer-name
+    """Check that a user picks up where they left off after the bot restarts."""
+    _, fake = restart()
+    fake.send(1, "/start")
+    fake.press(1, "Devices")
+    sent(fake)
+    drillbot, fake = restart(fake.bot)
+    fake.press(1, "fan")
+    assert sent(fake) == [("edit_message_text", "Menu:")]
+    info = drillbot.storage.load(1)
+    assert info.breadcrumb[-1] == "menu"
+    assert info.merged() == {"device": "fan"}
+
+def test_resume_in_new_process(restart): # pylint: disable=redefined-outer-name
+    """Check that buttons still work when nothing about the keyboards is cached in memory."""
+    _, fake = restart()
+    fake.send(1, "/start")
+    fake.press(1, "Rooms")
+    fake.press(1, "▶")
+    sent(fake)
+    machine._options_version.cache_clear() # pylint: disable=protected-access
+    machine._cached_keyboard.cache_clear() # pylint: disable=protected-access
+    machine._keyboard_options.clear() # pylint: disable=protected-access
+    drillbot, fake = restart(fake.bot)
+    fake.press(1, "room 4")
+    assert sent(fake) == [("edit_message_text", "Menu:")]
+    assert drillbot.storage.load(1).merged() == {"room": "room 4"}
+
+def test_storage_survives_reopening(tmp_path):
+    """Check that saved states are written out by close, and read back by a new storage."""
+    path = str(tmp_path / "state.db")
+    storage = SqliteStorage(path, flush_interval=60)
+    for key in range(10):
+        info = machine._MachineInfo() # pylint: disable=protected-access
+        info.breadcrumb = ("state {}".format(key),)
+        storage.save(key, info)
+    storage.close()
+    storage = SqliteStorage(path)
+    assert [storage.load(key).breadcrumb for key in range(10)] == [("state {}".format(key),) for key in range(10)]
+    assert sorted(key for key, _ in storage.items()) == list(range(10))
+    storage.close()
+
+def test_spilled_session_resumes(transitions, tmp_path):
+    """Check that a session evicted to a SqliteStorage is loaded back when the user returns."""
+    drillbot = DrillBot("1:test", "menu", transitions)
+    drillbot.configure_sessions(max_sessions=1, spill=SqliteStorage(str(tmp_path / "spill.db")))
+    fake = FakeTelegram(drillbot)
+    fake.send(1, "/start")
+    fake.press(1, "Devices")
+    fake.send(2, "/start")
+    assert drillbot.storage.size() == 1
+    fake.press(1, "lamp")
+    assert drillbot.storage.load(1).merged() == {"device": "lamp"}
+    drillbot.storage.close()
+
+def test_session_storage_on_evict_errors_are_contained():
+    """Check that an on_evict that fails doesn't stop sessions from being evicted or the storage from being used."""
+    storage = SessionStorage(max_sessions=1)
+    evicted = []
+    def on_evict(key):
+        evicted.append(key)
+        raise RuntimeError("on_evict failed")
+    storage.on_evict = on_evict
+    for key in range(3):
+        storage.save(key, machine._MachineInfo()) # pylint: disable=protected-access
+    assert evicted == [0, 1]
+    assert storage.size() == 1
+
+@pytest.mark.parametrize("sessions_first", [True, False])
+def test_sessions_spill_to_configured_storage(transitions, tmp_path, sessions_first):
+    """Check that configuring sessions and a storage, in either order, spills sessions to the storage."""
+    drillbot = DrillBot("1:test", "menu", transitions)
+    storage = SqliteStorage(str(tmp_path / "state.db"))
+    if sessions_first:
+        drillbot.configure_sessions(max_sessions=1)
+        drillbot.configure_storage(storage)
+    else:
+        drillbot.configure_storage(storage)
+        drillbot.configure_sessions(max_sessions=1)
+    assert isinstance(drillbot.storage, SessionStorage)
+    assert drillbot.storage.spill is storage
+    other = SqliteStorage(str(tmp_path / "other.db"))
+    with pytest.raises(ValueError):
+        drillbot.configure_sessions(spill=other)
+    other.close()
+    storage.close()
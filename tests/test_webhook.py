@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This module contains tests for receiving updates via webhook."""
+
+import io
+import json
+import socket
+import ssl
+import subprocess
+from queue import Queue
+
+import pytest
+
+from telegram_drillbot.drillbot.fake import FakeBot
+from telegram_drillbot.drillbot.webhook import WebhookApp, SECRET_HEADER, check_secret_token
+
+from conftest import sent, state
+
+def test_update_is_handled(fake):
+    """Check that a posted update goes through the bot's handlers."""
+    assert fake.send(1, "/start") == "200 OK"
+    assert sent(fake) == [("send_message", "Menu:")]
+    assert fake.press(1, "Devices") == "200 OK"
+    assert state(fake, 1) == "devices"
+
+def test_wrong_path_and_method():
+    """Check that only posts to the app's path are accepted."""
+    app = WebhookApp(FakeBot(), Queue(), "secret-path")
+    assert _request(app, {}, path="/") == "404 Not Found"
+    assert _request(app, {}, path="/secret-path", method="GET") == "405 Method Not Allowed"
+    assert _request(app, {"update_id": 1}, path="/secret-path") == "200 OK"
+
+def test_secret_token():
+    """Check that with a secret token, only requests carrying it are accepted."""
+    queue = Queue()
+    app = WebhookApp(FakeBot(), queue, secret_token="s3cret")
+    assert _request(app, {"update_id": 1}) == "403 Forbidden"
+    assert _request(app, {"update_id": 1}, headers={SECRET_HEADER: "wrong"}) == "403 Forbidden"
+    assert _request(app, {"update_id": 1}, headers={SECRET_HEADER: "s3cret"}) == "200 OK"
+    assert queue.qsize() == 1
+
+@pytest.mark.parametrize("body", [b"not json", b"[]", b"1", b"\"update\"", b"{\"update_id\": 1, \"message\": 1}"])
+def test_malformed_body(body):
+    """Check that bodies that aren't updates are rejected without reaching the dispatcher."""
+    queue = Queue()
+    app = WebhookApp(FakeBot(), queue)
+    assert _request(app, body=body) == "400 Bad Request"
+    assert queue.empty()
+
+def test_body_size_limit():
+    """Check that bodies over the size limit, or with an invalid size, are rejected without being read."""
+    queue = Queue()
+    app = WebhookApp(FakeBot(), queue, max_body_size=16)
+    assert _request(app, {"update_id": 1}) == "200 OK"
+    assert _request(app, {"update_id": 1, "padding": "x" * 16}) == "413 Payload Too Large"
+    assert _request(app, {"update_id": 1}, headers={"CONTENT_LENGTH": "-1"}) == "400 Bad Request"
+    assert queue.qsize() == 1
+
+def test_close():
+    """Check that a closed app refuses updates, and calls on_close once."""
+    closed = []
+    app = WebhookApp(FakeBot(), Queue(), on_close=lambda: closed.append(True))
+    app.close()
+    app.close()
+    assert closed == [True]
+    assert _request(app, {"update_id": 1}) == "503 Service Unavailable"
+
+def test_check_secret_token():
+    """Check that secret tokens Telegram wouldn't accept are rejected up front."""
+    check_secret_token(None)
+    check_secret_token("Abc_123-xyz")
+    for token in ("", "has space", "x" * 257, "trailing\n"):
+        with pytest.raises(ValueError):
+            check_secret_token(token)
+
+def test_tls_handshake_does_not_block_accepting(tmp_path):
+    """Check that a client stalled before its TLS handshake doesn't stop other clients being served."""
+    cert, key = str(tmp_path / "cert.pem"), str(tmp_path / "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-subj", "/CN=localhost",
+                    "-days", "1", "-keyout", key, "-out", cert], check=True, capture_output=True)
+    queue = Queue()
+    server = WebhookApp(FakeBot(), queue).serve("127.0.0.1", 0, cert=cert, key=key)
+    port = server.server_address[1]
+    try:
+        with socket.create_connection(("127.0.0.1", port)):
+            context = ssl.create_default_context(cafile=cert)
+            with socket.create_connection(("127.0.0.1", port), timeout=5) as raw, \
+                 context.wrap_socket(raw, server_hostname="localhost") as client:
+                body = b"{\"update_id\": 1}"
+                client.sendall(b"POST / HTTP/1.0\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+                assert client.recv(1024).startswith(b"HTTP/1.0 200")
+    finally:
+        server.shutdown()
+    assert queue.qsize() == 1
+
+# helper
+
+def _request(app, data=None, body=None, path="/", method="POST", headers=None): # pylint: disable=too-many-arguments
+    """Make a request to a WSGI app, returning the response status."""
+    if body is None:
+        body = json.dumps(data).encode("utf-8")
+    environ = {
+        "PATH_INFO": path,
+        "REQUEST_METHOD": method,
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": io.BytesIO(body),
+    }
+    environ.update(headers or {})
+    statuses = []
+    app(environ, lambda status, headers: statuses.append(status))
+    return statuses[0]